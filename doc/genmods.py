@@ -61,7 +61,9 @@ MODULES = [
     ('profile', 'Model profile'),
     ('reflectivity', 'Reflectivity'),
     ('reflmodule', 'Low level reflectivity calculations'),
+    ('reflmodule_numpy', 'Low level reflectivity calculations in numpy'),
     ('resolution', 'Resolution'),
+    ('snapshot', 'Saved models for fast reloading'),
     ('snsdata', 'SNS Data'),
     ('staj', 'Staj File'),
     ('stajconvert', 'Staj File Converter'),
@@ -16,3 +16,15 @@ See http://www.reflectometry.org/danse/reflectometry for online manuals.
 """
 
 __version__ = "0.8.5"
+
+def __getattr__(name):
+    """
+    Import submodules such as refl1d.probe on first access, so that
+    *import refl1d* does not load numpy, bumps or periodictable.
+    """
+    import importlib
+    import importlib.util
+    if not name.startswith('_'):
+        if importlib.util.find_spec('.'+name, __name__) is not None:
+            return importlib.import_module('.'+name, __name__)
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
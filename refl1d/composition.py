@@ -15,6 +15,7 @@ from numpy import inf, exp
 from bumps.parameter import Parameter as Par
 
 from .model import Layer
+from .material import mix_sld
 from .materialdb import air
 
 class CompositionSpace(Layer):
@@ -77,27 +78,20 @@ class CompositionSpace(Layer):
         # Uniform stepping
         z = np.arange(slabs.dz/2, self.thickness.value, slabs.dz)
 
-        # Storage for the sub-totals
-        n, k = len(z), slabs.nprobe
-        rho_total = np.zeros((n, k))
-        mu_total = np.zeros((n, k))
-        volume_total = np.zeros_like(z)
-
-        # Accumulate the parts
-        for p in self.parts:
-            f, rho, mu = p.f_sld(probe, z)
-            rho_total += rho
-            mu_total += mu
-            volume_total += f
+        # Volume fraction of each part at each z, with the remainder solvent
+        volume = np.empty((len(z), len(self.parts)+1))
+        for k, p in enumerate(self.parts):
+            volume[:, k] = p.volume(z)
+        volume[:, -1] = 1 - np.sum(volume[:, :-1], axis=1)
 
-        # Remainder is solvent
-        rho, mu = probe.sld(self.solvent)
-        rho_total += rho*(1-volume_total)
-        mu_total += mu*(1-volume_total)
+        # Mix the component slds over the whole grid at once
+        slds = [p.material.sld(probe) for p in self.parts]
+        slds.append(self.solvent.sld(probe))
+        rho, irho = mix_sld(volume, slds)
 
-        # Add to model
+        # Add to model, with one row per wavelength
         w = slabs.dz * np.ones(z.shape)
-        slabs.extend(w=w, rho=rho_total, mu=mu_total)
+        slabs.extend(w=w, rho=rho.T, irho=irho.T)
 
 class Part(object):
     def __init__(self, material, profile, fraction=1):
@@ -116,9 +110,15 @@ class Part(object):
         # Note: combining f and sld because there my be some
         # composites such as oriented proteins for which the
         # sld and volume change at the same time.
-        rho, mu = probe.sld(self.material)
-        f = self.fraction.value*self.profile(z)
-        return f, rho*f, mu*f
+        rho, irho = self.material.sld(probe)
+        f = self.volume(z)
+        return f, rho*f, irho*f
+
+    def volume(self, z):
+        """
+        Volume fraction of the part at each *z*.
+        """
+        return self.fraction.value*self.profile(z)
 
 
 class Gaussian(object):
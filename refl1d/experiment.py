@@ -13,12 +13,16 @@ from math import pi, log10, floor
 import os
 import traceback
 import json
+import hashlib
+from collections import OrderedDict
 
 import numpy
 from bumps import parameter
 
 from .reflectivity import reflectivity_amplitude as reflamp
+from .reflectivity import reflectivity_amplitude_gradient as reflamp_gradient
 from .reflectivity import magnetic_amplitude as reflmag
+from .reflectivity import TransferMatrixCache
 #print("Using pure python reflectivity calculator")
 #from .abeles import refl as reflamp
 from . import material, profile
@@ -78,7 +82,8 @@ class ExperimentBase(object):
         when an existing chemical formula is modified; new and
         deleted formulas will be handled automatically.
         """
-        self._probe_cache.reset()
+        self._probe_cache.clear()
+        self._cache = {}
         self.update()
 
     def is_reset(self):
@@ -175,10 +180,12 @@ class ExperimentBase(object):
     def resynth_data(self):
         """Resynthesize data with noise from the uncertainty estimates."""
         self.probe.resynth_data()
+        self._cache.pop('residuals', None)
 
     def restore_data(self):
         """Restore original data after resynthesis."""
         self.probe.restore_data()
+        self._cache.pop('residuals', None)
 
     def write_data(self, filename, **kw):
         """Save simulated data to a file"""
@@ -195,6 +202,7 @@ class ExperimentBase(object):
         """
         theory = self.reflectivity(resolution=True)
         self.probe.simulate_data(theory, noise=noise)
+        self._cache.pop('residuals', None)
 
     def _set_name(self, name):
         self._name = name
@@ -276,6 +284,80 @@ class ExperimentBase(object):
 
 
 
+# Cache stages for Experiment.update, in order of calculation.  Keys not
+# listed belong to the final 'beam' stage.
+_CACHE_STAGE_ORDER = ('render', 'amplitude', 'resolution', 'beam')
+_CACHE_STAGES = {
+    'rendered': 'render',
+    'smooth_profile': 'render',
+    'step_profile': 'render',
+    'magnetic_smooth_profile': 'render',
+    'magnetic_step_profile': 'render',
+    'calc_r': 'amplitude',
+    'convolved': 'resolution',
+    }
+def _cache_stage(key):
+    name = key[0] if isinstance(key, tuple) else key
+    return _CACHE_STAGES.get(name, 'beam')
+
+
+class SlabCache(object):
+    """
+    Reflectivity amplitudes for recently seen slab models.
+
+    Many parameter changes leave the rendered slabs unchanged, such as a
+    move within a clipped range or a change to a magnetic parameter of a
+    nonmagnetic layer, and samplers with stuck chains revisit the same
+    model.  The amplitude is stored under a hash of the slab arrays, the
+    calculation points and the other inputs to the kernel, and the least
+    recently used entry is dropped once there are more than *size*.
+
+    The counters *hits* and *misses* record how often the kernel call was
+    skipped or needed.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the stored amplitudes and clear the counters.
+        """
+        self._store = OrderedDict()
+        self.hits = self.misses = 0
+
+    def key(self, *args):
+        """
+        Hash of the arrays and scalars in *args*.
+        """
+        digest = hashlib.sha1()
+        for v in args:
+            v = numpy.ascontiguousarray(v)
+            digest.update(str((v.dtype.str, v.shape)).encode('ascii'))
+            digest.update(v.tobytes())
+        return digest.digest()
+
+    def get(self, key):
+        """
+        Return the amplitude stored for *key*, or None.
+        """
+        value = self._store.pop(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._store[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Store the amplitude *value* for *key*.
+        """
+        self._store[key] = value
+        while len(self._store) > self.size:
+            self._store.popitem(last=False)
+
+
 class Experiment(ExperimentBase):
     """
     Theory calculator.  Associates sample with data, Sample plus data.
@@ -324,12 +406,34 @@ class Experiment(ExperimentBase):
 
     *interpolation* indicates the number of points to plot in between
     existing points.
+
+    If *transfer_cache* is True, keep the partial products of the transfer
+    matrices between evaluations so that a change to one layer only
+    recomputes the part of the stack it affects.  This speeds up finite
+    difference derivatives, such as those used by Levenberg-Marquardt, at
+    the cost of memory.  It does not apply to magnetic samples.
+    See :class:`refl1d.reflectivity.TransferMatrixCache` for details.
+
+    If *slab_cache* is True, keep the amplitudes of recent slab models so
+    that a parameter change which leaves the rendered slabs unchanged does
+    not call the kernel.  An integer sets the number of models kept.
+    The cache is available as *experiment.slab_cache*; see
+    :class:`SlabCache` for the hit and miss counters.
+
+    *precision* is 'double' for full accuracy.  Exploratory fits, such as
+    the early stages of a DREAM run, can use 'single' to build the profile,
+    compute the reflectivity and apply the resolution in single precision,
+    or 'mixed' to compute only the reflectivity in single precision.  These
+    are accurate to about 1e-5, though this depends on the model; use
+    :meth:`check_precision` to see how large the error is for your model.
+    Magnetic reflectivity is always computed in double precision.
     """
     profile_shift = 0
     def __init__(self, sample=None, probe=None, name=None,
                  roughness_limit=0, dz=None, dA=None,
                  step_interfaces=None, smoothness=None,
-                 interpolation=0):
+                 interpolation=0, transfer_cache=False, precision='double',
+                 slab_cache=False):
         # Note: smoothness ignored
         self.sample = sample
         self._substrate = self.sample[0].material
@@ -343,12 +447,60 @@ class Experiment(ExperimentBase):
         self.dA = dA
         self.step_interfaces = step_interfaces
         self.interpolation = interpolation
-        num_slabs = len(probe.unique_L) if probe.unique_L is not None else 1
-        self._slabs = profile.Microslabs(num_slabs, dz=dz)
         self._probe_cache = material.ProbeCache(probe)
+        L = getattr(probe, 'sld_L', probe.unique_L)
+        num_slabs = len(L) if L is not None else 1
+        self._slabs = profile.Microslabs(num_slabs, dz=dz)
         self._cache = {}  # Cache calculated profiles/reflectivities
+        self._transfer_cache = TransferMatrixCache() if transfer_cache else None
+        if slab_cache:
+            self.slab_cache = (SlabCache() if slab_cache is True
+                               else SlabCache(size=slab_cache))
+        else:
+            self.slab_cache = None
+        self.precision = precision
         self._name = name
 
+    def _set_precision(self, precision):
+        if precision not in ('double', 'single', 'mixed'):
+            raise ValueError("precision should be 'double', 'single' or 'mixed'")
+        if precision != getattr(self, '_precision', None):
+            self._precision = precision
+            # The profile and everything computed from it depend on the
+            # precision; the slab buffers are recast on the next render.
+            self._cache = {}
+
+    def _get_precision(self):
+        return self._precision
+    precision = property(_get_precision, _set_precision)
+
+    def check_precision(self, precision='single'):
+        """
+        Compare the theory computed with *precision* to double precision.
+
+        Returns the maximum relative deviation of :meth:`reflectivity`
+        over the Q points of the probe, and the Q at which it occurs.
+        """
+        saved = self.precision
+        try:
+            self.precision = 'double'
+            target = self.reflectivity()
+            self.precision = precision
+            theory = self.reflectivity()
+        finally:
+            self.precision = saved
+        if self.probe.polarized:
+            target, theory = [[xs for xs in v if xs is not None]
+                              for v in (target, theory)]
+        else:
+            target, theory = [target], [theory]
+        Q = numpy.hstack([Q for Q, _ in target])
+        R = numpy.hstack([R for _, R in target])
+        err = abs(numpy.hstack([R for _, R in theory]) - R)
+        err /= numpy.maximum(abs(R), numpy.finfo('d').tiny)
+        k = numpy.argmax(err)
+        return err[k], Q[k]
+
     @property
     def ismagnetic(self):
         """True if experiment contains magnetic materials"""
@@ -362,13 +514,90 @@ class Experiment(ExperimentBase):
             'probe':self.probe.parameters(),
             }
 
+    def update(self):
+        """
+        Called when any parameter in the model is changed.
+
+        This signals that the entire model needs to be recalculated.  Use
+        :meth:`update_values` instead when only the values of the existing
+        parameters have changed.
+        """
+        self._cache = {}
+        self._stage_cache_values = None
+
+    def update_values(self):
+        """
+        Called when only the values of the model parameters have changed.
+
+        The cached calculations are kept in stages: the rendered profile,
+        the reflectivity amplitude, the reflectivity after resolution, and
+        the reflectivity after intensity and background.  Each stage
+        depends on the values of a group of parameters together with those
+        of the stages before it.  Only the stages whose parameters have
+        changed since the last update are dropped, so for example a change
+        to the background does not recompute the profile or the amplitude.
+
+        The values are compared with those at the previous call, so the
+        first call after :meth:`update` drops everything.  Changes which are
+        not parameter values, such as replacing a layer or material, or
+        setting a material attribute, are not detected; call :meth:`update`
+        after those.
+        """
+        values = self._stage_values()
+        previous = getattr(self, '_stage_cache_values', None)
+        stale = set(stage for stage in _CACHE_STAGE_ORDER
+                    if previous is None or values[stage] != previous[stage])
+        self._stage_cache_values = values
+        if len(stale) == len(_CACHE_STAGE_ORDER):
+            self._cache = {}
+        elif stale:
+            self._cache = dict((key, value)
+                               for key, value in self._cache.items()
+                               if _cache_stage(key) not in stale)
+
+    def _stage_values(self):
+        """
+        Values each cached stage depends on; see :meth:`update`.
+
+        Intensity and background only affect the final scaling and back
+        absorption only affects resolution.  All other probe parameters,
+        such as theta_offset, change the amplitude.  The probe version
+        tracks changes to the Q grid.  Values include those of the earlier
+        stages, so a change in one stage invalidates all later stages.
+        """
+        probe = self.probe
+        if probe.polarized:
+            parts = [xs for xs in probe.xs if xs is not None]
+        else:
+            parts = getattr(probe, 'probes', [probe])
+        scale = set(id(p) for part in parts
+                    for p in (part.intensity, part.background))
+        absorption = set(id(part.back_absorption) for part in parts)
+
+        render = [self._precision, self.step_interfaces, self.dA]
+        render.extend(p.value
+                      for p in parameter.flatten(self.sample.parameters()))
+        amplitude = [getattr(probe, 'version', None)]
+        resolution, beam = [], []
+        for p in parameter.flatten(probe.parameters()):
+            group = (beam if id(p) in scale
+                     else resolution if id(p) in absorption
+                     else amplitude)
+            group.append(p.value)
+        values, total = {}, ()
+        for stage, group in zip(_CACHE_STAGE_ORDER,
+                                (render, amplitude, resolution, beam)):
+            total += tuple(group)
+            values[stage] = total
+        return values
+
     def _render_slabs(self):
         """
         Build a slab description of the model from the individual layers.
         """
         key = 'rendered'
         if key not in self._cache:
-            self._slabs.clear()
+            self._slabs.clear(dtype='f' if self._precision == 'single' else 'd')
             self.sample.render(self._probe_cache, self._slabs)
             self._slabs.finalize(step_interfaces=self.step_interfaces,
                                  dA=self.dA)
@@ -382,42 +611,175 @@ class Experiment(ExperimentBase):
         key = 'calc_r'
         if key not in self._cache:
             slabs = self._render_slabs()
-            w = slabs.w
-            rho, irho = slabs.rho, slabs.irho
-            sigma = slabs.sigma
-            #sigma = slabs.sigma
+            if (getattr(self.probe, 'adaptive', None) is not None
+                    and self.probe.refine_calc_Q(self._theory_at,
+                                                 slabs.thickness())):
+                # The new points change the probe version, which would
+                # otherwise drop the amplitude on the next update.
+                if getattr(self, '_stage_cache_values', None) is not None:
+                    self._stage_cache_values = self._stage_values()
             calc_q = self.probe.calc_Q
             #print("calc Q", self.probe.calc_Q)
-            if slabs.ismagnetic:
-                rhoM, thetaM = slabs.rhoM, slabs.thetaM
-                Aguide = self.probe.Aguide.value
-                H = self.probe.H.value
-                calc_r = reflmag(-calc_q/2, depth=w, rho=rho[0], irho=irho[0],
-                                 rhoM=rhoM, thetaM=thetaM, Aguide=Aguide, H=H,
-                                 sigma=sigma)
+            if self.slab_cache is None:
+                calc_r = self._reflamp_kernel(slabs, calc_q)
             else:
-                calc_r = reflamp(-calc_q/2, depth=w, rho=rho, irho=irho,
-                                 sigma=sigma)
-            if False and numpy.isnan(calc_r).any():
-                print("w", w)
-                print("rho", rho)
-                print("irho", irho)
+                inputs = [calc_q, slabs.w, slabs.rho, slabs.irho, slabs.sigma,
+                          self._precision]
+                if getattr(self.probe, 'rho_index', None) is not None:
+                    inputs.append(self.probe.rho_index)
                 if slabs.ismagnetic:
-                    print("rhoM", rhoM)
-                    print("thetaM", thetaM)
-                    print("Aguide", Aguide, "H", H)
-                print("sigma", sigma)
-                print("kz", self.probe.calc_Q/2)
-                print("R", abs(numpy.asarray(calc_r)**2))
-                pars = parameter.unique(self.parameters())
-                fitted = parameter.varying(pars)
-                print(parameter.summarize(fitted))
-                print("===")
+                    inputs += [slabs.rhoM, slabs.thetaM,
+                               self.probe.Aguide.value, self.probe.H.value]
+                slab_key = self.slab_cache.key(*inputs)
+                calc_r = self.slab_cache.get(slab_key)
+                if calc_r is None:
+                    calc_r = self._reflamp_kernel(slabs, calc_q)
+                    self.slab_cache.put(slab_key, calc_r)
             self._cache[key] = calc_q, calc_r
             #if numpy.isnan(calc_q).any(): print("calc_Q contains NaN")
             #if numpy.isnan(calc_r).any(): print("calc_r contains NaN")
         return self._cache[key]
 
+    def _reflamp_kernel(self, slabs, calc_q):
+        """
+        Reflectivity amplitude of the rendered *slabs* at *calc_q*.
+        """
+        w = slabs.w
+        rho, irho = slabs.rho, slabs.irho
+        sigma = slabs.sigma
+        rho_index = getattr(self.probe, 'rho_index', None)
+        if rho_index is not None and not slabs.ismagnetic:
+            rho, irho = self.probe.interp_sld(rho), self.probe.interp_sld(irho)
+        if slabs.ismagnetic:
+            rhoM, thetaM = slabs.rhoM, slabs.thetaM
+            Aguide = self.probe.Aguide.value
+            H = self.probe.H.value
+            calc_r = reflmag(-calc_q/2, depth=w, rho=rho[0], irho=irho[0],
+                             rhoM=rhoM, thetaM=thetaM, Aguide=Aguide, H=H,
+                             sigma=sigma)
+        elif self._precision != 'double':
+            calc_r = reflamp(-calc_q/2, depth=w, rho=rho, irho=irho,
+                             sigma=sigma, rho_index=rho_index,
+                             precision='single')
+            if self._precision == 'mixed':
+                # Resolution and background in double precision
+                calc_r = calc_r.astype('D')
+        elif self._transfer_cache is not None:
+            calc_r = self._transfer_cache.amplitude(
+                -calc_q/2, depth=w, rho=rho, irho=irho, sigma=sigma,
+                rho_index=rho_index)
+        else:
+            calc_r = reflamp(-calc_q/2, depth=w, rho=rho, irho=irho,
+                             sigma=sigma, rho_index=rho_index)
+        if False and numpy.isnan(calc_r).any():
+            print("w", w)
+            print("rho", rho)
+            print("irho", irho)
+            if slabs.ismagnetic:
+                print("rhoM", rhoM)
+                print("thetaM", thetaM)
+                print("Aguide", Aguide, "H", H)
+            print("sigma", sigma)
+            print("kz", self.probe.calc_Q/2)
+            print("R", abs(numpy.asarray(calc_r)**2))
+            pars = parameter.unique(self.parameters())
+            fitted = parameter.varying(pars)
+            print(parameter.summarize(fitted))
+            print("===")
+        return calc_r
+
+    def _theory_at(self, Q):
+        """
+        Reflectivity of the current model at *Q* without resolution, for
+        choosing the calculation points.
+        """
+        # Adaptive sampling is only available on unpolarized probes, so
+        # the sample is not magnetic.
+        slabs = self._render_slabs()
+        r = reflamp(-Q/2, depth=slabs.w, rho=slabs.rho, irho=slabs.irho,
+                    sigma=slabs.sigma)
+        return abs(r)**2
+
+    def jacobian(self, parameters=None, step=1e-6):
+        """
+        Return the derivative of the theory with respect to the parameters.
+
+        *parameters* defaults to the fitted parameters of the experiment.
+        The result is an array *J* with *J[i, k]* the derivative of
+        *reflectivity()[1][i]* with respect to *parameters[k]*.
+
+        For nonmagnetic samples the derivatives of the reflectivity with
+        respect to the rendered slabs are computed analytically from the
+        transfer matrices, and carried through the resolution with the chain
+        rule, so the reflectivity kernel is called once however many
+        parameters there are.  The slabs are differentiated by central
+        differences, which only re-renders the profile and is exact for
+        parameters such as slab thickness, roughness and scattering length
+        density that enter the slabs linearly.  The difference step is
+        *step* times the parameter value, or *step* for values below one.
+        Parameters which do not change the slabs, such as probe intensity
+        and background, parameters which change the number of slabs, and
+        all parameters of magnetic samples use central differences of the
+        full theory.  Parameters are restored on return.
+        """
+        if parameters is None:
+            parameters = parameter.varying(parameter.unique(self.parameters()))
+        saved = [p.value for p in parameters]
+
+        def slabs_at(p, v):
+            p.value = v
+            self.update_values()
+            slabs = self._render_slabs()
+            return [numpy.array(x) for x in
+                    (slabs.w, slabs.sigma, slabs.rho[0], slabs.irho[0])]
+
+        def theory_at(p, v):
+            p.value = v
+            self.update_values()
+            return numpy.array(self.reflectivity()[1])
+
+        try:
+            self.update()
+            theory = self.reflectivity()[1]
+            J = numpy.empty((len(theory), len(parameters)))
+            analytic = (not self.ismagnetic and not self.probe.polarized
+                        and self.probe.rho_index is None)
+            if analytic:
+                slabs = self._render_slabs()
+                base = [numpy.array(x) for x in
+                        (slabs.w, slabs.sigma, slabs.rho[0], slabs.irho[0])]
+                calc_q = self.probe.calc_Q
+                # rho[0] is used for all kz in _reflamp, so differentiate
+                # with respect to the first profile only.
+                r, dw, dsigma, drho, dirho = reflamp_gradient(
+                    -calc_q/2, depth=slabs.w, rho=slabs.rho, irho=slabs.irho,
+                    sigma=slabs.sigma)
+                # R = |r|^2 so dR = 2 Re(conj(r) dr)
+                dR_dslabs = [2*(r.conj()[:, None]*dr).real
+                             for dr in (dw, dsigma, drho, dirho)]
+                # apply_beam is affine in R, so remove the background
+                offset = self.probe.apply_beam(calc_q, numpy.zeros_like(calc_q))[1]
+            for k, (p, v) in enumerate(zip(parameters, saved)):
+                h = step*max(abs(v), 1.)
+                if analytic:
+                    plus, minus = slabs_at(p, v+h), slabs_at(p, v-h)
+                    same_shape = all(a.shape == b.shape == c.shape
+                                     for a, b, c in zip(plus, minus, base))
+                    if same_shape:
+                        dslabs = [(a - b)/(2*h) for a, b in zip(plus, minus)]
+                        if any(d.any() for d in dslabs):
+                            dR = sum(numpy.dot(A, d)
+                                     for A, d in zip(dR_dslabs, dslabs))
+                            J[:, k] = self.probe.apply_beam(calc_q, dR)[1] - offset
+                            continue
+                J[:, k] = (theory_at(p, v+h) - theory_at(p, v-h))/(2*h)
+                p.value = v
+        finally:
+            for p, v in zip(parameters, saved):
+                p.value = v
+            self.update_values()
+        return J
+
     def amplitude(self, resolution=False):
         """
         Calculate reflectivity amplitude at the probe points.
@@ -439,13 +801,16 @@ class Experiment(ExperimentBase):
         """
         key = ('reflectivity', resolution, interpolation)
         if key not in self._cache:
-            Q, r = self._reflamp()
-            R = _amplitude_to_magnitude(r,
-                                        ismagnetic=self.ismagnetic,
-                                        polarized=self.probe.polarized)
-            res = self.probe.apply_beam(Q, R, resolution=resolution,
-                                        interpolation=interpolation)
-            self._cache[key] = res
+            stage = ('convolved', resolution, interpolation)
+            if stage not in self._cache:
+                Q, r = self._reflamp()
+                R = _amplitude_to_magnitude(r,
+                                            ismagnetic=self.ismagnetic,
+                                            polarized=self.probe.polarized)
+                self._cache[stage] = self.probe.apply_beam(
+                    Q, R, resolution=resolution, interpolation=interpolation,
+                    scale=False)
+            self._cache[key] = self.probe.scale_beam(self._cache[stage])
         return self._cache[key]
 
     def smooth_profile(self, dz=0.1):
@@ -734,6 +1099,7 @@ class MixedExperiment(ExperimentBase):
     def penalty(self):
         return sum(s.penalty() for s in self.samples)
 
+
 def _polarized_nonmagnetic(r):
     """Convert nonmagnetic data to polarized representation.
 
@@ -8,6 +8,9 @@ the two.
 
 __all__ = ["data_view", "model_view", "new_model", "calc_errors", "show_errors"]
 
+import os
+import sys
+
 import numpy
 
 from . import names as refl
@@ -32,9 +35,33 @@ def load_model(filename):
         from .stajconvert import load_mlayer
         return refl.FitProblem(load_mlayer(filename))
         #fit_all(problem.fitness, pmp=20)
+    elif filename.endswith('.py') and os.environ.get('REFL1D_MODEL_CACHE'):
+        args = _model_args(filename)
+        if args is None:
+            return None
+        from .snapshot import load_problem
+        options = [v for v in args if not v.startswith('-')]
+        return load_problem(filename, options=options, argv=args)
     else:
         return None
 
+def _model_args(filename):
+    """
+    Command line arguments following *filename*, or None if the model
+    is not on the command line.
+
+    The plugin is not given the model options, so take the positional
+    arguments after the model file as bumps does.  The options for bumps
+    cannot be told apart from options for the model, so the snapshot is
+    keyed on all of the arguments.
+    """
+    # bumps changes to the model directory and passes the bare file name
+    base = os.path.basename(filename)
+    for k, v in enumerate(sys.argv[1:]):
+        if os.path.basename(v) == base:
+            return sys.argv[k+2:]
+    return None
+
 def new_model():
     stack = refl.silicon(0, 10) | refl.air
     instrument = refl.NCNR.NG1()
@@ -1,6 +1,10 @@
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 #include <Python.h>
 #include <numpy/arrayobject.h>
+#include <stdlib.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 
 PyObject *Pcalc_g_zs(PyObject *self, PyObject *args)
@@ -180,6 +184,163 @@ PyObject *Pcalc_g_zs_pointers(PyObject *self, PyObject *args)
     Py_RETURN_NONE;
 }
 
+// Forward mode derivative of _calc_g_zs for Jacobian-vector products.
+// w = dg_z/g_z, dc_i is the derivative of c_i and dg_zs[:, 0] must be
+// filled in by the caller.
+PyObject *Pcalc_dg_zs(PyObject *self, PyObject *args)
+{
+    PyArrayObject *g_z_pao, *w_pao, *dc_i_pao, *g_zs_pao, *dg_zs_pao;
+    double lambda_0, lambda_1, cval;
+    double *g_z, *w, *dc_i, *g_zs, *dg_zs;
+    Py_ssize_t segments, layers, r, z, i;
+
+    if (!PyArg_ParseTuple(args, "O!O!O!O!O!ddnn",
+                            &PyArray_Type,&g_z_pao,
+                            &PyArray_Type,&w_pao,
+                            &PyArray_Type,&dc_i_pao,
+                            &PyArray_Type,&g_zs_pao,
+                            &PyArray_Type,&dg_zs_pao,
+                            &lambda_0,
+                            &lambda_1,
+                            &layers,
+                            &segments))
+    {return NULL;}
+
+    g_z=(double *) PyArray_DATA(g_z_pao);
+    w=(double *) PyArray_DATA(w_pao);
+    dc_i=(double *) PyArray_DATA(dc_i_pao);
+    g_zs=(double *) PyArray_DATA(g_zs_pao);
+    dg_zs=(double *) PyArray_DATA(dg_zs_pao);
+
+    Py_BEGIN_ALLOW_THREADS
+    for (r=1; r<segments; ++r) {
+        cval = dc_i[segments-r-1];
+        i = layers*(r-1);
+
+        dg_zs[i+layers] = w[0] * g_zs[i+layers] + g_z[0] * (
+            dg_zs[i] * lambda_0
+            + dg_zs[1+i] * lambda_1
+            + cval
+        );
+
+        for (z=1; z<(layers-1); ++z) {
+            dg_zs[z+i+layers] = w[z] * g_zs[z+i+layers] + g_z[z] * (
+                dg_zs[z+i-1] * lambda_1
+                + dg_zs[z+i] * lambda_0
+                + dg_zs[z+i+1] * lambda_1
+                + cval
+            );
+        }
+
+        dg_zs[z+i+layers] = w[z] * g_zs[z+i+layers] + g_z[z] * (
+            dg_zs[z+i] * lambda_0
+            + dg_zs[z+i-1] * lambda_1
+            + cval
+        );
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_RETURN_NONE;
+}
+
+
+// Same loop as Pcalc_g_zs, for one chain of a batch; c_i is NULL for
+// uniform and terminally attached chains
+static void calc_g_zs_chain(const double *g_z, const double *c_i,
+                            double *g_zs, double lambda_0, double lambda_1,
+                            Py_ssize_t layers, Py_ssize_t segments)
+{
+    double cval;
+    double *g_zs_next = g_zs + layers;
+    Py_ssize_t r, z, i;
+
+    for (r=1; r<segments; ++r) {
+        cval = c_i != NULL ? c_i[segments-r-1] : 0.0;
+        i = layers*(r-1);
+
+        *g_zs_next++ = g_z[0] * (
+            g_zs[i] * lambda_0
+            + g_zs[1+i] * lambda_1
+            + cval
+        );
+
+        for (z=1; z<(layers-1); ++z) {
+            *g_zs_next++ = g_z[z] * (
+                g_zs[z+i-1] * lambda_1
+                + g_zs[z+i] * lambda_0
+                + g_zs[z+i+1] * lambda_1
+                + cval
+            );
+        }
+
+        *g_zs_next++ = g_z[z] * (
+            g_zs[z+i] * lambda_0
+            + g_zs[z+i-1] * lambda_1
+            + cval
+        );
+    }
+}
+
+// Propagators for a batch of independent chains, with g_zs holding a
+// contiguous (segments x layers) block for each, with the first segment
+// filled in.  Chain k uses g_z and c_i offset by k*g_z_stride and
+// k*c_i_stride, so a stride of 0 shares one row between all chains, and
+// c_i is None for uniform and terminally attached chains.  The chains are split across threads; threads <= 0
+// uses OMP_NUM_THREADS if it is set, or a single thread otherwise.
+PyObject *Pcalc_g_zs_batch(PyObject *self, PyObject *args)
+{
+    PyArrayObject *g_z_pao, *g_zs_pao;
+    PyObject *c_i_obj;
+    double lambda_0, lambda_1;
+    double *g_z, *c_i, *g_zs;
+    Py_ssize_t segments, layers, batch, g_z_stride, c_i_stride;
+    int threads, k;
+
+    if (!PyArg_ParseTuple(args, "O!OO!ddnnnnni",
+                            &PyArray_Type,&g_z_pao,
+                            &c_i_obj,
+                            &PyArray_Type,&g_zs_pao,
+                            &lambda_0,
+                            &lambda_1,
+                            &layers,
+                            &segments,
+                            &batch,
+                            &g_z_stride,
+                            &c_i_stride,
+                            &threads))
+    {return NULL;}
+
+    if (c_i_obj == Py_None) {
+        c_i = NULL;
+        c_i_stride = 0;
+    } else if (PyArray_Check(c_i_obj)) {
+        c_i = (double *) PyArray_DATA((PyArrayObject *)c_i_obj);
+    } else {
+        PyErr_SetString(PyExc_TypeError, "c_i must be an array or None");
+        return NULL;
+    }
+    g_z=(double *) PyArray_DATA(g_z_pao);
+    g_zs=(double *) PyArray_DATA(g_zs_pao);
+
+    Py_BEGIN_ALLOW_THREADS
+    #ifdef _OPENMP
+    if (threads <= 0) {
+        const char *env = getenv("OMP_NUM_THREADS");
+        threads = (env != NULL && *env != '\0') ? omp_get_max_threads() : 1;
+    }
+    #pragma omp parallel for num_threads(threads) schedule(dynamic)
+    #endif
+    for (k=0; k<(int)batch; ++k) {
+        calc_g_zs_chain(g_z + k*g_z_stride,
+                        c_i != NULL ? c_i + k*c_i_stride : NULL,
+                        g_zs + k*layers*segments,
+                        lambda_0, lambda_1, layers, segments);
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_RETURN_NONE;
+}
+
 
 static PyMethodDef calc_g_zs_cex_methods[] =
 {
@@ -192,6 +353,12 @@ static PyMethodDef calc_g_zs_cex_methods[] =
     {"_calc_g_zs_pointers", Pcalc_g_zs_pointers, METH_VARARGS, 
     "_calc_g_zs_pointers(g_z,c_i,g_zs,lambda_0,lambda_1,layers,segments): calculate G(z,s) using pointer tricks"
     },
+    {"_calc_g_zs_batch", Pcalc_g_zs_batch, METH_VARARGS,
+    "_calc_g_zs_batch(g_z,c_i,g_zs,lambda_0,lambda_1,layers,segments,batch,g_z_stride,c_i_stride,threads): calculate G(z,s) for a batch of chains"
+    },
+    {"_calc_dg_zs", Pcalc_dg_zs, METH_VARARGS,
+    "_calc_dg_zs(g_z,w,dc_i,g_zs,dg_zs,lambda_0,lambda_1,layers,segments): derivative of G(z,s) along a direction"
+    },
     {NULL, NULL, 0, NULL}
 };
 
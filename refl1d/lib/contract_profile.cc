@@ -8,6 +8,7 @@
 #include <cmath>
 #include <iostream>
 #include <algorithm>
+#include <vector>
 
 #define GREEDY
 #include <cassert>
@@ -222,6 +223,88 @@ contract_by_area(int n, double d[], double sigma[],
   return newi;
 }
 
+/* Contract a profile with nwl wavelength dependent rho/irho values.
+ *
+ * rho and irho are nwl x n arrays stored row by row, with one row per
+ * wavelength.  Slices are merged using the same area criterion as
+ * contract_by_area, applied to the worst case over all wavelengths, so
+ * that each contracted layer is within dA of the original profile for
+ * every wavelength.  With nwl=1 this is identical to contract_by_area.
+ * The rows are contracted in place, with row k occupying rho[k*n] to
+ * rho[k*n+newn-1] on return.
+ */
+extern "C"
+int
+contract_by_area_multi(int n, int nwl, double d[], double sigma[],
+                       double rho[], double irho[], double dA)
+{
+  double dz;
+  int i, k, newi;
+  /* lo/hi/area for rho then irho in each wavelength */
+  std::vector<double> work(6*nwl);
+  double *rholo = &work[0], *rhohi = rholo+nwl, *rhoarea = rhohi+nwl;
+  double *irholo = rhoarea+nwl, *irhohi = irholo+nwl, *irhoarea = irhohi+nwl;
+
+  i=newi=1; /* Skip the substrate */
+  while (i < n) {
+
+    /* Get ready for the next layer */
+    /* Accumulation of the first row happens in the inner loop */
+    dz = 0.;
+    for (k=0; k < nwl; k++) {
+      rhoarea[k] = irhoarea[k] = 0.;
+      rholo[k] = rhohi[k] = rho[k*n+i];
+      irholo[k] = irhohi[k] = irho[k*n+i];
+    }
+
+    /* Accumulate slices into layer */
+    for (;;) {
+      int fits = 1;
+      assert(i < n);
+      /* Accumulate next slice */
+      dz += d[i];
+      for (k=0; k < nwl; k++) {
+        rhoarea[k] += d[i]*rho[k*n+i];
+        irhoarea[k] += d[i]*irho[k*n+i];
+      }
+
+      /* If no more slices or sigma != 0, break immediately */
+      if (++i == n || sigma[i-1] != 0.) break;
+
+      /* If next slice won't fit at any wavelength, break */
+      for (k=0; k < nwl && fits; k++) {
+        const double r = rho[k*n+i], ir = irho[k*n+i];
+        if (r < rholo[k]) rholo[k] = r;
+        if (r > rhohi[k]) rhohi[k] = r;
+        if ((rhohi[k]-rholo[k])*(dz+d[i]) > dA) fits = 0;
+        if (ir < irholo[k]) irholo[k] = ir;
+        if (ir > irhohi[k]) irhohi[k] = ir;
+        if ((irhohi[k]-irholo[k])*(dz+d[i]) > dA) fits = 0;
+      }
+      if (!fits) break;
+    }
+
+    /* Save the layer */
+    assert(newi < n);
+    d[newi] = dz;
+    for (k=0; k < nwl; k++) {
+      if (i == n) {
+        /* Last layer uses surface values */
+        rho[k*n+newi] = rho[k*n+n-1];
+        irho[k*n+newi] = irho[k*n+n-1];
+      } else {
+        /* Middle layers uses average values */
+        rho[k*n+newi] = rhoarea[k] / dz;
+        irho[k*n+newi] = irhoarea[k] / dz;
+      }
+    } /* First layer uses substrate values */
+    if (i < n) sigma[newi] = sigma[i-1];
+    newi++;
+  }
+
+  return newi;
+}
+
 extern "C"
 int
 contract_mag(int n, double d[], double sigma[],
@@ -16,6 +16,11 @@
 #include <ieeefp.h>
 #endif
 
+#ifdef _OPENMP
+/* Thread count shared with the reflectivity kernels; see reflectivity.cc */
+int get_num_threads(void);
+#endif
+
 /* What to do at the endpoints --- USE_TRUNCATED_NORMALIZATION will
  * avoid the assumption that the data is zero where it hasn't been
  * measured.
@@ -206,7 +211,8 @@ void
 convolve(size_t Nin, const double xin[], const double yin[],
          size_t Nout, const double x[], const double dx[], double y[])
 {
-  size_t in,out;
+  size_t in;
+  long out; /* OpenMP 2.0 needs a signed loop index */
 
   /* FIXME fails if xin are not sorted; slow if x not sorted */
   assert(Nin>1);
@@ -227,9 +233,9 @@ convolve(size_t Nin, const double xin[], const double yin[],
    */
   in = 0;
   #ifdef _OPENMP
-  #pragma omp parallel for firstprivate(in) schedule(static,1)
+  #pragma omp parallel for firstprivate(in) schedule(static,1) num_threads(get_num_threads())
   #endif
-  for (out=0; out < Nout; out++) {
+  for (out=0; out < (long)Nout; out++) {
     /* width of resolution window for x is w = 2 dx^2. */
     const double sigma = dx[out];
     const double xo = x[out];
@@ -266,3 +272,80 @@ convolve(size_t Nin, const double xin[], const double yin[],
   }
 
 }
+
+/* MSVC 2008 doesn't define the float versions either */
+#if defined(_MSC_VER) && _MSC_VER<=1600
+  #define erff(x) ((float)erf(x))
+  #define expf(x) ((float)exp(x))
+#endif
+
+/* Single precision version of convolve_point for exploratory fits.
+ * Differences of erf lose about three digits in float when the theory
+ * is densely sampled, so expect relative errors around 1e-5. */
+static float
+convolve_point_single(const float xin[], const float yin[], size_t k, size_t n,
+                      float xo, float limit, float sigma)
+{
+  const float two_sigma_sq = 2.f * sigma * sigma;
+  float z, Glo, erflo, erfmin, y;
+
+  z = xo - xin[k];
+  Glo = expf(-z*z/two_sigma_sq);
+  erfmin = erflo = erff(-z/((float)SQRT2*sigma));
+  y = 0.f;
+  while (++k < n) if (xin[k] != xin[k-1]) {
+    const float zhi = xo - xin[k];
+    const float Ghi = expf(-zhi*zhi/two_sigma_sq);
+    const float erfhi = erff(-zhi/((float)SQRT2*sigma));
+    const float m = (yin[k]-yin[k-1])/(xin[k]-xin[k-1]);
+    const float b = yin[k] - m * xin[k];
+
+    y += 0.5f*(m*xo+b)*(erfhi-erflo) - sigma/(float)SQRT2PI*m*(Ghi-Glo);
+    Glo = Ghi;
+    erflo = erfhi;
+    if (xin[k] >= xo+limit) break;
+  }
+
+#ifdef USE_TRUNCATED_NORMALIZATION
+  return 2.f * y / (erflo - erfmin);
+#else
+  return y;
+#endif
+}
+
+void
+convolve_single(size_t Nin, const float xin[], const float yin[],
+                size_t Nout, const float x[], const float dx[], float y[])
+{
+  size_t in;
+  long out; /* OpenMP 2.0 needs a signed loop index */
+
+  /* See convolve() for details. */
+  assert(Nin>1);
+  in = 0;
+  #ifdef _OPENMP
+  #pragma omp parallel for firstprivate(in) schedule(static,1) num_threads(get_num_threads())
+  #endif
+  for (out=0; out < (long)Nout; out++) {
+    const float sigma = dx[out];
+    const float xo = x[out];
+    const float limit = sqrtf(-2.f*sigma*sigma*(float)LOG_RESLIMIT);
+
+    while (in < Nin-1 && xin[in] < xo-limit) in++;
+    while (in > 0 && xin[in] > xo-limit) in--;
+
+    if (sigma > 0.f) {
+      y[out] = convolve_point_single(xin,yin,in,Nin,xo,limit,sigma);
+    } else if (in < Nin-1) {
+      float m = (yin[in+1]-yin[in])/(xin[in+1]-xin[in]);
+      float b = yin[in] - m*xin[in];
+      y[out] = m*xo + b;
+    } else if (in > 0) {
+      float m = (yin[in]-yin[in-1])/(xin[in]-xin[in-1]);
+      float b = yin[in] - m*xin[in];
+      y[out] = m*xo + b;
+    } else {
+      assert(Nin>1);
+    }
+  }
+}
@@ -9,6 +9,11 @@
 #include <ieeefp.h>
 #endif
 
+#ifdef _OPENMP
+/* Thread count shared with the reflectivity kernels; see reflectivity.cc */
+int get_num_threads(void);
+#endif
+
 /* Convolution of two linear splines. */
 double convolve_point_sampled(
     size_t Nin, const double xin[], const double yin[],
@@ -103,7 +108,8 @@ convolve_sampled(size_t Nin, const double xin[], const double yin[],
          size_t Np, const double xp[], const double yp[],
          size_t N, const double x[], const double dx[], double y[])
 {
-  size_t in,out;
+  size_t in;
+  long out; /* OpenMP 2.0 needs a signed loop index */
 
   /* FIXME fails if xin are not sorted; slow if x not sorted */
   assert(Nin>1);
@@ -124,9 +130,9 @@ convolve_sampled(size_t Nin, const double xin[], const double yin[],
    */
   in = 0;
   #ifdef _OPENMP
-  #pragma omp parallel for firstprivate(in) schedule(static,1)
+  #pragma omp parallel for firstprivate(in) schedule(static,1) num_threads(get_num_threads())
   #endif
-  for (out=0; out < N; out++) {
+  for (out=0; out < (long)N; out++) {
     /* width of resolution window for x is w = 2 dx^2. */
     const double limit = -dx[out]*xp[0];
     const double xo = x[out];
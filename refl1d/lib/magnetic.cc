@@ -436,12 +436,11 @@ magnetic_amplitude(const int layers,
                       const int points, const double KZ[], const int rho_index[],
                       Cplx Ra[], Cplx Rb[], Cplx Rc[], Cplx Rd[])
 {
-  Cplx dummy1,dummy2;
   int ip;
   if (fabs(rhoM[0]) <= MINIMAL_RHO_M && fabs(rhoM[layers-1]) <= MINIMAL_RHO_M) {
     ip = 1; // calculations for I+ and I- are the same in the fronting and backing.
     #ifdef _OPENMP
-    #pragma omp parallel for
+    #pragma omp parallel for num_threads(get_num_threads())
     #endif
     for (int i=0; i < points; i++) {
       const int offset = layers*(rho_index != NULL?rho_index[i]:0);
@@ -451,18 +450,21 @@ magnetic_amplitude(const int layers,
   } else {
     ip = 1; // plus polarization
     #ifdef _OPENMP
-    #pragma omp parallel for
+    #pragma omp parallel for num_threads(get_num_threads())
     #endif
     for (int i=0; i < points; i++) {
+      // dummy outputs are per-thread so workers don't race on them
+      Cplx dummy1,dummy2;
       const int offset = layers*(rho_index != NULL?rho_index[i]:0);
       Cr4xa(layers,d,sigma,ip,rho+offset,irho+offset,rhoM,u1,u3,
             Aguide,KZ[i],Ra[i],Rb[i],dummy1,dummy2);
     }
     ip = -1; // minus polarization
     #ifdef _OPENMP
-    #pragma omp parallel for
+    #pragma omp parallel for num_threads(get_num_threads())
     #endif
     for (int i=0; i < points; i++) {
+      Cplx dummy1,dummy2;
       const int offset = layers*(rho_index != NULL?rho_index[i]:0);
       Cr4xa(layers,d,sigma,ip,rho+offset,irho+offset,rhoM,u1,u3,
             Aguide,KZ[i],dummy1,dummy2,Rc[i],Rd[i]);
@@ -377,7 +377,7 @@ magnetic_amplitude(const int layers,
   if (rhoM[0] == 0.0 && rhoM[layers-1] == 0.0) {
     ip = 1; // calculations for I+ and I- are the same in the fronting and backing.
     #ifdef _OPENMP
-    #pragma omp parallel for
+    #pragma omp parallel for num_threads(get_num_threads())
     #endif
     for (int i=0; i < points; i++) {
       const int offset = layers*(rho_index != NULL?rho_index[i]:0);
@@ -387,7 +387,7 @@ magnetic_amplitude(const int layers,
   } else {
     ip = 1; // plus polarization
     #ifdef _OPENMP
-    #pragma omp parallel for
+    #pragma omp parallel for num_threads(get_num_threads())
     #endif
     for (int i=0; i < points; i++) {
       const int offset = layers*(rho_index != NULL?rho_index[i]:0);
@@ -396,7 +396,7 @@ magnetic_amplitude(const int layers,
     }
     ip = -1; // minus polarization
     #ifdef _OPENMP
-    #pragma omp parallel for
+    #pragma omp parallel for num_threads(get_num_threads())
     #endif
     for (int i=0; i < points; i++) {
       const int offset = layers*(rho_index != NULL?rho_index[i]:0);
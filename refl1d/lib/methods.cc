@@ -100,8 +100,10 @@ PyObject* Pmagnetic_amplitude(PyObject*obj,PyObject*args)
 #endif
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS
   magnetic_amplitude((int)nd, d, sigma, rho, irho, rhom, u1, u3,
                      Aguide, (int)nkz, kz, rho_index, r1, r2, r3, r4);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("");
 }
 
@@ -153,10 +155,328 @@ PyObject* Preflectivity_amplitude(PyObject*obj,PyObject*args)
 #endif
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS
   reflectivity_amplitude((int)nd, d, sigma, rho, irho, (int)nkz, kz, rho_index, r);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("");
 }
 
+PyObject* Preflectivity_amplitude_single(PyObject*obj,PyObject*args)
+{
+  PyObject *kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj,*rho_index_obj;
+  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, nrho_index;
+  const float *kz, *d, *sigma, *rho, *irho;
+  const int *rho_index;
+  int nprofiles;
+  CplxSingle *r;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOO:reflectivity_single",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,
+      &kz_obj,&rho_index_obj, &r_obj))
+    return NULL;
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  INVECTOR(kz_obj,kz,nkz);
+  INVECTOR(rho_index_obj, rho_index, nrho_index);
+  OUTVECTOR(r_obj,r,nr);
+
+  // Determine how many profiles we have
+  nprofiles = 1;
+  for (int i=0; i < nrho_index; i++)
+    if (rho_index[i] > nprofiles-1) nprofiles = rho_index[i]+1;
+
+  // interfaces should be one shorter than layers
+  if (nrho%nd != 0 || nirho%nd != 0 || nd != nsigma+1) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  if (nrho < nd*nprofiles || nirho < nd*nprofiles) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "rho_index too high");
+#endif
+    return NULL;
+  }
+  if (nkz != nr || nrho_index != nkz) {
+    //printf("%ld %ld %ld\n",
+    //    long(nkz), long(nrho_index), long(nr));
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "kz,rho_index,r have different lengths");
+#endif
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  reflectivity_amplitude_single((int)nd, d, sigma, rho, irho, (int)nkz, kz, rho_index, r);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
+PyObject* Preflectivity_amplitude_batch(PyObject*obj,PyObject*args)
+{
+  PyObject *kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj,*rho_index_obj;
+  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, nrho_index;
+  const double *kz, *d, *sigma, *rho, *irho;
+  const int *rho_index;
+  int nprofiles, npop, nlayers;
+  Cplx *r;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOO:reflectivity_batch",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,
+      &kz_obj,&rho_index_obj, &r_obj))
+    return NULL;
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  INVECTOR(kz_obj,kz,nkz);
+  INVECTOR(rho_index_obj, rho_index, nrho_index);
+  OUTVECTOR(r_obj,r,nr);
+
+  if (nkz == 0 || nkz != nrho_index || nr%nkz != 0) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "kz,rho_index,r have different lengths");
+#endif
+    return NULL;
+  }
+
+  // Population size comes from the output; layers from the population size
+  npop = (int)(nr/nkz);
+  if (npop == 0 || nd == 0 || nd%npop != 0 || nsigma != nd - npop) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,sigma,r have inconsistent population sizes");
+#endif
+    return NULL;
+  }
+  nlayers = (int)(nd/npop);
+
+  // Determine how many profiles we have
+  nprofiles = 1;
+  for (int i=0; i < nrho_index; i++)
+    if (rho_index[i] > nprofiles-1) nprofiles = rho_index[i]+1;
+
+  if (nrho%nd != 0 || nirho != nrho) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho have different lengths");
+#endif
+    return NULL;
+  }
+  if (nrho < nd*nprofiles) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "rho_index too high");
+#endif
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  reflectivity_amplitude_batch(npop, nlayers, (int)(nrho/nd),
+                               d, sigma, rho, irho,
+                               (int)nkz, kz, rho_index, r);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
+PyObject* Preflectivity_amplitude_partials(PyObject*obj,PyObject*args)
+{
+  PyObject *kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj,*rho_index_obj;
+  PyObject *prefix_obj,*suffix_obj;
+  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, nrho_index, nprefix, nsuffix;
+  const double *kz, *d, *sigma, *rho, *irho;
+  const int *rho_index;
+  Cplx *r, *prefix, *suffix;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOOOO:reflectivity_partials",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,
+      &kz_obj,&rho_index_obj,&prefix_obj,&suffix_obj,&r_obj))
+    return NULL;
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  INVECTOR(kz_obj,kz,nkz);
+  INVECTOR(rho_index_obj, rho_index, nrho_index);
+  OUTVECTOR(prefix_obj,prefix,nprefix);
+  OUTVECTOR(suffix_obj,suffix,nsuffix);
+  OUTVECTOR(r_obj,r,nr);
+
+  if (nd == 0 || nrho%nd != 0 || nirho != nrho || nd != nsigma+1) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  if (nkz != nr || nrho_index != nkz) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "kz,rho_index,r have different lengths");
+#endif
+    return NULL;
+  }
+  for (Py_ssize_t i=0; i < nrho_index; i++) {
+    if (rho_index[i] < 0 || rho_index[i] >= nrho/nd) {
+#ifndef BROKEN_EXCEPTIONS
+      PyErr_SetString(PyExc_ValueError, "rho_index too high");
+#endif
+      return NULL;
+    }
+  }
+  if (nprefix != 4*nd*nkz || nsuffix != nprefix) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "prefix,suffix should have 4*len(d)*len(kz) entries");
+#endif
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  reflectivity_amplitude_partials((int)nd, d, sigma, rho, irho,
+                                  (int)nkz, kz, rho_index, prefix, suffix, r);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
+PyObject* Preflectivity_amplitude_update(PyObject*obj,PyObject*args)
+{
+  PyObject *kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj,*rho_index_obj;
+  PyObject *prefix_obj,*suffix_obj;
+  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, nrho_index, nprefix, nsuffix;
+  const double *kz, *d, *sigma, *rho, *irho;
+  const int *rho_index;
+  const Cplx *prefix, *suffix;
+  Cplx *r;
+  int lo, hi;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOOOiiO:reflectivity_update",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,
+      &kz_obj,&rho_index_obj,&prefix_obj,&suffix_obj,&lo,&hi,&r_obj))
+    return NULL;
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  INVECTOR(kz_obj,kz,nkz);
+  INVECTOR(rho_index_obj, rho_index, nrho_index);
+  INVECTOR(prefix_obj,prefix,nprefix);
+  INVECTOR(suffix_obj,suffix,nsuffix);
+  OUTVECTOR(r_obj,r,nr);
+
+  if (nd == 0 || nrho%nd != 0 || nirho != nrho || nd != nsigma+1) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  if (nkz != nr || nrho_index != nkz) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "kz,rho_index,r have different lengths");
+#endif
+    return NULL;
+  }
+  for (Py_ssize_t i=0; i < nrho_index; i++) {
+    if (rho_index[i] < 0 || rho_index[i] >= nrho/nd) {
+#ifndef BROKEN_EXCEPTIONS
+      PyErr_SetString(PyExc_ValueError, "rho_index too high");
+#endif
+      return NULL;
+    }
+  }
+  if (nprefix != 4*nd*nkz || nsuffix != nprefix) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "prefix,suffix should have 4*len(d)*len(kz) entries");
+#endif
+    return NULL;
+  }
+  if (lo < 0 || hi > nd || lo >= hi) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "changed layers lo:hi out of range");
+#endif
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  reflectivity_amplitude_update((int)nd, d, sigma, rho, irho,
+                                (int)nkz, kz, rho_index, prefix, suffix,
+                                lo, hi, r);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
+PyObject* Preflectivity_amplitude_gradient(PyObject*obj,PyObject*args)
+{
+  PyObject *kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj,*rho_index_obj;
+  PyObject *dd_obj,*ds_obj,*drho_obj,*dirho_obj;
+  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, nrho_index;
+  Py_ssize_t ndd, nds, ndrho, ndirho;
+  const double *kz, *d, *sigma, *rho, *irho;
+  const int *rho_index;
+  Cplx *r, *dd, *ds, *drho, *dirho;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOOOOOO:reflectivity_gradient",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,
+      &kz_obj,&rho_index_obj,&r_obj,&dd_obj,&ds_obj,&drho_obj,&dirho_obj))
+    return NULL;
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  INVECTOR(kz_obj,kz,nkz);
+  INVECTOR(rho_index_obj, rho_index, nrho_index);
+  OUTVECTOR(r_obj,r,nr);
+  OUTVECTOR(dd_obj,dd,ndd);
+  OUTVECTOR(ds_obj,ds,nds);
+  OUTVECTOR(drho_obj,drho,ndrho);
+  OUTVECTOR(dirho_obj,dirho,ndirho);
+
+  if (nd == 0 || nrho%nd != 0 || nirho != nrho || nd != nsigma+1) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  if (nkz != nr || nrho_index != nkz) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "kz,rho_index,r have different lengths");
+#endif
+    return NULL;
+  }
+  for (Py_ssize_t i=0; i < nrho_index; i++) {
+    if (rho_index[i] < 0 || rho_index[i] >= nrho/nd) {
+#ifndef BROKEN_EXCEPTIONS
+      PyErr_SetString(PyExc_ValueError, "rho_index too high");
+#endif
+      return NULL;
+    }
+  }
+  if (ndd != nd*nkz || ndrho != ndd || ndirho != ndd || nds != nsigma*nkz) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "gradients should be len(kz) x len(d) or len(kz) x len(sigma)");
+#endif
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  reflectivity_amplitude_gradient((int)nd, d, sigma, rho, irho,
+                                  (int)nkz, kz, rho_index,
+                                  r, dd, ds, drho, dirho);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
+PyObject* Pset_num_threads(PyObject*obj,PyObject*args)
+{
+  int n;
+
+  if (!PyArg_ParseTuple(args, "i:set_num_threads", &n)) return NULL;
+  if (n < 1) {
+    PyErr_SetString(PyExc_ValueError, "number of threads must be positive");
+    return NULL;
+  }
+  set_num_threads(n);
+  return Py_BuildValue("");
+}
+
+PyObject* Pget_num_threads(PyObject*obj,PyObject*args)
+{
+  if (!PyArg_ParseTuple(args, ":get_num_threads")) return NULL;
+  return Py_BuildValue("i",get_num_threads());
+}
+
 PyObject* Palign_magnetic(PyObject *obj, PyObject *args)
 {
   PyObject *d_obj,*rho_obj,*irho_obj,*sigma_obj;
@@ -229,6 +549,32 @@ PyObject* Pcontract_by_area(PyObject*obj,PyObject*args)
   return Py_BuildValue("i",newlen);
 }
 
+PyObject* Pcontract_by_area_multi(PyObject*obj,PyObject*args)
+{
+  PyObject *d_obj,*rho_obj,*irho_obj,*sigma_obj;
+  Py_ssize_t nd, nrho, nirho, nsigma;
+  double *d, *sigma, *rho, *irho;
+  double dA;
+
+  if (!PyArg_ParseTuple(args, "OOOOd:contract_by_area_multi",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,&dA))
+    return NULL;
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  // rho,irho hold one row of len(d) values for each wavelength
+  if (nd == 0 || nrho != nirho || nrho % nd != 0 || nd != nsigma+1) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  int newlen = contract_by_area_multi((int)nd, (int)(nrho/nd),
+                                      d, sigma, rho, irho, dA);
+  return Py_BuildValue("i",newlen);
+}
+
 PyObject* Pcontract_mag(PyObject*obj,PyObject*args)
 {
   PyObject *d_obj,*rho_obj,*irho_obj,*rhoM_obj,*thetaM_obj,*sigma_obj;
@@ -313,6 +659,36 @@ PyObject* Pconvolve(PyObject *obj, PyObject *args)
   return Py_BuildValue("");
 }
 
+PyObject* Pconvolve_single(PyObject *obj, PyObject *args)
+{
+  PyObject *xi_obj,*yi_obj,*x_obj,*dx_obj,*y_obj;
+  const float *xi, *yi, *x, *dx;
+  float *y;
+  Py_ssize_t nxi, nyi, nx, ndx, ny;
+
+  if (!PyArg_ParseTuple(args, "OOOOO:convolve_single",
+			&xi_obj,&yi_obj,&x_obj,&dx_obj,&y_obj)) return NULL;
+  INVECTOR(xi_obj,xi,nxi);
+  INVECTOR(yi_obj,yi,nyi);
+  INVECTOR(x_obj,x,nx);
+  INVECTOR(dx_obj,dx,ndx);
+  OUTVECTOR(y_obj,y,ny);
+  if (nxi != nyi) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "convolve_single: xi and yi have different lengths");
+#endif
+    return NULL;
+  }
+  if (nx != ndx || nx != ny) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "convolve_single: x, dx and y have different lengths");
+#endif
+    return NULL;
+  }
+  convolve_single(nxi,xi,yi,nx,x,dx,y);
+  return Py_BuildValue("");
+}
+
 PyObject* Pconvolve_sampled(PyObject *obj, PyObject *args)
 {
   PyObject *xi_obj,*yi_obj,*xp_obj,*yp_obj,*x_obj,*dx_obj,*y_obj;
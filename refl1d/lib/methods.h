@@ -22,11 +22,20 @@
 //PyObject* pyvector(int n, double v[]);
 
 PyObject* Preflectivity_amplitude(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_amplitude_single(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_amplitude_batch(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_amplitude_partials(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_amplitude_update(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_amplitude_gradient(PyObject*obj,PyObject*args);
+PyObject* Pset_num_threads(PyObject*obj,PyObject*args);
+PyObject* Pget_num_threads(PyObject*obj,PyObject*args);
 PyObject* Pmagnetic_amplitude(PyObject* obj, PyObject* args);
 PyObject* Pcalculate_u1_u3(PyObject* obj, PyObject* args);
 PyObject* Palign_magnetic(PyObject *obj, PyObject *args);
 PyObject* Pcontract_by_step(PyObject*obj,PyObject*args);
 PyObject* Pcontract_by_area(PyObject*obj,PyObject*args);
+PyObject* Pcontract_by_area_multi(PyObject*obj,PyObject*args);
 PyObject* Pcontract_mag(PyObject*obj,PyObject*args);
 PyObject* Pconvolve(PyObject*obj,PyObject*args);
+PyObject* Pconvolve_single(PyObject*obj,PyObject*args);
 PyObject* Pconvolve_sampled(PyObject*obj,PyObject*args);
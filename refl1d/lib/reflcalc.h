@@ -27,11 +27,20 @@ Reflectivity calculations on rectangular slabs.
    Functions:
    reflectivity(M,d,rho,mu,lambda,N,Q,R)
    reflectivity_amplitude(M,d,rho,mu,lambda,N,Q,r)
+   reflectivity_amplitude_single(M,d,sigma,rho,irho,N,kz,rho_index,r)
+   reflectivity_amplitude_batch(P,M,K,d,sigma,rho,irho,N,kz,rho_index,r)
+   reflectivity_amplitude_partials(M,d,sigma,rho,irho,N,kz,rho_index,prefix,suffix,r)
+   reflectivity_amplitude_update(M,d,sigma,rho,irho,N,kz,rho_index,prefix,suffix,lo,hi,r)
+   reflectivity_amplitude_gradient(M,d,sigma,rho,irho,N,kz,rho_index,r,dd,dsigma,drho,dirho)
    reflectivity_real(M,d,rho,mu,lambda,N,Q,real_r)
    reflectivity_imag(M,d,rho,mu,lambda,N,Q,real_r)
    magnetic_reflectivity(M,d,rho,mu,lambda,P,exptheta,Aguide,N,Q,R)
    magnetic_amplitude(M,d,rho,mu,lambda,P,exptheta,Aguide,N,Q,r)
 
+   The amplitude calculations and resolution convolutions split the Q
+   points across threads when compiled with OpenMP.  They run in one thread unless OMP_NUM_THREADS
+   is set or the count is changed with set_num_threads(n).
+
 
 Fresnel reflectivity from a single interface.
 
@@ -104,9 +113,11 @@ Q of a given step size in order to reach 0.001 on a gaussian of width dQ
 # include <complex>
 # include <cmath>
   typedef std::complex<double> Cplx;
+  typedef std::complex<float> CplxSingle;
 #else
 # include <math.h>
   typedef double Cplx;
+  typedef float CplxSingle;
 #endif
 
  // Inclusion from C
@@ -123,6 +134,49 @@ reflectivity_amplitude(const int layers,
                        const double kz[], const int rho_offset[],
                        Cplx r[]);
 
+void
+reflectivity_amplitude_single(const int layers,
+                              const float d[], const float sigma[],
+                              const float rho[], const float irho[],
+                              const int points,
+                              const float kz[], const int rho_offset[],
+                              CplxSingle r[]);
+
+void
+reflectivity_amplitude_batch(const int population, const int layers,
+                             const int profiles,
+                             const double d[], const double sigma[],
+                             const double rho[], const double irho[],
+                             const int points,
+                             const double kz[], const int rho_offset[],
+                             Cplx r[]);
+
+void
+reflectivity_amplitude_partials(const int layers,
+                                const double d[], const double sigma[],
+                                const double rho[], const double irho[],
+                                const int points,
+                                const double kz[], const int rho_offset[],
+                                Cplx prefix[], Cplx suffix[], Cplx r[]);
+
+void
+reflectivity_amplitude_update(const int layers,
+                              const double d[], const double sigma[],
+                              const double rho[], const double irho[],
+                              const int points,
+                              const double kz[], const int rho_offset[],
+                              const Cplx prefix[], const Cplx suffix[],
+                              const int lo, const int hi, Cplx r[]);
+
+void
+reflectivity_amplitude_gradient(const int layers,
+                                const double d[], const double sigma[],
+                                const double rho[], const double irho[],
+                                const int points,
+                                const double kz[], const int rho_offset[],
+                                Cplx r[], Cplx dr_dd[], Cplx dr_dsigma[],
+                                Cplx dr_drho[], Cplx dr_dirho[]);
+
 void
 magnetic_amplitude(const int layers,
                    const double d[], const double sigma[],
@@ -133,6 +187,12 @@ magnetic_amplitude(const int layers,
                    const double kz[], const int rho_offset[],
                    Cplx Ra[], Cplx Rb[], Cplx Rc[], Cplx Rd[]);
 
+void
+set_num_threads(const int n);
+
+int
+get_num_threads(void);
+
 void
 calculate_U1_U3(const double H,
                 double &rhoM,
@@ -153,6 +213,10 @@ int
 contract_by_area(int n, double d[], double sigma[],
                  double rho[], double irho[], double dA);
 
+int
+contract_by_area_multi(int n, int nwl, double d[], double sigma[],
+                       double rho[], double irho[], double dA);
+
 int
 contract_mag(int n, double d[], double sigma[], double rho[], double irho[],
              double rhoM[], double thetaM[], double dA);
@@ -161,6 +225,10 @@ void
 convolve(size_t Nin, const double xin[], const double yin[],
          size_t N, const double x[], const double dx[], double y[]);
 
+void
+convolve_single(size_t Nin, const float xin[], const float yin[],
+                size_t N, const float x[], const float dx[], float y[]);
+
 void
 convolve_sampled(size_t Nin, const double xin[], const double yin[],
          size_t Np, const double xp[], const double yp[],
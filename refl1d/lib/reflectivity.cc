@@ -5,23 +5,57 @@
  */
 #include <iostream>
 #include <complex>
+#include <vector>
+#include <cstdlib>
 #include "reflcalc.h"
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// The single precision complex exp and sqrt in the C++ library are slower
+// than the double precision versions, so build them from real functions.
+static inline std::complex<double> exp_(const std::complex<double> z)
+{
+  return exp(z);
+}
+static inline std::complex<float> exp_(const std::complex<float> z)
+{
+  const float m = expf(z.real());
+  return std::complex<float>(m*cosf(z.imag()), m*sinf(z.imag()));
+}
+static inline std::complex<double> sqrt_(const std::complex<double> z)
+{
+  return sqrt(z);
+}
+static inline std::complex<float> sqrt_(const std::complex<float> z)
+{
+  const float x = z.real(), y = z.imag();
+  if (x == 0.f && y == 0.f) return std::complex<float>(0.f, y);
+  const float t = sqrtf(0.5f*(fabsf(x) + hypotf(x, y)));
+  if (x >= 0.f) return std::complex<float>(t, 0.5f*y/t);
+  return std::complex<float>(0.5f*fabsf(y)/t, copysignf(t, y));
+}
 
 // Abeles matrix reflectivity calculation
+// This is instantiated for double and for float; the single precision
+// version is used for exploratory fits where speed matters more than
+// accuracy.
+template <typename T>
 static void
 refl(const int layers,
-     const double kz,
-     const double depth[],
-     const double sigma[],
-     const double rho[],
-     const double irho[],
-     Cplx& R)
+     const T kz,
+     const T depth[],
+     const T sigma[],
+     const T rho[],
+     const T irho[],
+     std::complex<T>& R)
 {
+  typedef std::complex<T> Cplx;
   const Cplx J(0,1);
 
   // Check that Q is not too close to zero.
   // For negative Q, reverse the layers.
-  const double cutoff = 1e-10;
+  const T cutoff = 1e-10;
   int next,step;
   if (kz >= cutoff) {
     next=0;
@@ -31,15 +65,15 @@ refl(const int layers,
     step=-1;
     sigma -= 1;
   } else {
-    R = -1.;
+    R = -1;
     return;
   }
 
   // Since sqrt(1/4 * x) = sqrt(x)/2, I'm going to pull the 1/2 into the
   // sqrt to save a multiplication later.
-  const double pi4=12.566370614359172e-6;        // 1e-6 * 4 pi
-  const double kz_sq = kz*kz + pi4*rho[next];    // kz^2 + 4 pi Vrho
-  Cplx k(fabs(kz));
+  const T pi4=12.566370614359172e-6;             // 1e-6 * 4 pi
+  const T kz_sq = kz*kz + pi4*rho[next];         // kz^2 + 4 pi Vrho
+  Cplx k(std::abs(kz));
 
   Cplx B11, B12, B21, B22;
   B11 = B22 = 1;
@@ -51,10 +85,10 @@ refl(const int layers,
     // The loop index is not the layer number because we may be reversing
     // the stack.  Instead, n is set to the incident layer (which may be
     // first or last) and incremented or decremented each time through.
-    const Cplx k_next = sqrt(kz_sq - pi4*Cplx(rho[next+step],irho[next+step]));
-    const Cplx F = (k-k_next)/(k+k_next)*exp(-2.*k*k_next*sigma[next]*sigma[next]);
-    const Cplx M11 = (i>0 ? exp(J*k*depth[next]) : 1);
-    const Cplx M22 = (i>0 ? exp(-J*k*depth[next]) : 1);
+    const Cplx k_next = sqrt_(kz_sq - pi4*Cplx(rho[next+step],irho[next+step]));
+    const Cplx F = (k-k_next)/(k+k_next)*exp_(T(-2)*k*k_next*sigma[next]*sigma[next]);
+    const Cplx M11 = (i>0 ? exp_(J*k*depth[next]) : Cplx(1));
+    const Cplx M22 = (i>0 ? exp_(-J*k*depth[next]) : Cplx(1));
     const Cplx M21 = F*M11;
     const Cplx M12 = F*M22;
 
@@ -87,6 +121,34 @@ refl(const int layers,
 
 
 
+// Number of threads used to split the kz points in the amplitude loops.
+// This is kept globally rather than with omp_set_num_threads() since the
+// OpenMP setting only applies to the calling thread, and the calculation
+// may be started from any python thread.  Zero means single threaded
+// unless OMP_NUM_THREADS is set, in which case the OpenMP default is used;
+// fits are often run as one process per core, and threads would then
+// oversubscribe the machine.  Without OpenMP the calculation is always
+// single threaded.
+static int num_threads = 0;
+
+extern "C" void
+set_num_threads(const int n)
+{
+  num_threads = n;
+}
+
+extern "C" int
+get_num_threads(void)
+{
+  #ifdef _OPENMP
+  if (num_threads > 0) return num_threads;
+  const char *env = std::getenv("OMP_NUM_THREADS");
+  return (env != NULL && *env != '\0') ? omp_get_max_threads() : 1;
+  #else
+  return 1;
+  #endif
+}
+
 extern "C" void
 reflectivity_amplitude(const int    layers,
              const double depth[],
@@ -99,7 +161,28 @@ reflectivity_amplitude(const int    layers,
              Cplx r[])
 {
   #ifdef _OPENMP
-  #pragma omp parallel for
+  #pragma omp parallel for num_threads(get_num_threads())
+  #endif
+  for (int i=0; i < points; i++) {
+    const int offset = layers*(rho_index!=NULL ? rho_index[i] : 0);
+    refl(layers, kz[i], depth, sigma, rho+offset, irho+offset, r[i]);
+  }
+}
+
+// Single precision version of reflectivity_amplitude.
+extern "C" void
+reflectivity_amplitude_single(const int    layers,
+             const float depth[],
+             const float sigma[],
+             const float rho[],
+             const float irho[],
+             const int    points,
+             const float kz[],
+             const int    rho_index[],
+             CplxSingle r[])
+{
+  #ifdef _OPENMP
+  #pragma omp parallel for num_threads(get_num_threads())
   #endif
   for (int i=0; i < points; i++) {
     const int offset = layers*(rho_index!=NULL ? rho_index[i] : 0);
@@ -107,6 +190,375 @@ reflectivity_amplitude(const int    layers,
   }
 }
 
+// Evaluate a population of slab models against a shared set of kz values.
+// Model p uses depth[p*layers], sigma[p*(layers-1)], and rho, irho starting
+// at p*layers*profiles, returning its amplitude in r[p*points].
+extern "C" void
+reflectivity_amplitude_batch(const int    population,
+             const int    layers,
+             const int    profiles,
+             const double depth[],
+             const double sigma[],
+             const double rho[],
+             const double irho[],
+             const int    points,
+             const double kz[],
+             const int    rho_index[],
+             Cplx r[])
+{
+  const int total = population*points;
+  #ifdef _OPENMP
+  #pragma omp parallel for num_threads(get_num_threads())
+  #endif
+  for (int k=0; k < total; k++) {
+    const int p = k/points;
+    const int i = k%points;
+    const int offset = layers*(p*profiles + (rho_index!=NULL ? rho_index[i] : 0));
+    refl(layers, kz[i], depth+p*layers, sigma+p*(layers-1),
+         rho+offset, irho+offset, r[k]);
+  }
+}
+
+
+// Partial products of the Abeles matrices.
+//
+// The product computed by refl() can be written as X = Y_0 Y_1 ... Y_{F-1}
+// for F = layers-1 interfaces, where Y_f = [M11 M21; M12 M22] for the f-th
+// step through the stack.  Saving prefix[f] = Y_0 ... Y_{f-1} and
+// suffix[f] = Y_f ... Y_{F-1} for f = 0 ... F allows the amplitude to be
+// updated when only a few layers change by recomputing just the factors
+// which involve those layers.  Each kz has layers partial products in each
+// of prefix and suffix, with matrices stored as [x00 x01 x10 x11].
+
+// Y = A*B for 2x2 matrices
+static inline void
+mul2(const Cplx A[], const Cplx B[], Cplx Y[])
+{
+  const Cplx y00 = A[0]*B[0] + A[1]*B[2];
+  const Cplx y01 = A[0]*B[1] + A[1]*B[3];
+  const Cplx y10 = A[2]*B[0] + A[3]*B[2];
+  const Cplx y11 = A[2]*B[1] + A[3]*B[3];
+  Y[0] = y00; Y[1] = y01; Y[2] = y10; Y[3] = y11;
+}
+
+// Direction through the stack for kz; returns false if kz is too small.
+static inline bool
+refl_direction(const int layers, const double kz, int &first, int &step)
+{
+  const double cutoff = 1e-10;
+  if (kz >= cutoff) {
+    first = 0;
+    step = 1;
+  } else if (kz <= -cutoff) {
+    first = layers-1;
+    step = -1;
+  } else {
+    return false;
+  }
+  return true;
+}
+
+// Factor f in the product for the given kz, as computed in refl().
+// first and step are the direction through the stack from refl_direction().
+static void
+refl_factor(const int first, const int step, const double kz,
+            const double kz_sq, const int f,
+            const double depth[], const double sigma[],
+            const double rho[], const double irho[], Cplx Y[])
+{
+  const Cplx J(0,1);
+  const double pi4=12.566370614359172e-6;        // 1e-6 * 4 pi
+  const int n = first + f*step;
+  const double s = (step > 0 ? sigma[n] : sigma[n-1]);
+  const Cplx k = (f > 0 ? sqrt(kz_sq - pi4*Cplx(rho[n],irho[n])) : Cplx(fabs(kz)));
+  const Cplx k_next = sqrt(kz_sq - pi4*Cplx(rho[n+step],irho[n+step]));
+  const Cplx F = (k-k_next)/(k+k_next)*exp(-2.*k*k_next*s*s);
+  const Cplx M11 = (f>0 ? exp(J*k*depth[n]) : 1);
+  const Cplx M22 = (f>0 ? exp(-J*k*depth[n]) : 1);
+  Y[0] = M11;
+  Y[1] = F*M11;
+  Y[2] = F*M22;
+  Y[3] = M22;
+}
+
+static void
+refl_partials(const int layers, const double kz,
+              const double depth[], const double sigma[],
+              const double rho[], const double irho[],
+              Cplx prefix[], Cplx suffix[], Cplx& R)
+{
+  const double pi4=12.566370614359172e-6;        // 1e-6 * 4 pi
+  const int F = layers-1;
+  int first, step;
+  if (!refl_direction(layers, kz, first, step)) {
+    R = -1.;
+    return;
+  }
+  const double kz_sq = kz*kz + pi4*rho[first];
+
+  // Forward pass accumulates the prefix, keeping the factors in suffix.
+  Cplx *X = prefix;
+  X[0] = X[3] = 1.;
+  X[1] = X[2] = 0.;
+  for (int f=0; f < F; f++) {
+    refl_factor(first, step, kz, kz_sq, f, depth, sigma, rho, irho,
+                suffix+4*f);
+    mul2(prefix+4*f, suffix+4*f, prefix+4*(f+1));
+  }
+  // Backward pass turns the factors into suffix products.
+  X = suffix + 4*F;
+  X[0] = X[3] = 1.;
+  X[1] = X[2] = 0.;
+  for (int f=F-1; f >= 0; f--) {
+    mul2(suffix+4*f, suffix+4*(f+1), suffix+4*f);
+  }
+  X = prefix + 4*F;
+  R = X[2]/X[0];
+}
+
+static void
+refl_update(const int layers, const double kz,
+            const double depth[], const double sigma[],
+            const double rho[], const double irho[],
+            const Cplx prefix[], const Cplx suffix[],
+            const int lo, const int hi, Cplx& R)
+{
+  const double pi4=12.566370614359172e-6;        // 1e-6 * 4 pi
+  const int F = layers-1;
+  int first, step, flo, fhi;
+  if (!refl_direction(layers, kz, first, step)) {
+    R = -1.;
+    return;
+  }
+  const double kz_sq = kz*kz + pi4*rho[first];
+
+  // Layer n is used by the factors on either side of it, and interface n
+  // by the factor between layers n and n+1.  The incident medium is used
+  // by every factor.
+  if (first >= lo && first < hi) {
+    flo = 0;
+    fhi = F;
+  } else if (step > 0) {
+    flo = lo-1;
+    fhi = hi;
+  } else {
+    flo = F-hi;
+    fhi = F-lo+1;
+  }
+  if (flo < 0) flo = 0;
+  if (fhi > F) fhi = F;
+
+  Cplx X[4], Y[4];
+  for (int j=0; j < 4; j++) X[j] = prefix[4*flo+j];
+  for (int f=flo; f < fhi; f++) {
+    refl_factor(first, step, kz, kz_sq, f, depth, sigma, rho, irho, Y);
+    mul2(X, Y, X);
+  }
+  mul2(X, suffix+4*fhi, X);
+  R = X[2]/X[0];
+}
+
+// Compute the amplitude and save the partial products for each kz.
+// prefix and suffix each hold points*layers 2x2 matrices.
+extern "C" void
+reflectivity_amplitude_partials(const int    layers,
+             const double depth[],
+             const double sigma[],
+             const double rho[],
+             const double irho[],
+             const int    points,
+             const double kz[],
+             const int    rho_index[],
+             Cplx prefix[],
+             Cplx suffix[],
+             Cplx r[])
+{
+  #ifdef _OPENMP
+  #pragma omp parallel for num_threads(get_num_threads())
+  #endif
+  for (int i=0; i < points; i++) {
+    const int offset = layers*(rho_index!=NULL ? rho_index[i] : 0);
+    refl_partials(layers, kz[i], depth, sigma, rho+offset, irho+offset,
+                  prefix+4*layers*i, suffix+4*layers*i, r[i]);
+  }
+}
+
+// Compute the amplitude from saved partial products when only layers
+// lo through hi-1 and the interfaces following them have changed.
+extern "C" void
+reflectivity_amplitude_update(const int    layers,
+             const double depth[],
+             const double sigma[],
+             const double rho[],
+             const double irho[],
+             const int    points,
+             const double kz[],
+             const int    rho_index[],
+             const Cplx   prefix[],
+             const Cplx   suffix[],
+             const int    lo,
+             const int    hi,
+             Cplx r[])
+{
+  #ifdef _OPENMP
+  #pragma omp parallel for num_threads(get_num_threads())
+  #endif
+  for (int i=0; i < points; i++) {
+    const int offset = layers*(rho_index!=NULL ? rho_index[i] : 0);
+    refl_update(layers, kz[i], depth, sigma, rho+offset, irho+offset,
+                prefix+4*layers*i, suffix+4*layers*i, lo, hi, r[i]);
+  }
+}
+
+
+// Derivatives of the amplitude with respect to the slab parameters.
+//
+// With X = P_f Y_f S_{f+1} as above and r = X10/X00, the change in r
+// from a change in factor f is dr = w_f' dY_f u_{f+1} where w_f is the
+// row (P_f[1,:] - r P_f[0,:])/X00 and u_{f+1} is the first column of
+// S_{f+1}.  The prefix products are saved on the way into the stack and
+// the columns u are accumulated on the way out, so the derivatives with
+// respect to all parameters cost about three amplitude calculations.
+// Work holds 11*layers values.
+static void
+refl_gradient(const int layers, const double kz,
+              const double depth[], const double sigma[],
+              const double rho[], const double irho[], Cplx work[],
+              Cplx& R, Cplx dd[], Cplx ds[], Cplx drho[], Cplx dirho[])
+{
+  const Cplx J(0,1);
+  const double pi4=12.566370614359172e-6;        // 1e-6 * 4 pi
+  const int F = layers-1;
+  int first, step;
+
+  for (int n=0; n < layers; n++) dd[n] = drho[n] = dirho[n] = 0.;
+  for (int n=0; n < layers-1; n++) ds[n] = 0.;
+  if (!refl_direction(layers, kz, first, step)) {
+    R = -1.;
+    return;
+  }
+  const double kz_sq = kz*kz + pi4*rho[first];
+
+  Cplx *P = work;            // prefix products, F+1 matrices
+  Cplx *Y = P + 4*(F+1);     // factors, F matrices
+  Cplx *K = Y + 4*F;         // wave vector in each layer, F+1 values
+  Cplx *G = K + (F+1);       // Fresnel coefficient for each interface
+  Cplx *E = G + F;           // roughness factor for each interface
+
+  // Forward pass computes the factors and the prefix products.
+  P[0] = P[3] = 1.;
+  P[1] = P[2] = 0.;
+  K[0] = fabs(kz);
+  for (int f=0; f < F; f++) {
+    const int n = first + f*step;
+    const double s = (step > 0 ? sigma[n] : sigma[n-1]);
+    const Cplx k = K[f];
+    const Cplx k_next = sqrt(kz_sq - pi4*Cplx(rho[n+step],irho[n+step]));
+    const Cplx g = (k-k_next)/(k+k_next);
+    const Cplx e = exp(-2.*k*k_next*s*s);
+    const Cplx M11 = (f>0 ? exp(J*k*depth[n]) : 1);
+    const Cplx M22 = (f>0 ? exp(-J*k*depth[n]) : 1);
+    Cplx *Yf = Y+4*f;
+    Yf[0] = M11;
+    Yf[1] = g*e*M11;
+    Yf[2] = g*e*M22;
+    Yf[3] = M22;
+    mul2(P+4*f, Yf, P+4*(f+1));
+    K[f+1] = k_next;
+    G[f] = g;
+    E[f] = e;
+  }
+  const Cplx X00 = P[4*F];
+  R = P[4*F+2]/X00;
+
+  // Backward pass accumulates the derivatives.
+  Cplx u0 = 1., u1 = 0.;
+  for (int f=F-1; f >= 0; f--) {
+    const int n = first + f*step;
+    const int n_next = n + step;
+    const int sn = (step > 0 ? n : n-1);
+    const double s = sigma[sn];
+    const Cplx *Pf = P+4*f;
+    const Cplx *Yf = Y+4*f;
+    const Cplx w0 = (Pf[2] - R*Pf[0])/X00;
+    const Cplx w1 = (Pf[3] - R*Pf[1])/X00;
+    const Cplx k = K[f], k_next = K[f+1], g = G[f], e = E[f];
+    const Cplx Ff = g*e;
+    const Cplx M11 = Yf[0], M22 = Yf[3];
+    #define CONTRACT(a00,a01,a10,a11) \
+        (w0*((a00)*u0 + (a01)*u1) + w1*((a10)*u0 + (a11)*u1))
+
+    // Interface: Fresnel coefficient and roughness
+    const Cplx ksum_sq = (k+k_next)*(k+k_next);
+    const Cplx dF_dk = 2.*k_next/ksum_sq*e - 2.*g*k_next*s*s*e;
+    const Cplx dF_dknext = -2.*k/ksum_sq*e - 2.*g*k*s*s*e;
+    const Cplx dF_ds = -4.*g*k*k_next*s*e;
+    ds[sn] += CONTRACT(0., dF_ds*M11, dF_ds*M22, 0.);
+    const Cplx t_next = CONTRACT(0., dF_dknext*M11, dF_dknext*M22, 0.);
+    const Cplx b = t_next*pi4/(2.*k_next);
+    drho[n_next] -= b;
+    dirho[n_next] -= J*b;
+    drho[first] += b;
+
+    // Layer: phase, and the wave vector k in the layer.  The incident
+    // medium has no phase, and k = |kz| there.
+    if (f > 0) {
+      const Cplx dM11_dd = J*k*M11, dM22_dd = -J*k*M22;
+      dd[n] += CONTRACT(dM11_dd, Ff*dM11_dd, Ff*dM22_dd, dM22_dd);
+      const Cplx dM11_dk = J*depth[n]*M11, dM22_dk = -J*depth[n]*M22;
+      const Cplx t = CONTRACT(dM11_dk, dF_dk*M11 + Ff*dM11_dk,
+                              dF_dk*M22 + Ff*dM22_dk, dM22_dk);
+      const Cplx a = t*pi4/(2.*k);
+      drho[n] -= a;
+      dirho[n] -= J*a;
+      drho[first] += a;
+    }
+    #undef CONTRACT
+
+    // u_f = Y_f u_{f+1}
+    const Cplx v0 = Yf[0]*u0 + Yf[1]*u1;
+    const Cplx v1 = Yf[2]*u0 + Yf[3]*u1;
+    u0 = v0;
+    u1 = v1;
+  }
+}
+
+// Compute the amplitude and its derivatives with respect to the depth,
+// rho and irho of each layer (points*layers) and to the roughness of
+// each interface (points*(layers-1)).  Derivatives with respect to rho
+// and irho are for the profile selected by rho_index.
+extern "C" void
+reflectivity_amplitude_gradient(const int    layers,
+             const double depth[],
+             const double sigma[],
+             const double rho[],
+             const double irho[],
+             const int    points,
+             const double kz[],
+             const int    rho_index[],
+             Cplx r[],
+             Cplx dr_ddepth[],
+             Cplx dr_dsigma[],
+             Cplx dr_drho[],
+             Cplx dr_dirho[])
+{
+  #ifdef _OPENMP
+  #pragma omp parallel num_threads(get_num_threads())
+  #endif
+  {
+    std::vector<Cplx> work(11*layers);
+    #ifdef _OPENMP
+    #pragma omp for
+    #endif
+    for (int i=0; i < points; i++) {
+      const int offset = layers*(rho_index!=NULL ? rho_index[i] : 0);
+      refl_gradient(layers, kz[i], depth, sigma, rho+offset, irho+offset,
+                    &work[0], r[i], dr_ddepth+layers*i, dr_dsigma+(layers-1)*i,
+                    dr_drho+layers*i, dr_dirho+layers*i);
+    }
+  }
+}
+
 
 /*************************************************************************/
 // We need  a number of tests as follows:
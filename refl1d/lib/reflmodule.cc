@@ -81,6 +81,41 @@ static PyMethodDef methods[] = {
 	 METH_VARARGS,
 	 "_reflectivity_amplitude(d,sigma,rho,irho,Q,rho_offset,R): compute reflectivity putting it into vector R of len(Q)"},
 
+	{"_reflectivity_amplitude_single",
+	 Preflectivity_amplitude_single,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_single(d,sigma,rho,irho,Q,rho_offset,R): single precision version of _reflectivity_amplitude\nfor float32 inputs and complex64 R"},
+
+	{"_reflectivity_amplitude_batch",
+	 Preflectivity_amplitude_batch,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_batch(d,sigma,rho,irho,Q,rho_offset,R): compute reflectivity for a population of models\nwith shared Q, putting it into R of len(population)*len(Q)"},
+
+	{"_reflectivity_amplitude_partials",
+	 Preflectivity_amplitude_partials,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_partials(d,sigma,rho,irho,Q,rho_offset,prefix,suffix,R): compute reflectivity into R,\nsaving the partial products of the transfer matrices in prefix and suffix"},
+
+	{"_reflectivity_amplitude_update",
+	 Preflectivity_amplitude_update,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_update(d,sigma,rho,irho,Q,rho_offset,prefix,suffix,lo,hi,R): recompute reflectivity into R\nfrom saved partial products when only layers lo:hi have changed"},
+
+	{"_reflectivity_amplitude_gradient",
+	 Preflectivity_amplitude_gradient,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_gradient(d,sigma,rho,irho,Q,rho_offset,R,dd,dsigma,drho,dirho): compute reflectivity into R\nand its derivatives with respect to the slab parameters"},
+
+	{"_set_num_threads",
+	 Pset_num_threads,
+	 METH_VARARGS,
+	 "_set_num_threads(n): number of threads used to split the Q points in the amplitude calculations"},
+
+	{"_get_num_threads",
+	 Pget_num_threads,
+	 METH_VARARGS,
+	 "_get_num_threads(): number of threads used by the amplitude calculations (1 if compiled without OpenMP)"},
+
 	{"_magnetic_amplitude",
 	 Pmagnetic_amplitude,
 	 METH_VARARGS,
@@ -96,6 +131,11 @@ static PyMethodDef methods[] = {
 	 METH_VARARGS,
 	 "_contract_by_area(d,sigma,rho,irho,dA): join layers in microstep profile, keeping error under control"},
 
+	{"_contract_by_area_multi",
+	 Pcontract_by_area_multi,
+	 METH_VARARGS,
+	 "_contract_by_area_multi(d,sigma,rho,irho,dA): join layers in microstep profile with one rho,irho row per wavelength, keeping error under control at every wavelength"},
+
 	{"_contract_mag",
 	 Pcontract_mag,
 	 METH_VARARGS,
@@ -116,6 +156,11 @@ static PyMethodDef methods[] = {
 	 METH_VARARGS,
 	 "convolve(xi,yi,x,dx,y): compute convolution of width dx[k] at points x[k],\nreturned in y[k]"},
 
+	{"convolve_single",
+	 Pconvolve_single,
+	 METH_VARARGS,
+	 "convolve_single(xi,yi,x,dx,y): single precision version of convolve for float32 vectors"},
+
 	{"convolve_sampled",
 	 Pconvolve_sampled,
 	 METH_VARARGS,
@@ -35,12 +35,21 @@ make sense to store them with the probe.  The scattering factor lookup
 for the material is separate from the scattering length density
 calculation so that you only need to look up the material once per fit.
 
+Scattering factors are also kept in a process-wide cache (see
+:class:`ScatteringFactorCache`) keyed by composition and probe
+wavelengths, so experiments sharing materials, or models which rebuild
+their materials, only look them up once.
+
 The probe itself deals with all computations relating to the radiation
 type and energy.  Unlike the normally tabulated scattering factors f', f''
 for X-ray, there is no need to scale by probe by electron radius.  In
 the end, sld is just the returned scattering factors times density.
 """
-__all__ = ['Material', 'Mixture', 'SLD', 'Vacuum', 'Scatterer', 'ProbeCache']
+__all__ = ['Material', 'Mixture', 'SLD', 'Vacuum', 'Scatterer', 'ProbeCache',
+           'ScatteringFactorCache', 'scattering_factor_cache', 'mix_sld']
+from collections import OrderedDict
+import hashlib
+
 import numpy
 from numpy import inf, NaN
 import periodictable
@@ -354,7 +363,7 @@ class _MassFraction(object):
     def __call__(self, fraction):
         density = numpy.array([m.density.value for m in self._material])
         volume = fraction/density
-        return volume/sum(volume)
+        return volume/numpy.sum(volume, axis=-1, keepdims=True)
 
 class Mixture(Scatterer):
     """
@@ -462,31 +471,36 @@ class Mixture(Scatterer):
         """
         Return the scattering length density and absorption of the mixture.
         """
-        # Convert fractions into an array, with the final fraction
-        fraction = numpy.array([0.]+[f.value for f in self.fraction])
-        fraction[0] = 100 - sum(fraction)
+        if self.use_incoherent:
+            raise NotImplementedError("incoherent scattering not supported")
         # TODO: handle invalid fractions using penalty functions
         # S = sum(fraction)
         # scale = S/100 if S > 100 else 1
         # fraction[0] = 100 - S/scale
         # penalty = scale - 1
-        if (fraction < 0).any():
-            return NaN, NaN
-
-        # Lookup SLD
-        slds = [c.sld(probe) for c in [self.base] + self.material]
-        rho, irho = [numpy.asarray(v) for v in zip(*slds)]
+        return self.mix(probe, [f.value for f in self.fraction])
 
-        # Use calculator to convert individual SLDs to overall SLD
-        volume_fraction = self._volume(fraction)
-        rho = numpy.sum(rho*volume_fraction)
+    def mix(self, probe, fraction):
+        """
+        Return the scattering length density and absorption of the mixture
+        for each row of *fraction*.
+
+        *fraction* holds the percentages F2, F3, ... along its last axis,
+        so a single call can evaluate the mixture at every point of a
+        z grid or for every member of a population.  The component SLDs
+        are looked up once and mixed as array operations.  Rows in which
+        the implicit fraction F1 is negative are NaN.
+        """
+        fraction = numpy.asarray(fraction, 'd')
+        base = 100 - numpy.sum(fraction, axis=-1)
+        fraction = numpy.concatenate((base[..., None], fraction), axis=-1)
 
-        irho = numpy.sum(irho*volume_fraction)
-        if self.use_incoherent:
-            raise NotImplementedError("incoherent scattering not supported")
-        #print "Mixture", self.name, coh, absorp
+        # Use calculator to convert fractions to volume fractions
+        volume = self._volume(fraction)
+        volume[base < 0] = NaN
 
-        return rho, irho
+        slds = [c.sld(probe) for c in [self.base] + self.material]
+        return mix_sld(volume, slds)
 
     def __str__(self):
         return "<%s>"%(", ".join(str(M) for M in [self.base]+self.material))
@@ -494,6 +508,23 @@ class Mixture(Scatterer):
     def __repr__(self):
         return "Mixture(%s)"%(", ".join(repr(M) for M in [self.base]+self.material))
 
+def mix_sld(volume, slds):
+    """
+    Combine component SLDs in proportion to their volume fractions.
+
+    *volume* holds the volume fraction of each component along its last
+    axis.  *slds* is the list of (rho, irho) for the components, each of
+    which may be a scalar or a vector of values for the probe wavelengths.
+
+    Returns rho, irho with the shape of *volume* without its last axis,
+    followed by the wavelength axis if any.
+    """
+    values = numpy.broadcast_arrays(*[v for pair in slds for v in pair])
+    rho = numpy.array(values[0::2], 'd')
+    irho = numpy.array(values[1::2], 'd')
+    return (numpy.tensordot(volume, rho, axes=(-1, 0)),
+            numpy.tensordot(volume, irho, axes=(-1, 0)))
+
 # ============================ SLD cache =============================
 
 class ProbeCache(object):
@@ -503,7 +534,8 @@ class ProbeCache(object):
     A caching probe which only looks up scattering factors for materials
     which it hasn't seen before.   Note that caching is based on object
     id, and will fail if the material object is updated with a new atomic
-    structure.
+    structure.  Materials not seen before are retrieved from the shared
+    :data:`scattering_factor_cache`.
 
     *probe* is the probe to use when looking up the scattering length density.
 
@@ -519,6 +551,14 @@ class ProbeCache(object):
     def clear(self):
         self._cache = {}
 
+    def __getstate__(self):
+        # ids are not preserved when pickled, so start with an empty cache
+        return self._probe
+
+    def __setstate__(self, state):
+        self._probe = state
+        self._cache = {}
+
     def __delitem__(self, material):
         if material in self._cache:
             del self._cache[material]
@@ -531,6 +571,77 @@ class ProbeCache(object):
         h = id(material)
         if h not in self._cache:
             # lookup density of 1, and scale to actual density on retrieval
-            self._cache[h] = self._probe.scattering_factors(material,
-                                                            density=1.0)
+            self._cache[h] = scattering_factor_cache.lookup(self._probe,
+                                                            material)
         return [v*density for v in self._cache[h]]
+
+
+class ScatteringFactorCache(object):
+    """
+    Scattering factors shared by all probes in the process.
+
+    Entries are keyed by the atoms in the chemical formula, including
+    isotope substitutions, the type of the probe and a hash of the
+    wavelengths at which the factors are computed, so models which share
+    materials, or which rebuild equivalent materials, only look them up
+    once.  The factors are stored at density 1.  The least recently used
+    entry is dropped once there are more than *size*.
+
+    The counters *hits*, *misses* and *evictions* record how the cache
+    has been used.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the stored scattering factors and clear the counters.
+        """
+        self._store = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._store)
+
+    def key(self, probe, material):
+        """
+        Cache key for *material* looked up by *probe*, or None if the
+        material does not have a chemical formula.
+        """
+        atoms = getattr(material, 'atoms', None)
+        if atoms is None:
+            return None
+        # ProbeSet looks up scattering factors with its first probe
+        probes = getattr(probe, 'probes', None)
+        if probes:
+            probe = probes[0]
+        L = getattr(probe, 'sld_L', getattr(probe, 'unique_L', None))
+        digest = (hashlib.sha1(numpy.ascontiguousarray(L, 'd').tobytes())
+                  .hexdigest() if L is not None else None)
+        composition = tuple(sorted((str(k), v) for k, v in atoms.items()))
+        return (type(probe), getattr(probe, 'sld_columns', None), digest,
+                composition)
+
+    def lookup(self, probe, material):
+        """
+        Return the scattering factors of *material* at density 1 for
+        *probe*, calling *probe.scattering_factors* if they are not stored.
+        """
+        key = self.key(probe, material)
+        if key is None:
+            return probe.scattering_factors(material, density=1.0)
+        value = self._store.pop(key, None)
+        if value is None:
+            self.misses += 1
+            value = probe.scattering_factors(material, density=1.0)
+        else:
+            self.hits += 1
+        self._store[key] = value
+        while len(self._store) > self.size:
+            self._store.popitem(last=False)
+            self.evictions += 1
+        return value
+
+#: Process-wide :class:`ScatteringFactorCache` used by :class:`ProbeCache`.
+scattering_factor_cache = ScatteringFactorCache()
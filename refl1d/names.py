@@ -9,46 +9,120 @@ can simply perform:
 
 This is bad style for library and applications but convenient for
 small scripts.
+
+The names are loaded on first use, so a script which only imports the
+names it needs, such as::
+
+    from refl1d.names import Slab, Material, NeutronProbe, Experiment
+
+only imports the modules which define them.  This saves time on startup
+for short batch jobs.  Using *import \\** binds every name, and so imports
+all the modules.
 """
 
 import sys
+import importlib
+
 import numpy as np
 
-from periodictable import elements, formula
-from bumps.parameter import Parameter, FreeVariables
-from bumps import pmath
-from bumps.pdfwrapper import PDF
-from bumps.fitproblem import FitProblem
-from bumps.fitproblem import MultiFitProblem  # deprecated
-
-from .experiment import Experiment, plot_sample, MixedExperiment
-from .flayer import FunctionalProfile, FunctionalMagnetism
-from .material import SLD, Material, Compound, Mixture
-from .model import Slab, Stack
-from .polymer import (PolymerBrush, PolymerMushroom, EndTetheredPolymer,
-                      VolumeProfile, layer_thickness)
-from .mono import FreeLayer, FreeInterface
-from .cheby import FreeformCheby, ChebyVF, cheby_approx, cheby_points
-from .interface import Erf
-from .probe import (Probe, ProbeSet, XrayProbe, NeutronProbe, QProbe,
-                    PolarizedNeutronProbe, PolarizedQProbe, load4)
-from .stajconvert import load_mlayer, save_mlayer
-from . import ncnrdata as NCNR, snsdata as SNS
-from .instrument import Monochromatic, Pulsed
-from .magnetic import MagneticSlab, MagneticTwist, FreeMagnetic, MagneticStack
-from .magnetism import Magnetism, MagnetismTwist, FreeMagnetism, MagnetismStack
-from .support import sample_data
+# Exported name => (module, attribute), with attribute None for a module
+_LAZY = {
+    'elements': ('periodictable', 'elements'),
+    'formula': ('periodictable', 'formula'),
+    'Parameter': ('bumps.parameter', 'Parameter'),
+    'FreeVariables': ('bumps.parameter', 'FreeVariables'),
+    'pmath': ('bumps.pmath', None),
+    'PDF': ('bumps.pdfwrapper', 'PDF'),
+    'FitProblem': ('bumps.fitproblem', 'FitProblem'),
+    'MultiFitProblem': ('bumps.fitproblem', 'MultiFitProblem'),  # deprecated
+    'Experiment': ('.experiment', 'Experiment'),
+    'plot_sample': ('.experiment', 'plot_sample'),
+    'MixedExperiment': ('.experiment', 'MixedExperiment'),
+    'FunctionalProfile': ('.flayer', 'FunctionalProfile'),
+    'FunctionalMagnetism': ('.flayer', 'FunctionalMagnetism'),
+    'SLD': ('.material', 'SLD'),
+    'Material': ('.material', 'Material'),
+    'Compound': ('.material', 'Compound'),
+    'Mixture': ('.material', 'Mixture'),
+    'Slab': ('.model', 'Slab'),
+    'Stack': ('.model', 'Stack'),
+    'PolymerBrush': ('.polymer', 'PolymerBrush'),
+    'PolymerMushroom': ('.polymer', 'PolymerMushroom'),
+    'EndTetheredPolymer': ('.polymer', 'EndTetheredPolymer'),
+    'VolumeProfile': ('.polymer', 'VolumeProfile'),
+    'layer_thickness': ('.polymer', 'layer_thickness'),
+    'FreeLayer': ('.mono', 'FreeLayer'),
+    'FreeInterface': ('.mono', 'FreeInterface'),
+    'FreeformCheby': ('.cheby', 'FreeformCheby'),
+    'ChebyVF': ('.cheby', 'ChebyVF'),
+    'cheby_approx': ('.cheby', 'cheby_approx'),
+    'cheby_points': ('.cheby', 'cheby_points'),
+    'Erf': ('.interface', 'Erf'),
+    'Probe': ('.probe', 'Probe'),
+    'ProbeSet': ('.probe', 'ProbeSet'),
+    'XrayProbe': ('.probe', 'XrayProbe'),
+    'NeutronProbe': ('.probe', 'NeutronProbe'),
+    'QProbe': ('.probe', 'QProbe'),
+    'PolarizedNeutronProbe': ('.probe', 'PolarizedNeutronProbe'),
+    'PolarizedQProbe': ('.probe', 'PolarizedQProbe'),
+    'PolarizedNeutronQProbe': ('.probe', 'PolarizedQProbe'),  # deprecated
+    'load4': ('.probe', 'load4'),
+    'load_mlayer': ('.stajconvert', 'load_mlayer'),
+    'save_mlayer': ('.stajconvert', 'save_mlayer'),
+    'NCNR': ('.ncnrdata', None),
+    'SNS': ('.snsdata', None),
+    'Monochromatic': ('.instrument', 'Monochromatic'),
+    'Pulsed': ('.instrument', 'Pulsed'),
+    'MagneticSlab': ('.magnetic', 'MagneticSlab'),
+    'MagneticTwist': ('.magnetic', 'MagneticTwist'),
+    'FreeMagnetic': ('.magnetic', 'FreeMagnetic'),
+    'MagneticStack': ('.magnetic', 'MagneticStack'),
+    'Magnetism': ('.magnetism', 'Magnetism'),
+    'MagnetismTwist': ('.magnetism', 'MagnetismTwist'),
+    'FreeMagnetism': ('.magnetism', 'FreeMagnetism'),
+    'MagnetismStack': ('.magnetism', 'MagnetismStack'),
+    'sample_data': ('.support', 'sample_data'),
+}
 
 # Pull in common materials for reflectometry experiments.
 # This could lead to a lot of namespace pollution, and particularly to
 # confusion if the user also does "from periodictable import *" since
 # both of them create elements.
-# Python doesn't allow "from .module import *"
-from .materialdb import *
+# This list must match materialdb.__all__.
+_LAZY.update((name, ('.materialdb', name)) for name in (
+    'air',
+    'water', 'H2O', 'heavywater', 'D2O', 'lightheavywater', 'DHO',
+    'silicon', 'Si', 'sapphire', 'Al2O3', 'gold', 'Au',
+    'permalloy', 'Ni8Fe2',
+    ))
+
+__all__ = sorted(_LAZY) + ['ModelFunction', 'np', 'numpy', 'sys']
+
+def __getattr__(name):
+    """
+    Import the module defining *name* on first use.
+    """
+    try:
+        module, attr = _LAZY[name]
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r"%(__name__, name))
+    value = importlib.import_module(module, __package__)
+    if attr is not None:
+        value = getattr(value, attr)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
+# Module level __getattr__ needs python 3.7 (PEP 562), so load everything
+# up front on older versions.
+if sys.version_info < (3, 7):
+    for _name in _LAZY:
+        __getattr__(_name)
 
 # Deprecated names
 def ModelFunction(*args, **kw):
     raise NotImplementedError("ModelFunction no longer supported --- use PDF instead")
 
-PolarizedNeutronQProbe = PolarizedQProbe
 numpy = np
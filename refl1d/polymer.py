@@ -47,9 +47,12 @@ Profile\ [#Cosgrove]_\ [#deVos]_\ [#Sheridan]_
 from __future__ import division, print_function, unicode_literals
 
 __all__ = ["PolymerBrush", "PolymerMushroom", "EndTetheredPolymer",
-           "VolumeProfile", "layer_thickness"]
+           "VolumeProfile", "layer_thickness", "SCFstore", "set_scf_store"]
 
 import inspect
+import os
+import tempfile
+import weakref
 
 import numpy as np
 
@@ -639,10 +642,24 @@ def SCFcache(chi, chi_s, pdi, sigma, segments, disp=False, cache=OrderedDict()):
     Return a memoized SCF result by walking from a previous solution.
 
     Using an OrderedDict (because I want to prune keys FIFO)
+
+    If an :class:`SCFstore` is active (see :func:`set_scf_store`), solutions
+    are also looked up in and saved to the store, and the walk starts from
+    the nearest stored solution when it is closer than any in *cache*.
     """
+    store = SCF_STORE
+    index = _cache_index(cache)
+
     # prime the cache with a known easy solution
     if not cache:
-        cache[(0, 0, 0, .1, .2)] = SCFsolve(sigma=.1, segments=100)
+        prime = (0, 0, 0, .1, .2)
+        phi = store.get(prime) if store is not None else None
+        if phi is None:
+            phi = SCFsolve(sigma=.1, segments=100)
+            if store is not None:
+                store.put(prime, phi)
+        cache[prime] = phi
+        index.add(prime)
 
     if disp:
         starttime = time()
@@ -658,26 +675,35 @@ def SCFcache(chi, chi_s, pdi, sigma, segments, disp=False, cache=OrderedDict()):
         cache[scaled_parameters] = phi     # to the end as "recently used"
         return phi
 
-    # Find the closest parameters in the cache: O(len(cache))
-
-    # Numpy setup
-    cached_parameters = list(cache)
-    cp_array = np.array(cached_parameters)
+    # another process may have solved it already
+    if store is not None:
+        phi = store.get(scaled_parameters)
+        if phi is not None:
+            if disp:
+                print('SCFstore hit at:', scaled_parameters)
+            cache[scaled_parameters] = phi
+            index.add(scaled_parameters)
+            return phi
+
+    # Find the closest parameters in the cache
+    closest_cp, distance = index.nearest(scaled_parameters)
+    closest_cp_array = np.array(closest_cp)
     p_array = np.array(scaled_parameters)
-
-    # Calculate distances to all cached parameters
-    deltas = p_array - cp_array # Parameter space displacement vectors
-    norms = sqrt(addred(deltas*deltas, axis=1)) # and their magnitudes
-    closest_index = norms.argmin()
-
-    # Organize closest point data for later use
-    closest_cp = cached_parameters[closest_index]
-    closest_cp_array = cp_array[closest_index]
-    closest_delta = deltas[closest_index]
+    closest_delta = p_array - closest_cp_array
 
     phi0 = cache.pop(closest_cp) # pop and assign to shift the key
     cache[closest_cp] = phi0     # to the end as "recently used"
 
+    # Walk from the on-disk store instead if it has a closer solution
+    if store is not None:
+        stored_cp, stored_distance = store.nearest(scaled_parameters)
+        stored_phi = (store.get(stored_cp) if stored_distance < distance
+                      else None)
+        if stored_phi is not None:
+            phi0 = stored_phi
+            closest_cp_array = np.array(stored_cp)
+            closest_delta = p_array - closest_cp_array
+
     if disp:
         print("Walking from nearest:", closest_cp_array)
         print("to:", p_array)
@@ -723,6 +749,7 @@ def SCFcache(chi, chi_s, pdi, sigma, segments, disp=False, cache=OrderedDict()):
         try:
             phi0 = SCFsolve(*parameters, phi0=phi0, disp=disp)
             cache[p_tup] = phi0
+            index.add(p_tup)
             dstep *= 1.05
             step += dstep
         except RuntimeError as e:
@@ -740,6 +767,11 @@ def SCFcache(chi, chi_s, pdi, sigma, segments, disp=False, cache=OrderedDict()):
                 dstep *= .5
                 step -= dstep
 
+    # only the solution is shared; the intermediate steps of the walk
+    # are of little use to other processes
+    if store is not None:
+        store.put(scaled_parameters, phi0)
+
     if disp:
         print('SCFcache execution time:', round(time()-starttime, 3), "s")
 
@@ -748,13 +780,264 @@ def SCFcache(chi, chi_s, pdi, sigma, segments, disp=False, cache=OrderedDict()):
         if disp:
             print('pruning cache')
         for i in range(100):
-            cache.popitem(last=False)
+            key, _ = cache.popitem(last=False)
+            index.remove(key)
 
     return phi0
 
 
+class _NearestIndex(object):
+    """
+    Nearest neighbour lookup for scaled SCF parameters.
+
+    The keys are held in a KD-tree, which is rebuilt once enough keys
+    have been added or removed.  Keys added since then are compared
+    directly, and removed keys are skipped, so that keeping the index in
+    step with the cache is cheap.
+    """
+    #: Number of changes before the tree is rebuilt
+    rebuild = 64
+
+    def __init__(self, keys=()):
+        self._all = set(keys)
+        self._keys = []  # keys in the tree
+        self._tree = None
+        self._added = set()
+        self._removed = set()
+        self._build()
+
+    def __len__(self):
+        return len(self._all)
+
+    def add(self, key):
+        if key in self._all:
+            return
+        self._all.add(key)
+        if key in self._removed:
+            self._removed.discard(key)
+        else:
+            self._added.add(key)
+
+    def remove(self, key):
+        if key not in self._all:
+            return
+        self._all.discard(key)
+        if key in self._added:
+            self._added.discard(key)
+        else:
+            self._removed.add(key)
+
+    def nearest(self, key):
+        """
+        Return the closest key to *key* and its distance, or (None, inf)
+        if the index is empty.
+        """
+        if len(self._added) + len(self._removed) > self.rebuild:
+            self._build()
+        best, distance = None, np.inf
+        p = np.array(key, 'd')
+        if self._tree is not None and len(self._removed) < len(self._keys):
+            # ask for enough neighbours that one has not been removed
+            k = len(self._removed) + 1
+            distances, indices = self._tree.query(p, k=k)
+            for d, i in zip(np.atleast_1d(distances), np.atleast_1d(indices)):
+                if i < len(self._keys) and self._keys[i] not in self._removed:
+                    best, distance = self._keys[i], d
+                    break
+        if self._added:
+            added = list(self._added)
+            deltas = np.array(added) - p
+            norms = sqrt(addred(deltas*deltas, axis=1))
+            i = norms.argmin()
+            if norms[i] < distance:
+                best, distance = added[i], norms[i]
+        return best, distance
+
+    def _build(self):
+        self._keys = list(self._all)
+        self._added.clear()
+        self._removed.clear()
+        if self._keys:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(np.array(self._keys, 'd'))
+        else:
+            self._tree = None
+
+# id(cache) => (weakref to cache, _NearestIndex of its keys)
+_CACHE_INDEXES = {}
+
+def _cache_index(cache):
+    """
+    Return the :class:`_NearestIndex` for the keys of the SCFcache *cache*.
+
+    The index is rebuilt if the cache was changed outside of SCFcache.
+    """
+    ref, index = _CACHE_INDEXES.get(id(cache), (None, None))
+    if ref is None or ref() is not cache or len(index) != len(cache):
+        index = _NearestIndex(cache)
+        _CACHE_INDEXES[id(cache)] = weakref.ref(cache), index
+    return index
+
+
+class SCFstore(object):
+    """
+    On-disk store of SCF solutions shared between processes.
+
+    Each solution is saved as a .npy file in the directory *path*, with
+    the scaled parameters (chi, 3 chi_s, pdi-1, sigma, segments/500) used
+    by :func:`SCFcache` encoded in the file name, so worker processes
+    pointed at the same directory see each other's solutions without any
+    locking.  Files are written under a temporary name and renamed into
+    place, and are loaded with *mmap_mode* ('r' by default).
+
+    The nearest stored solution is found with the same index as used for
+    the in-memory cache.  Solutions saved by this process are added to the
+    index as they are written, and the directory is scanned for solutions
+    from other processes at most every *interval* seconds.  Once the files
+    take more than *max_bytes*, the least recently used are removed.
+
+    Use :func:`set_scf_store` to select the store used by
+    :func:`SCFcache`, or set the REFL1D_SCF_STORE environment variable to
+    the directory before importing refl1d.
+    """
+    def __init__(self, path, max_bytes=100*2**20, mmap_mode='r',
+                 interval=5.):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self.interval = interval
+        self._files = {}  # name: (key, size)
+        self._index = _NearestIndex()
+        self._scanned = -np.inf
+
+    @staticmethod
+    def _name(key):
+        return "_".join(float(v).hex() for v in key) + ".npy"
+
+    @staticmethod
+    def _key(name):
+        return tuple(float.fromhex(v) for v in name[:-4].split("_"))
+
+    def refresh(self, force=False):
+        """
+        Update the index with solutions added or removed by other processes.
+
+        The directory is only scanned if *interval* seconds have passed
+        since the last scan, or if *force* is True.
+        """
+        if not force and time() - self._scanned < self.interval:
+            return
+        self._scanned = time()
+        try:
+            names = set(v for v in os.listdir(self.path)
+                        if v.endswith(".npy") and not v.startswith("."))
+        except OSError:
+            names = set()
+        for name in set(self._files) - names:
+            self._discard(name)
+        for name in names - set(self._files):
+            self._add(name)
+
+    def _add(self, name):
+        try:
+            key = self._key(name)
+            size = os.path.getsize(os.path.join(self.path, name))
+        except (ValueError, OSError):
+            return
+        self._files[name] = key, size
+        self._index.add(key)
+
+    def _discard(self, name):
+        key, _ = self._files.pop(name)
+        self._index.remove(key)
+
+    def __len__(self):
+        self.refresh()
+        return len(self._files)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.path, self._name(key)))
+
+    def get(self, key):
+        """
+        Return the solution stored for *key*, or None.
+        """
+        name = self._name(key)
+        filename = os.path.join(self.path, name)
+        try:
+            phi = np.load(filename, mmap_mode=self.mmap_mode)
+            os.utime(filename, None)  # mark as recently used
+        except (IOError, OSError, ValueError):
+            # removed by another process since the last scan
+            if name in self._files:
+                self._discard(name)
+            return None
+        return phi
+
+    def put(self, key, phi):
+        """
+        Store solution *phi* for *key*, evicting old solutions if needed.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        name = self._name(key)
+        fd, tmpname = tempfile.mkstemp(prefix=".", suffix=".npy",
+                                       dir=self.path)
+        with os.fdopen(fd, 'wb') as fid:
+            np.save(fid, np.asarray(phi, 'd'))
+        try:
+            os.rename(tmpname, os.path.join(self.path, name))
+        except OSError:
+            # Windows will not replace a solution saved by another worker
+            os.unlink(tmpname)
+        if name not in self._files:
+            self._add(name)
+        self._evict()
+
+    def nearest(self, key):
+        """
+        Return the stored key closest to *key* and its distance, or
+        (None, inf) if the store is empty.
+        """
+        self.refresh()
+        return self._index.nearest(key)
+
+    def _evict(self):
+        total = sum(size for _, size in self._files.values())
+        if total <= self.max_bytes:
+            return
+        def _mtime(name):
+            try:
+                return os.path.getmtime(os.path.join(self.path, name))
+            except OSError:
+                return 0
+        # Remove down to 90% so that eviction is not triggered on every put
+        for name in sorted(self._files, key=_mtime):
+            if total <= 0.9*self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                continue
+            total -= self._files[name][1]
+            self._discard(name)
+
+def set_scf_store(path, max_bytes=100*2**20):
+    """
+    Share SCF solutions between processes through the directory *path*.
+
+    Use None to stop using the store.  Returns the new :class:`SCFstore`.
+    """
+    global SCF_STORE
+    SCF_STORE = SCFstore(path, max_bytes=max_bytes) if path else None
+    return SCF_STORE
+
+SCF_STORE = (SCFstore(os.environ['REFL1D_SCF_STORE'])
+             if os.environ.get('REFL1D_SCF_STORE') else None)
+
+
 def SCFsolve(chi=0, chi_s=0, pdi=1, sigma=None, segments=None,
-             disp=False, phi0=None, maxiter=15):
+             disp=False, phi0=None, maxiter=15, method=None):
     """
     Solve SCF equations using an initial guess and lattice parameters
 
@@ -763,6 +1046,12 @@ def SCFsolve(chi=0, chi_s=0, pdi=1, sigma=None, segments=None,
 
     The Newton-Krylov solver really makes this one. Krylov+gmres was faster
     than the other scipy.optimize alternatives by quite a lot.
+
+    *method* is 'krylov' to use scipy.optimize.root, which approximates
+    the Jacobian by finite differences, or 'newton' to use exact
+    Jacobian-vector products from :class:`SCFjacobian`.  The default is
+    the module variable SCF_METHOD.  Iteration counts for the 'newton'
+    method are accumulated in SCF_STATS.
     """
 
     from scipy.optimize import root
@@ -807,11 +1096,16 @@ def SCFsolve(chi=0, chi_s=0, pdi=1, sigma=None, segments=None,
             print("Solving SCF equations")
 
         try:
-            result = root(
-                SCFeqns, phi0, args=(chi, chi_s, sigma, segments, p_i),
-                method='Krylov', callback=callback,
-                options={'disp':bool(disp), 'maxiter':maxiter,
-                         'jac_options':{'method':jac_solve_method}})
+            if (method or SCF_METHOD) == 'newton':
+                result = SCFnewton(
+                    phi0, args=(chi, chi_s, sigma, segments, p_i),
+                    callback=callback, maxiter=maxiter, disp=disp)
+            else:
+                result = root(
+                    SCFeqns, phi0, args=(chi, chi_s, sigma, segments, p_i),
+                    method='Krylov', callback=callback,
+                    options={'disp':bool(disp), 'maxiter':maxiter,
+                             'jac_options':{'method':jac_solve_method}})
             if disp:
                 print('Solver exit code:', result.status, result.message)
 
@@ -1014,17 +1308,22 @@ def SCFeqns(phi_z, chi, chi_s, sigma, navgsegments, p_i):
     uavg = addred(u)/layers
     g_z_norm = g_z*exp(uavg)
 
-    # calculate weighting factors for terminally attached chains
-    g_zs_ta_norm = calc_g_zs(g_z_norm, 0, layers, cutoff)
-
-    # calculate normalization constants from 1/(single chain partition fn)
     if cutoff == round(navgsegments): # if uniform,
+        # the free chains are a multiple of the chains starting from g_z,
+        # so compute them with the terminally attached chains in one call
+        g_zs_ta_norm, g_zs_free_ngts_norm = calc_g_zs_batch(
+            g_z_norm, (0., 1.), layers, cutoff)
         c_i_norm = sigma/addred(g_zs_ta_norm[:, -1]) # take a shortcut!
+        g_zs_free_ngts_norm *= c_i_norm
     else:
+        # calculate weighting factors for terminally attached chains
+        g_zs_ta_norm = calc_g_zs(g_z_norm, 0, layers, cutoff)
+
+        # calculate normalization constants from 1/(single chain partition fn)
         c_i_norm = sigma*p_i/addred(g_zs_ta_norm, axis=0)
 
-    # calculate weighting factors for free chains
-    g_zs_free_ngts_norm = calc_g_zs(g_z_norm, c_i_norm, layers, cutoff)
+        # calculate weighting factors for free chains
+        g_zs_free_ngts_norm = calc_g_zs(g_z_norm, c_i_norm, layers, cutoff)
 
     # calculate new polymer density field
     phi_z_new = calc_phi_z(g_zs_ta_norm, g_zs_free_ngts_norm, g_z_norm)
@@ -1039,6 +1338,157 @@ def SCFeqns(phi_z, chi, chi_s, sigma, navgsegments, p_i):
     eps_z = phi_z - phi_z_new
     return eps_z + penalty*np.sign(eps_z)
 
+class SCFjacobian(object):
+    """
+    Residual of :func:`SCFeqns` at *phi_z* with its exact Jacobian.
+
+    The propagators are differentiated in forward mode (see
+    :func:`calc_dg_zs`), so :meth:`matvec` costs about as much as one
+    residual evaluation and avoids the finite difference steps used to
+    approximate the Jacobian in scipy.optimize.root.
+    """
+    def __init__(self, phi_z, chi, chi_s, sigma, navgsegments, p_i):
+        # same sequence of steps as SCFeqns, keeping the intermediates
+        self.sign_z = np.sign(phi_z)
+        phi_abs = fabs(phi_z)
+        self.toomuch = phi_abs > .99999
+        phi = np.where(self.toomuch, .99999, phi_abs)
+        penalty = np.where(self.toomuch, 1e5*(phi_abs-.99999), 0)
+
+        layers = phi.size
+        cutoff = p_i.size
+        delta = np.zeros(layers)
+        delta[0] = 1.0
+        self.boltzmann = exp(2*chi*calc_phi_z_avg(phi) + delta*chi_s)
+        g_z = (1.0 - phi)*self.boltzmann
+        uavg = addred(-log(g_z))/layers
+        g_z_norm = g_z*exp(uavg)
+
+        self.uniform = cutoff == round(navgsegments)
+        if self.uniform:
+            g_zs_ta_norm, g_zs_free_ngts_norm = calc_g_zs_batch(
+                g_z_norm, (0., 1.), layers, cutoff)
+            c_i_norm = sigma/addred(g_zs_ta_norm[:, -1])
+            g_zs_free_ngts_norm *= c_i_norm
+        else:
+            g_zs_ta_norm = calc_g_zs(g_z_norm, 0, layers, cutoff)
+            c_i_norm = sigma*p_i/addred(g_zs_ta_norm, axis=0)
+            g_zs_free_ngts_norm = calc_g_zs(g_z_norm, c_i_norm, layers,
+                                            cutoff)
+        self.phi_z_new = calc_phi_z(g_zs_ta_norm, g_zs_free_ngts_norm,
+                                    g_z_norm)
+
+        eps_z = phi - self.phi_z_new
+        self.sign_eps = np.sign(eps_z)
+        self.residual = eps_z + penalty*self.sign_eps
+
+        self.chi, self.layers, self.cutoff = chi, layers, cutoff
+        self.g_z, self.g_z_norm, self.c_i_norm = g_z, g_z_norm, c_i_norm
+        self.g_zs_ta_norm = g_zs_ta_norm
+        self.g_zs_free_ngts_norm = g_zs_free_ngts_norm
+
+    def matvec(self, v):
+        """
+        Return the product of the Jacobian with the vector *v*.
+        """
+        dphi = np.where(self.toomuch, 0., self.sign_z*v)
+        dg_z = (-dphi*self.boltzmann
+                + self.g_z*2*self.chi*calc_phi_z_avg(dphi))
+        # relative change in the normalized g_z, including the change
+        # in the normalization constant
+        w = dg_z/self.g_z
+        w -= addred(w)/self.layers
+
+        g_ta, g_free = self.g_zs_ta_norm, self.g_zs_free_ngts_norm
+        dg_ta = calc_dg_zs(self.g_z_norm, w, np.zeros(self.cutoff), g_ta)
+        if self.uniform:
+            dc_i = np.zeros(self.cutoff)
+            dc_i[-1] = -self.c_i_norm*addred(dg_ta[:, -1])/addred(g_ta[:, -1])
+        else:
+            dc_i = -self.c_i_norm*addred(dg_ta, axis=0)/addred(g_ta, axis=0)
+        dg_free = calc_dg_zs(self.g_z_norm, w, dc_i, g_free)
+
+        dphi_new = (addred(dg_ta*np.fliplr(g_free)
+                           + g_ta*np.fliplr(dg_free), axis=1)/self.g_z_norm
+                    - self.phi_z_new*w)
+        dpenalty = np.where(self.toomuch, 1e5*self.sign_z*v, 0)
+        return dphi - dphi_new + dpenalty*self.sign_eps
+
+def SCFnewton(phi0, args=(), callback=None, maxiter=15, f_tol=6e-6,
+              disp=False):
+    """
+    Solve :func:`SCFeqns` by Newton's method with GMRES inner iterations.
+
+    Each inner iteration uses an exact Jacobian-vector product from
+    :class:`SCFjacobian`, with a backtracking line search on the residual
+    norm.  The return value has the attributes of the scipy.optimize.root
+    result used by :func:`SCFsolve` (*x*, *status*, *message*), with
+    *status* 1 on success and 2 if *maxiter* iterations were not enough,
+    and reports the number of Newton iterations *nit*, residual
+    evaluations *nfev* and Jacobian-vector products *njev*.
+    """
+    from scipy.optimize import OptimizeResult
+    from scipy.sparse.linalg import LinearOperator, gmres
+
+    n = len(phi0)
+    counts = {'nfev': 1, 'njev': 0}
+    def matvec(v):
+        counts['njev'] += 1
+        return jac.matvec(np.ravel(v))
+
+    x = np.array(phi0, 'd')
+    jac = SCFjacobian(x, *args)
+    status, nit = 2, 0
+    while True:
+        fnorm = np.max(np.abs(jac.residual))
+        if fnorm < f_tol:
+            status = 1
+            break
+        if nit >= maxiter:
+            break
+        nit += 1
+
+        # inexact Newton step; the tolerance tightens as we converge
+        A = LinearOperator((n, n), matvec=matvec, dtype='d')
+        rtol = min(0.5, sqrt(fnorm))
+        try:
+            dx, _ = gmres(A, -jac.residual, rtol=rtol, atol=0)
+        except TypeError:  # scipy < 1.12
+            dx, _ = gmres(A, -jac.residual, tol=rtol, atol=0)
+
+        # backtrack until the residual decreases
+        norm2 = np.linalg.norm(jac.residual)
+        step = 1.0
+        while True:
+            trial = SCFjacobian(x + step*dx, *args)
+            counts['nfev'] += 1
+            if (np.linalg.norm(trial.residual) < (1 - 1e-4*step)*norm2
+                    or step < 1./16):
+                break
+            step *= 0.5
+        x, jac = x + step*dx, trial
+        if disp:
+            print('Newton iteration', nit, 'step', step,
+                  '|F| =', np.max(np.abs(jac.residual)))
+        if callback is not None:
+            callback(x, jac.residual)
+
+    SCF_STATS['solves'] += 1
+    SCF_STATS['iterations'] += nit
+    SCF_STATS['residuals'] += counts['nfev']
+    SCF_STATS['jvps'] += counts['njev']
+    message = ('A solution was found at the specified tolerance.'
+               if status == 1 else 'The maximum number of iterations allowed'
+               ' has been reached.')
+    return OptimizeResult(x=x, fun=jac.residual, status=status,
+                          success=status == 1, message=message, nit=nit,
+                          **counts)
+
+#: Method used by SCFsolve, either 'krylov' or 'newton'
+SCF_METHOD = 'krylov'
+#: Work done by the 'newton' SCF method
+SCF_STATS = {'solves': 0, 'iterations': 0, 'residuals': 0, 'jvps': 0}
+
 def _getmax(t, seen_t={}):
     try:
         return seen_t[t]
@@ -1108,3 +1558,69 @@ def calc_g_zs(g_z, c_i, layers, segments):
 #        pg_zs=g_zs[:, r]
 
     return g_zs
+
+def calc_g_zs_batch(g_z, c_i, layers, segments, threads=0):
+    """
+    Propagators for a batch of independent chains in one call.
+
+    *g_z* is a row of Boltzmann weighting factors for each chain, or a
+    single row shared by all of them.  *c_i* is as for :func:`calc_g_zs`:
+    rows of normalization constants for free chains, or a constant for
+    uniform chains, with 0 for terminally attached chains.  A sequence of
+    constants gives one chain for each, and a single row of *c_i* is
+    shared by all chains.  The chains are split across *threads* OpenMP
+    threads, with 0 for OMP_NUM_THREADS if it is set and 1 otherwise.
+
+    Returns an array *g_zs* with *g_zs[k]* equal to calc_g_zs for chain
+    *k*.  Each *g_zs[k]* is a contiguous block in Fortran order.
+    """
+    g_z = np.ascontiguousarray(g_z, 'd')
+    c_i = np.ascontiguousarray(c_i, 'd')
+    if g_z.ndim not in (1, 2) or g_z.shape[-1] != layers:
+        raise ValueError("g_z must have rows of %d layers" % layers)
+    free = c_i.ndim == 2
+    if c_i.ndim > 2 or (free and c_i.shape[1] != segments):
+        raise ValueError("c_i must have rows of %d segments" % segments)
+    g_z_rows = g_z.shape[0] if g_z.ndim == 2 else 1
+    c_i_rows = c_i.shape[0] if c_i.ndim else 1
+    batch = max(g_z_rows, c_i_rows)
+    if g_z_rows not in (1, batch) or c_i_rows not in (1, batch):
+        raise ValueError("g_z and c_i have different numbers of chains")
+
+    g_z = g_z.reshape(g_z_rows, layers)
+    block = np.empty((batch, segments, layers), dtype=np.float64)
+    if free:
+        # free ends
+        np.multiply(c_i[:, -1:], g_z, out=block[:, 0, :])
+    else:
+        # uniform chains, or terminally attached ends where c_i is zero
+        c = c_i.reshape(c_i_rows, 1)
+        np.multiply(c, g_z, out=block[:, 0, :])
+        for k in range(batch):
+            if c[k if c_i_rows > 1 else 0, 0] == 0:
+                block[k, 0, 0] = g_z[k if g_z_rows > 1 else 0, 0]
+        c_i = None
+    from refl1d.calc_g_zs_cex import _calc_g_zs_batch
+    _calc_g_zs_batch(g_z, c_i, block, LAMBDA_0, LAMBDA_1, layers, segments,
+                     batch, layers if g_z_rows > 1 else 0,
+                     segments if c_i_rows > 1 else 0, int(threads))
+    return block.transpose(0, 2, 1)
+
+def calc_dg_zs(g_z, w, dc_i, g_zs):
+    """
+    Derivative of the propagator *g_zs* returned by :func:`calc_g_zs`.
+
+    The derivative is taken along the direction in which g_z changes by
+    ``w*g_z`` and c_i changes by *dc_i*, which is zero for terminally
+    attached chains.  Uniform chains have a single nonzero entry, for the
+    final segment.
+    """
+    layers, segments = g_zs.shape
+    dc_i = np.ascontiguousarray(dc_i, 'd').ravel()
+    w = np.ascontiguousarray(w, 'd')
+    dg_zs = np.empty((layers, segments), dtype=np.float64, order='F')
+    dg_zs[:, 0] = w*g_zs[:, 0] + dc_i[-1]*g_z
+    from refl1d.calc_g_zs_cex import _calc_dg_zs
+    _calc_dg_zs(g_z, w, dc_i, g_zs, dg_zs, LAMBDA_0, LAMBDA_1,
+                layers, segments)
+    return dg_zs
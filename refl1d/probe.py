@@ -40,6 +40,7 @@ from __future__ import with_statement, division, print_function
 
 import os
 import json
+import bisect
 
 import numpy
 from numpy import sqrt, pi, inf, sign, log
@@ -54,7 +55,7 @@ from .material import Vacuum
 from .resolution import QL2T, QT2L, TL2Q, dQdL2dT, dQdT2dLoL, dTdL2dQ
 from .resolution import sigma2FWHM, FWHM2sigma
 from .stitch import stitch
-from .reflectivity import convolve
+from .reflectivity import convolve, convolve_fft, convolve_matrix
 
 PROBE_KW = ('T', 'dT', 'L', 'dL', 'data', 'name', 'filename',
             'intensity', 'background', 'back_absorption',
@@ -73,6 +74,19 @@ def make_probe(**kw):
         return XrayProbe(**kw)
 
 
+# Attributes which determine Q, calc_Q and unique_L; see Probe.version
+_GRID_ATTRIBUTES = frozenset((
+    'T', 'dT', 'L', 'dL', 'Q', 'dQ', 'Qo', 'calc_T', 'calc_L', 'calc_Qo',
+    'unique_L', 'theta_offset', 'back_reflectivity'))
+def _grid_setattr(self, name, value):
+    """
+    Helper for __setattr__ which counts changes to the Q grid.
+    """
+    if name in _GRID_ATTRIBUTES:
+        object.__setattr__(self, '_grid_version', self._grid_version + 1)
+    object.__setattr__(self, name, value)
+
+
 class Probe(object):
     r"""
     Defines the incident beam used to study the material.
@@ -149,9 +163,14 @@ class Probe(object):
     """
     polarized = False
     Aguide = 270  # default guide field for unpolarized measurements
+    adaptive = None  # settings for adaptive_oversample
+    convolution = 'direct'  # 'direct', 'fft' or 'matrix'; see _apply_resolution
+    sld_columns = None  # wavelengths for scattering factors; see sld_L
     view = "fresnel"
     plot_shift = 0
     residuals_shift = 0
+    _grid_version = 0
+    __setattr__ = _grid_setattr
 
     def __init__(self, T=None, dT=0, L=None, dL=0, data=None,
                  intensity=1, background=0, back_absorption=1, theta_offset=0,
@@ -321,10 +340,32 @@ class Probe(object):
         self.unique_L = numpy.unique(self.calc_L)
         self._L_idx = numpy.searchsorted(self.unique_L, L)
 
+    @property
+    def version(self):
+        """
+        Token which changes whenever *Q*, *calc_Q* or *unique_L* may change.
+
+        Assigning any of the measurement or calculation points, or replacing
+        *theta_offset*, increments a counter; the value of *theta_offset* is
+        included directly.  Changes made in place to the arrays are not seen.
+        """
+        return self._grid_version, self.theta_offset.value
+
+    def _memo(self, name, fn):
+        """
+        Return *fn()*, reusing the previous value if *version* is unchanged.
+        """
+        version = self.version
+        memo = self.__dict__.setdefault('_memo_cache', {})
+        if name not in memo or memo[name][0] != version:
+            memo[name] = version, fn()
+        return memo[name][1]
+
     @property
     def Q(self):
         if self.theta_offset.value != 0:
-            Q = TL2Q(T=self.T+self.theta_offset.value, L=self.L)
+            Q = self._memo('Q', lambda: TL2Q(T=self.T+self.theta_offset.value,
+                                             L=self.L))
             # TODO: this may break the Q order on measurements with varying L
         else:
             Q = self.Qo
@@ -333,7 +374,9 @@ class Probe(object):
     @property
     def calc_Q(self):
         if self.theta_offset.value != 0:
-            Q = TL2Q(T=self.calc_T+self.theta_offset.value, L=self.calc_L)
+            Q = self._memo('calc_Q',
+                           lambda: TL2Q(T=self.calc_T+self.theta_offset.value,
+                                        L=self.calc_L))
             # TODO: this may break the Q order on measurements with varying L
         else:
             Q = self.calc_Qo
@@ -361,6 +404,58 @@ class Probe(object):
         """
         raise NotImplementedError
 
+    @property
+    def sld_L(self):
+        """
+        Wavelengths at which the scattering factors are computed.
+
+        This is *unique_L* unless *sld_columns* is set to fewer wavelengths
+        than *unique_L*, in which case it is a geometric grid of
+        *sld_columns* wavelengths spanning *unique_L*.  The profile then
+        only needs *sld_columns* rows no matter how finely a time-of-flight
+        measurement is sampled, and :meth:`interp_sld` fills in the rows
+        for the wavelengths in between.
+
+        Set *sld_columns* before creating the experiment, since the
+        number of rows in the rendered profile is fixed at that point.
+        """
+        L, n = self.unique_L, self.sld_columns
+        if n is None or L is None or len(L) <= n:
+            return L
+        return self._memo('sld_L%d'%n, lambda: numpy.geomspace(L[0], L[-1], n))
+
+    @property
+    def rho_index(self):
+        """
+        Row of :meth:`interp_sld` for each point in *calc_Q*, or None if
+        the scattering factors do not depend on wavelength.
+        """
+        n = self.sld_columns
+        if n is None or self.unique_L is None:
+            return None
+        return self._memo('rho_index%d'%n, lambda: numpy.searchsorted(
+            self.unique_L, self.calc_L).astype('i'))
+
+    def interp_sld(self, rho):
+        """
+        Interpolate the rows of *rho*, computed at *sld_L*, to *unique_L*.
+
+        The interpolation is linear in wavelength between the neighbouring
+        rows, which is exact for the absorption of most neutron scatterers
+        since it goes as $1/v$.  Anomalous x-ray scattering near an
+        absorption edge needs *sld_columns* large enough to resolve the edge.
+        """
+        def _weights():
+            grid, L = self.sld_L, self.unique_L
+            lo = numpy.clip(numpy.searchsorted(grid, L, 'right')-1,
+                            0, max(len(grid)-2, 0))
+            hi = numpy.minimum(lo+1, len(grid)-1)
+            step = numpy.where(hi > lo, grid[hi]-grid[lo], 1.)
+            t = numpy.clip((L - grid[lo])/step, 0., 1.)[:, None]
+            return lo, hi, t
+        lo, hi, t = self._memo('sld_weights%d'%self.sld_columns, _weights)
+        return (1-t)*rho[lo] + t*rho[hi]
+
     def subsample(self, dQ):
         """
         Select points at most every dQ.
@@ -392,15 +487,32 @@ class Probe(object):
             self.dR = self.dR[idx]
         self._set_calc(self.T, self.L)
 
-    def resolution_guard(self):
+    def resolution_guard(self, n=5, width=3):
         r"""
-        Make sure each measured $Q$ point has at least 5 calculated $Q$
-        points contributing to it in the range $[-3\Delta Q, 3\Delta Q]$.
-
-        *Not Implemented*
+        Make sure each measured $Q$ point has at least *n* calculated $Q$
+        points contributing to it in the range $[-w\Delta Q, w\Delta Q]$,
+        with *w* = *width*.  Half of the points are required on each side
+        of $Q$, so that the resolution at the ends of the measurement
+        extends beyond the measured range.
+
+        Only the missing points are added, placed to fill the largest gaps
+        in the window, so measurements which are already densely sampled,
+        or which share calculation points with their neighbours, cost
+        nothing.  New points use the wavelength of the measurement they
+        guard.  Points with $\Delta Q = 0$ are ignored.
+
+        Returns the number of points added.
         """
-        raise NotImplementedError
-        # TODO: implement resolution guard.
+        Q, index = _guard_points(self.Qo, self.dQ, self.calc_Qo, n, width)
+        if len(Q):
+            if getattr(self, 'T', None) is None:
+                # Pure Q probe
+                self.calc_Qo = numpy.sort(numpy.hstack((self.calc_Qo, Q)))
+            else:
+                L = self.L[index]
+                self._set_calc(numpy.hstack((self.calc_T, QL2T(Q=Q, L=L))),
+                               numpy.hstack((self.calc_L, L)))
+        return len(Q)
 
     def critical_edge(self, substrate=None, surface=None,
                       n=51, delta=0.25):
@@ -483,26 +595,153 @@ class Probe(object):
         L = numpy.hstack((self.L, L.flatten()))
         self._set_calc(T, L)
 
+    def adaptive_oversample(self, tol=0.001, min_step=0.05, max_passes=8,
+                            thickness_change=0.1):
+        r"""
+        Choose the calculation points by refining where the theory bends.
+
+        Rather than drawing a fixed number of points around each measurement
+        as :meth:`oversample` does, start from the measured $Q$ points and
+        repeatedly bisect the intervals where the linear interpolation used
+        by the resolution calculation is in error.  An interval is split
+        when the theory at its midpoint differs from the average of the
+        theory at its ends by more than *tol* relative to that average,
+        unless it is already narrower than *min_step* times the local
+        $\Delta Q$.  At most *max_passes* bisections are done, so the
+        spacing is never less than $1/2^\text{max_passes}$ of the
+        original.  This puts points in the Kiessig fringes from thick
+        layers without wasting them in smooth regions.
+
+        The refinement depends on the model, so it is done by the experiment
+        the first time the theory is calculated, and redone when the total
+        thickness of the sample changes by more than *thickness_change*
+        relative to the thickness at the last refinement.  Fringe spacing
+        is inversely proportional to thickness, so smaller changes do not
+        need new points.  See :meth:`refine_calc_Q` for details.
+        """
+        self.adaptive = dict(tol=tol, min_step=min_step, max_passes=max_passes,
+                             thickness_change=thickness_change)
+        self._adaptive_thickness = None
+
+    def refine_calc_Q(self, theory, thickness=None):
+        """
+        Refine the calculation points for *theory* as set up by
+        :meth:`adaptive_oversample`.
+
+        *theory(Q)* returns the reflectivity at *Q*, without resolution,
+        using the same sign convention as *calc_Q*.  *thickness* is the
+        total sample thickness; if it is close to the thickness at the last
+        refinement then the current points are kept.
+
+        Returns True if the calculation points were changed.  The probe
+        *version* is only changed if the points are.
+        """
+        opts = self.adaptive
+        if opts is None:
+            raise ValueError("use adaptive_oversample() to set the tolerance")
+        last = self._adaptive_thickness
+        if (last is not None and thickness is not None
+                and abs(thickness - last) <= opts['thickness_change']*abs(last)):
+            return False
+
+        sign = -1 if self.back_reflectivity else 1
+        Q = numpy.unique(self.Qo)
+        R = theory(sign*Q)
+        for _ in range(opts['max_passes']):
+            mid = 0.5*(Q[1:] + Q[:-1])
+            local_dQ = numpy.interp(mid, self.Qo, self.dQ)
+            split = (Q[1:] - Q[:-1]) > opts['min_step']*local_dQ
+            if not split.any():
+                break
+            mid = mid[split]
+            R_mid = theory(sign*mid)
+            R_lin = 0.5*(R[1:] + R[:-1])[split]
+            err = abs(R_mid - R_lin)
+            bad = err > opts['tol']*numpy.maximum(abs(R_lin), 1e-300)
+            if not bad.any():
+                break
+            Q = numpy.hstack((Q, mid[bad]))
+            R = numpy.hstack((R, R_mid[bad]))
+            idx = numpy.argsort(Q)
+            Q, R = Q[idx], R[idx]
+
+        self._adaptive_thickness = thickness
+        if numpy.array_equal(Q, self.calc_Qo):
+            # Same points, so keep the probe version and the cached theory
+            return False
+        if getattr(self, 'T', None) is None:
+            # Pure Q probe
+            self.calc_Qo = Q
+        else:
+            # Use the wavelength of the nearest measurement so that the
+            # set of wavelengths, and the scattering factors, do not change.
+            nearest = numpy.clip(numpy.searchsorted(self.Qo, Q), 1, len(self.Qo)-1)
+            left = (Q - self.Qo[nearest-1]) < (self.Qo[nearest] - Q)
+            nearest[left] -= 1
+            L = self.L[nearest]
+            self._set_calc(QL2T(Q=Q, L=L), L)
+        return True
+
     def _apply_resolution(self, Qin, Rin, interpolation):
         """
         Apply the instrument resolution function
+
+        If *convolution* is 'fft' then probes with constant *dQ* or
+        constant *dQ/Q* use :func:`refl1d.reflectivity.convolve_fft`,
+        which falls back to the direct sum for other resolutions.
+
+        If *convolution* is 'matrix' then the resolution weights are built
+        once as a sparse matrix and the convolution is a matrix-vector
+        product.  The matrix is kept with the probe and rebuilt only when
+        the probe *version* changes, such as when *theta_offset* is fitted.
+        The cross sections of a polarized measurement on a common Q grid
+        share the matrix of the first cross section.
         """
         Q, dQ = _interpolate_Q(self.Q, self.dQ, interpolation)
-        R = convolve(Qin, Rin, Q, dQ)
+        if self.convolution == 'fft':
+            R = convolve_fft(Qin, Rin, Q, dQ)
+        elif self.convolution == 'matrix':
+            W = self._resolution_matrix(Qin, Q, dQ, interpolation)
+            R = W.dot(Rin).astype(Rin.dtype, copy=False)
+        else:
+            R = convolve(Qin, Rin, Q, dQ)
         return Q, R
 
-    def apply_beam(self, calc_Q, calc_R, resolution=True, interpolation=0):
+    def _resolution_matrix(self, Qin, Q, dQ, interpolation=0):
+        """
+        Return the sparse matrix convolving *Qin* to *Q* with resolution *dQ*.
+
+        The matrix is reused while *version* and *interpolation* are
+        unchanged and the theory is on the same *Qin*, which is checked
+        since probe sets evaluate each probe on their common grid.
+        """
+        key = self.version, interpolation
+        memo = self.__dict__.setdefault('_memo_cache', {})
+        cached = memo.get('resolution', None)
+        if (cached is None or cached[0] != key
+                or not numpy.array_equal(cached[1], Qin)):
+            W = convolve_matrix(Qin, Q, dQ)
+            cached = memo['resolution'] = key, numpy.array(Qin), W
+        return cached[2]
+
+    def apply_beam(self, calc_Q, calc_R, resolution=True, interpolation=0,
+                   scale=True):
         """
         Apply factors such as beam intensity, background, backabsorption,
         resolution to the data.
+
+        If *scale* is False, intensity and background are left for a later
+        call to :meth:`scale_beam`.
         """
         # Note: in-place vector operations are not notably faster.
 
         # Handle absorption through the substrate, which occurs when Q<0
         # (condition)*C is C when condition is True or 0 when False,
         # (condition)*(C-1)+1 is C when condition is True or 1 when False.
+        # The result keeps the precision of calc_R, so a single precision
+        # theory is convolved in single precision.
         back = (calc_Q < 0)*(self.back_absorption.value-1)+1
-        calc_R = calc_R * back
+        calc_R = calc_R * back.astype(calc_R.dtype, copy=False)
 
         # For back reflectivity, reverse the sign of Q after computing
         if self.back_reflectivity:
@@ -521,10 +760,19 @@ class Probe(object):
             # if it is a problem before optimizing.
             Q, dQ = _interpolate_Q(self.Q, self.dQ, interpolation)
             Q, R = self.Q, numpy.interp(Q, calc_Q, calc_R)
-        R = self.intensity.value*R + self.background.value
+        if scale:
+            Q, R = self.scale_beam((Q, R))
         #return calc_Q, calc_R
         return Q, R
 
+    def scale_beam(self, theory):
+        """
+        Apply beam intensity and background to the *(Q, R)* returned by
+        :meth:`apply_beam` with *scale=False*.
+        """
+        Q, R = theory
+        return Q, self.intensity.value*R + self.background.value
+
     def fresnel(self, substrate=None, surface=None):
         """
         Returns a Fresnel reflectivity calculator given the surface and
@@ -806,8 +1054,10 @@ class XrayProbe(Probe):
         # Note: the real density is calculated as a scale factor applied to
         # the returned sld as computed assuming density=1
         rho, irho = xsf.xray_sld(material,
-                                 wavelength=self.unique_L,
+                                 wavelength=self.sld_L,
                                  density=density)
+        if self.sld_columns is not None:
+            return rho, irho, 0
         # TODO: support wavelength dependent systems
         return rho[0], irho[0], 0
         #return rho[self._L_idx], irho[self._L_idx], 0
@@ -828,8 +1078,10 @@ class NeutronProbe(Probe):
         # Note: the real density is calculated as a scale factor applied to
         # the returned sld as computed assuming density=1
         rho, irho, rho_incoh = nsf.neutron_sld(material,
-                                               wavelength=self.unique_L,
+                                               wavelength=self.sld_L,
                                                density=density)
+        if self.sld_columns is not None:
+            return rho, irho, rho_incoh
         # TODO: support wavelength dependent systems
         return rho, irho[0], rho_incoh
         #return rho, irho[self._L_idx], rho_incoh
@@ -874,25 +1126,65 @@ class ProbeSet(Probe):
             offset += n
     simulate_data.__doc__ = Probe.simulate_data.__doc__
 
+    @property
+    def version(self):
+        return tuple(p.version for p in self.probes)
+    version.__doc__ = Probe.version.__doc__
+
+    def _union(self):
+        """
+        Combined Q, calc_Q, unique_L and the offset of each part in Q,
+        rebuilt only when the version of one of the probes changes.
+        """
+        version = self.version
+        if getattr(self, '_union_version', None) != version:
+            Q = [p.Q for p in self.probes]
+            self._union_cache = (
+                numpy.hstack(Q),
+                numpy.unique(numpy.hstack(p.calc_Q for p in self.probes)),
+                numpy.unique(numpy.hstack(p.unique_L for p in self.probes)),
+                numpy.cumsum([0] + [len(v) for v in Q]),
+                )
+            self._union_version = version
+        return self._union_cache
+
     @property
     def Q(self):
-        return numpy.hstack(p.Q for p in self.probes)
+        return self._union()[0]
 
     @property
     def calc_Q(self):
-        return numpy.unique(numpy.hstack(p.calc_Q for p in self.probes))
+        return self._union()[1]
 
     @property
     def unique_L(self):
-        return numpy.unique(numpy.hstack(p.unique_L for p in self.probes))
+        return self._union()[2]
 
     def oversample(self, **kw):
         for p in self.probes:
             p.oversample(**kw)
+
+    def resolution_guard(self, **kw):
+        return sum(p.resolution_guard(**kw) for p in self.probes)
+    resolution_guard.__doc__ = Probe.resolution_guard.__doc__
     oversample.__doc__ = Probe.oversample.__doc__
 
+    @property
+    def sld_L(self):
+        self._check_sld_columns()
+        return self.probes[0].sld_L
+
+    # TODO: support wavelength dependent systems
+    rho_index = None
+
+    def _check_sld_columns(self):
+        if (self.sld_columns is not None
+                or any(p.sld_columns is not None for p in self.probes)):
+            raise ValueError("sld_columns is not supported for ProbeSet")
+
     def scattering_factors(self, material, density):
         # TODO: support wavelength dependent systems
+        self._check_sld_columns()
         return self.probes[0].scattering_factors(material, density)
         # result = [p.scattering_factors(material, density) for p in self.probes]
         # return [numpy.hstack(v) for v in zip(*result)]
@@ -903,6 +1195,12 @@ class ProbeSet(Probe):
         Q, R = [numpy.hstack(v) for v in zip(*result)]
         return Q, R
 
+    def scale_beam(self, theory):
+        result = [p.scale_beam(th) for p, th in self.parts(theory)]
+        Q, R = [numpy.hstack(v) for v in zip(*result)]
+        return Q, R
+    scale_beam.__doc__ = Probe.scale_beam.__doc__
+
     def fresnel(self, *args, **kw):
         return self.probes[0].fresnel(*args, **kw)
     fresnel.__doc__ = Probe.fresnel.__doc__
@@ -958,12 +1256,10 @@ class ProbeSet(Probe):
             for p in self.probes:
                 yield p, None
         else:
-            offset = 0
+            offsets = self._union()[3]
             Q, R = theory
-            for p in self.probes:
-                n = len(p.Q)
-                yield p, (Q[offset:offset+n], R[offset:offset+n])
-                offset += n
+            for p, lo, hi in zip(self.probes, offsets[:-1], offsets[1:]):
+                yield p, (Q[lo:hi], R[lo:hi])
 
     def shared_beam(self, intensity=1, background=0,
                     back_absorption=1, theta_offset=0):
@@ -1302,6 +1598,9 @@ class PolarizedNeutronProbe(object):
     view = None  # Default to Probe.view so only need to change in one place
     substrate = surface = None
     polarized = True
+    _grid_version = 0
+    __setattr__ = _grid_setattr
+
     def __init__(self, xs=None, name=None, Aguide=270, H=0):
         self._xs = xs
 
@@ -1320,6 +1619,12 @@ class PolarizedNeutronProbe(object):
     def xs(self):
         return self._xs  # Don't let user replace xs
 
+    @property
+    def version(self):
+        return (self._grid_version,) + tuple(xsi.version if xsi else None
+                                             for xsi in self.xs)
+    version.__doc__ = Probe.version.__doc__
+
     @property
     def pp(self):
         return self.xs[3]
@@ -1411,6 +1716,19 @@ class PolarizedNeutronProbe(object):
         self._set_calc(T, L)
     oversample.__doc__ = Probe.oversample.__doc__
 
+    def resolution_guard(self, n=5, width=3):
+        # doc string is inherited from parent (see below)
+        Q, index = _guard_points(self.Q, self.dQ, self.calc_Qo, n, width)
+        if len(Q):
+            if getattr(self, 'T', None) is None:
+                self.calc_Qo = numpy.sort(numpy.hstack((self.calc_Qo, Q)))
+            else:
+                L = self.L[index]
+                self._set_calc(numpy.hstack((self.calc_T, QL2T(Q=Q, L=L))),
+                               numpy.hstack((self.calc_L, L)))
+        return len(Q)
+    resolution_guard.__doc__ = Probe.resolution_guard.__doc__
+
     @property
     def calc_Q(self):
         return self.calc_Qo
@@ -1428,14 +1746,77 @@ class PolarizedNeutronProbe(object):
         self.unique_L = numpy.unique(self.calc_L)
         self._L_idx = numpy.searchsorted(self.unique_L, L)
 
-    def apply_beam(self, Q, R, resolution=True, interpolation=0):
+    def apply_beam(self, Q, R, resolution=True, interpolation=0, scale=True):
         """
         Apply factors such as beam intensity, background, backabsorption,
         and footprint to the data.
+
+        When the measured cross sections share the same Q grid and all use
+        *convolution = 'matrix'*, the resolution is applied to all of them
+        at once using a single resolution matrix.
+
+        If *scale* is False, intensity and background are left for a later
+        call to :meth:`scale_beam`.
         """
-        return [(xs.apply_beam(Q, Ri, resolution, interpolation) if xs else None)
+        if resolution and interpolation == 0 and self._shared_grid():
+            return self._apply_beam_fused(Q, R, scale)
+        return [(xs.apply_beam(Q, Ri, resolution, interpolation, scale)
+                 if xs else None)
                 for xs, Ri in zip(self.xs, R)]
 
+    def scale_beam(self, theory):
+        return [(xs.scale_beam(th) if xs else None)
+                for xs, th in zip(self.xs, theory)]
+    scale_beam.__doc__ = Probe.scale_beam.__doc__
+
+    def _shared_grid(self):
+        """
+        True if the measured cross sections share Q, dQ and beam geometry,
+        and all use the resolution matrix.
+
+        Cross sections with the direct or FFT engines are convolved
+        separately.  The answer is cached until the version or convolution
+        engine of a cross section changes.
+        """
+        version = self.version, tuple(xsi.convolution if xsi else None
+                                      for xsi in self.xs)
+        if getattr(self, '_shared_version', None) != version:
+            xs = [xsi for xsi in self.xs if xsi is not None]
+            first = xs[0]
+            self._shared = all(
+                xsi.convolution == 'matrix'
+                and xsi.back_reflectivity == first.back_reflectivity
+                and numpy.array_equal(xsi.Q, first.Q)
+                and numpy.array_equal(xsi.dQ, first.dQ)
+                for xsi in xs)
+            self._shared_version = version
+        return self._shared
+
+    def _apply_beam_fused(self, calc_Q, calc_R, scale=True):
+        """
+        Apply the beam to the measured cross sections as one block.
+
+        This follows :meth:`Probe.apply_beam` for each cross section, with
+        the rows of the block convolved by one sparse matrix product.
+        """
+        index = [k for k, xsi in enumerate(self.xs) if xsi is not None]
+        xs = [self.xs[k] for k in index]
+        block = numpy.array([calc_R[k] for k in index])
+        back = numpy.array([(calc_Q < 0)*(xsi.back_absorption.value-1)+1
+                            for xsi in xs])
+        block = block * back.astype(block.dtype, copy=False)
+        if xs[0].back_reflectivity:
+            calc_Q = -calc_Q
+        if calc_Q[-1] < calc_Q[0]:
+            calc_Q, block = calc_Q[::-1], block[:, ::-1]
+        Q = xs[0].Q
+        W = xs[0]._resolution_matrix(calc_Q, Q, xs[0].dQ)
+        block = W.dot(block.T).T.astype(block.dtype, copy=False)
+        result = [None]*len(self.xs)
+        for k, xsi, Rk in zip(index, xs, block):
+            result[k] = xsi.scale_beam((Q, Rk)) if scale else (Q, Rk)
+        return result
+
     def fresnel(self, *args, **kw):
         return self.pp.fresnel(*args, **kw)
     fresnel.__doc__ = Probe.fresnel.__doc__
@@ -1629,6 +2010,41 @@ def _interpolate_Q(Q, dQ, n):
         dQ = numpy.interp(subindex, index, dQ)
     return Q, dQ
 
+def _guard_points(Q, dQ, calc_Q, n, width):
+    """
+    Helper function for resolution_guard.
+
+    Returns the calculation points needed so that each *Q* has *n* points
+    of the sorted *calc_Q* within *width* x *dQ*, and the index of the
+    measurement each new point belongs to.
+    """
+    calc = list(calc_Q)
+    new_Q, index = [], []
+    # Half the points on each side of Q, otherwise the measurements at the
+    # ends of the range only see theory on the inside.
+    half = (n + 1)//2
+    for k in numpy.argsort(Q):
+        if dQ[k] <= 0:
+            continue
+        for lo, hi in ((Q[k] - width*dQ[k], Q[k]), (Q[k], Q[k] + width*dQ[k])):
+            start = bisect.bisect_left(calc, lo)
+            stop = bisect.bisect_right(calc, hi)
+            if stop - start >= half:
+                continue
+            # Fill in by bisecting the largest gap in the window, including
+            # the gaps to the window edges.
+            edges = [lo] + calc[start:stop] + [hi]
+            for _ in range(half - (stop - start)):
+                gaps = numpy.diff(edges)
+                j = int(numpy.argmax(gaps))
+                q = edges[j] + 0.5*gaps[j]
+                edges.insert(j+1, q)
+                bisect.insort(calc, q)
+                new_Q.append(q)
+                index.append(k)
+    return numpy.array(new_Q, 'd'), numpy.array(index, 'i')
+
+
 class PolarizedQProbe(PolarizedNeutronProbe):
     polarized = True
     def __init__(self, xs=None, name=None, Aguide=270, H=0):
@@ -63,6 +63,8 @@ import numpy as np
 from numpy import inf, nan, isnan
 from scipy.special import erf
 
+from .reflectivity import _reflmodule
+
 
 class Microslabs(object):
     """
@@ -77,20 +79,34 @@ class Microslabs(object):
     parameter of dz for the step size within the layer.
 
     The space for the slabs is saved even after reset, in preparation for a
-    new set of slabs from different fitting parameters.
-
+    new set of slabs from different fitting parameters.  The buffers at
+    least double when they need to grow, and *w*, *sigma* and each row of
+    *rho* and *irho* are contiguous views into them, so a model which
+    renders to a similar number of slabs on each evaluation stops allocating
+    after the first few and its slabs are passed to the reflectivity kernel
+    without copying.  The counter *allocations* records the number of times
+    a slab or scratch buffer was allocated.
+
+    The slabs are stored with the given *dtype*.  Use 'f' to build the
+    profile in single precision.
     """
 
-    def __init__(self, nprobe, dz=1):
+    def __init__(self, nprobe, dz=1, dtype='d'):
         self._num_slabs = 0
-        # _slabs contains the 1D objects w, sigma of len n
-        # _slabs_rho contains 2D objects rho, irho, with one for each wavelength
-        # rhoM, thetaM will contain magnetic moment and angle
-        self._slabs = np.empty(shape=(0, 2))
-        self._slabs_rho = np.empty(shape=(0, nprobe, 2))
-        self.rhoM = None  # type: np.ndarray
-        self.thetaM = None  # type: np.ndarray
-        self._slabs_mag = np.empty(shape=(0, nprobe, 2))
+        # _w, _sigma contain the 1D objects w, sigma, with room for _capacity
+        # _rho, _irho contain 2D objects rho, irho, with one for each wavelength
+        # _rhoM, _thetaM contain magnetic moment and angle once aligned
+        self.dtype = np.dtype(dtype)
+        self.allocations = 0
+        self._capacity = 0
+        self._w = np.empty(0, self.dtype)
+        self._sigma = np.empty(0, self.dtype)
+        self._rho = np.empty((nprobe, 0), self.dtype)
+        self._irho = np.empty((nprobe, 0), self.dtype)
+        self._rhoM = np.empty(0, self.dtype)
+        self._thetaM = np.empty(0, self.dtype)
+        self._magnetic_aligned = False
+        self._work = {}
         self.dz = dz
         self._magnetic_sections = []
         self._z_left = self._z_right = 0.
@@ -118,18 +134,29 @@ class Microslabs(object):
         """
         # TODO: force dz onto a common boundary to avoid remeshing
         # in the smooth profile function
-        edges = np.arange(0, thickness + self.dz, self.dz, dtype='d')
+        edges = np.arange(0, thickness + self.dz, self.dz, dtype=self.dtype)
         edges[-1] = thickness
         centers = (edges[1:] + edges[:-1]) / 2
         widths = edges[1:] - edges[:-1]
         return widths, centers
 
-    def clear(self):
+    def clear(self, dtype=None):
         """
         Reset the slab model so that none are present.
+
+        If *dtype* differs from the current type then the buffers are
+        released and reallocated with the new type as the slabs are added.
         """
+        if dtype is not None and np.dtype(dtype) != self.dtype:
+            self.dtype = np.dtype(dtype)
+            self._capacity = 0
+            for name in ('_w', '_sigma', '_rho', '_irho', '_rhoM', '_thetaM'):
+                old = getattr(self, name)
+                setattr(self, name, np.empty(old.shape[:-1] + (0,), self.dtype))
+            self._work = {}
         self._num_slabs = 0
         self._magnetic_sections = []
+        self._magnetic_aligned = False
 
     def __len__(self):
         return self._num_slabs
@@ -151,12 +178,12 @@ class Microslabs(object):
         fromidx = slice(start, end)
         toidx = slice(end, end + repeats * length)
         self._reserve(repeats * length)
-        self._slabs[toidx] = np.tile(self._slabs[fromidx], [repeats, 1])
-        self._slabs_rho[toidx] = np.tile(self._slabs_rho[fromidx], [repeats, 1, 1])
+        for v in (self._w, self._sigma, self._rho, self._irho):
+            v[..., toidx] = np.tile(v[..., fromidx], repeats)
         self._num_slabs += repeats * length
 
         # Replace interface on the top
-        self._slabs[self._num_slabs - 1, 1] = interface
+        self._sigma[self._num_slabs - 1] = interface
 
         if self._magnetic_sections:
             raise NotImplementedError("Repeated magnetic layers not implemented")
@@ -165,13 +192,29 @@ class Microslabs(object):
         """
         Reserve space for at least *nadd* slabs.
         """
-        ns, nl, _ = self._slabs_rho.shape
-        if ns < self._num_slabs + nadd:
-            new_ns = self._num_slabs + nadd + 50
-            self._slabs = self._slabs.copy()
-            self._slabs.resize((new_ns, 4))
-            self._slabs_rho = self._slabs_rho.copy()
-            self._slabs_rho.resize((new_ns, nl, 2))
+        n = self._num_slabs
+        if self._capacity < n + nadd:
+            capacity = max(n + nadd, 2*self._capacity, 64)
+            for name in ('_w', '_sigma', '_rho', '_irho', '_rhoM', '_thetaM'):
+                old = getattr(self, name)
+                new = np.empty(old.shape[:-1] + (capacity,), self.dtype)
+                new[..., :n] = old[..., :n]
+                setattr(self, name, new)
+            self._capacity = capacity
+            self.allocations += 1
+
+    def _workspace(self, name, size, dtype=None):
+        """
+        Scratch buffer of *size* elements, reused between renderings.
+        """
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        buffer = self._work.get(name, None)
+        if buffer is None or len(buffer) < size or buffer.dtype != dtype:
+            old_size = len(buffer) if buffer is not None else 0
+            buffer = np.empty(max(size, 2*old_size, 64), dtype)
+            self._work[name] = buffer
+            self.allocations += 1
+        return buffer[:size]
 
     def extend(self, w=0, sigma=0, rho=0, irho=0):
         """
@@ -181,10 +224,10 @@ class Microslabs(object):
         self._reserve(nadd)
         idx = slice(self._num_slabs, self._num_slabs + nadd)
         self._num_slabs += nadd
-        self._slabs[idx, 0] = w
-        self._slabs[idx, 1] = sigma
-        self._slabs_rho[idx, :, 0] = np.asarray(rho).T
-        self._slabs_rho[idx, :, 1] = np.asarray(irho).T
+        self._w[idx] = w
+        self._sigma[idx] = sigma
+        self._rho[:, idx] = rho
+        self._irho[:, idx] = irho
 
     def append(self, w=0, sigma=0, rho=0, irho=0):
         """
@@ -193,10 +236,10 @@ class Microslabs(object):
         #self.extend(w=[w], sigma=[sigma], rho=[rho], irho=[irho])
         #return
         self._reserve(1)
-        self._slabs[self._num_slabs, 0] = w
-        self._slabs[self._num_slabs, 1] = sigma
-        self._slabs_rho[self._num_slabs, :, 0] = rho
-        self._slabs_rho[self._num_slabs, :, 1] = irho
+        self._w[self._num_slabs] = w
+        self._sigma[self._num_slabs] = sigma
+        self._rho[:, self._num_slabs] = rho
+        self._irho[:, self._num_slabs] = irho
         self._num_slabs += 1
 
     def add_magnetism(self, anchor, w, rhoM=0, thetaM=270., sigma=0):
@@ -217,32 +260,42 @@ class Microslabs(object):
         surface layers.  Normally these will be zero, but the contract
         profile operation may result in large values for either.
         """
-        return np.sum(self._slabs[1:self._num_slabs, 0])
+        return np.sum(self._w[1:self._num_slabs])
 
     @property
     def w(self):
         "Thickness (A)"
-        return self._slabs[:self._num_slabs, 0]
+        return self._w[:self._num_slabs]
 
     @property
     def sigma(self):
         "rms roughness (A)"
-        return self._slabs[:self._num_slabs - 1, 1]
+        return self._sigma[:self._num_slabs - 1]
 
     @property
     def surface_sigma(self):
         "roughness for the current top layer, or nan if substrate"
-        return self._slabs[self._num_slabs - 1, 1] if self._num_slabs > 0 else nan
+        return self._sigma[self._num_slabs - 1] if self._num_slabs > 0 else nan
 
     @property
     def rho(self):
         "Scattering length density (10^-6 number density)"
-        return self._slabs_rho[:self._num_slabs, :, 0].T
+        return self._rho[:, :self._num_slabs]
 
     @property
     def irho(self):
         "Absorption (10^-6 number density)"
-        return self._slabs_rho[:self._num_slabs, :, 1].T
+        return self._irho[:, :self._num_slabs]
+
+    @property
+    def rhoM(self):
+        "Magnetic scattering length density, or None before finalize"
+        return self._rhoM[:self._num_slabs] if self._magnetic_aligned else None
+
+    @property
+    def thetaM(self):
+        "Magnetic angle (degrees), or None before finalize"
+        return self._thetaM[:self._num_slabs] if self._magnetic_aligned else None
 
     @property
     def ismagnetic(self):
@@ -320,7 +373,7 @@ class Microslabs(object):
         Add magnetic information to the nuclear slabs, introducing new
         slabs as necessary where magnetic and nuclear do not match.
         """
-        from .reflmodule import _align_magnetic
+        _align_magnetic = _reflmodule()._align_magnetic
 
         # Nuclear profile (one wavelength only)
         #if self.rho.shape[0] != 1:
@@ -335,18 +388,20 @@ class Microslabs(object):
             np.ascontiguousarray(v, 'd')
             for v in (w, sigma, rho, irho, wM, sigmaM, rhoM, thetaM)
             ]
-        output = np.empty((len(w)+len(wM), 6), 'd')
+        size = len(w) + len(wM)
+        output = self._workspace('align', 6*size, 'd').reshape(size, 6)
         n = _align_magnetic(w, sigma, rho, irho, wM, sigmaM, rhoM, thetaM, output)
 
         # Store the resulting profile
         self._reserve(n - self._num_slabs)  # make sure there is space
         self._num_slabs = n
+        self._magnetic_aligned = True
         self.w[:] = output[:n, 0]
         self.sigma[:] = output[:n-1, 1]
         self.rho[0][:] = output[:n, 2]
         self.irho[0][:] = output[:n, 3]
-        self.rhoM = output[:n, 4]
-        self.thetaM = output[:n, 5]
+        self.rhoM[:] = output[:n, 4]
+        self.thetaM[:] = output[:n, 5]
 
     def _render_interfaces(self):
         """
@@ -359,64 +414,86 @@ class Microslabs(object):
         better performance on models with large sections of constant
         scattering potential.
         """
-        z = np.arange(self._z_left, self._z_right + 0.5*self.dz, self.dz)
+        z = np.arange(self._z_left, self._z_right + 0.5*self.dz, self.dz,
+                      dtype=self.dtype)
         n_slabs = len(z)
         n_profiles = self.rho.shape[0]
         offsets = np.cumsum(self.w[:-1])  # assumes w[0] == 0 in _set_z_range
 
-        # generate profiles
-        rho = np.empty((n_profiles, n_slabs), 'd')
-        irho = np.empty((n_profiles, n_slabs), 'd')
-        for k in range(n_profiles):
-            # Gd support: cycle through wavelength dependent rho/irho
-            rho[k] = build_profile(z, offsets, self.sigma, self.rho[k])
-            irho[k] = build_profile(z, offsets, self.sigma, self.irho[k])
+        # The profile is rendered into the slab buffers, so first move the
+        # step profile it is computed from into scratch space.
+        n = self._num_slabs
+        steps = [self.sigma] + list(self.rho) + list(self.irho)
         if self.ismagnetic:
-            rhoM = build_profile(z, offsets, self.sigma, self.rhoM)
-            thetaM = build_profile(z, offsets, self.sigma, self.thetaM)
-
-        w = self.dz * np.ones(n_slabs)
-        w[0] = w[-1] = 0.
+            steps += [self.rhoM, self.thetaM]
+        saved = self._workspace('steps', len(steps)*n).reshape(len(steps), n)
+        sigma, values = saved[0, :n-1], saved[1:]
+        for row, v in zip(saved, steps):
+            row[:len(v)] = v
 
         # update slabs
         self._reserve(n_slabs - self._num_slabs)
         self._num_slabs = n_slabs
-        self.w[:] = w
+        self.w[:] = self.dz
+        self.w[0] = self.w[-1] = 0.
         self.sigma[:] = 0
-        self.rho[:,:] = rho
-        self.irho[:,:] = irho
+
+        # generate profiles, including wavelength dependent rho/irho for Gd
+        profiles = build_profile(z, offsets, sigma, values)
+        self.rho[:] = profiles[:n_profiles]
+        self.irho[:] = profiles[n_profiles:2*n_profiles]
         if self.ismagnetic:
-            self.rhoM = rhoM
-            self.thetaM = thetaM
+            self.rhoM[:] = profiles[-2]
+            self.thetaM[:] = profiles[-1]
         self._z_offset = self._z_left
 
     def _contract_profile(self, dA):
-        from .reflmodule import _contract_by_area
+        _contract_by_area = _reflmodule()._contract_by_area
 
         if dA is None:
             return
 
-        # TODO: need a separate implementation for multiple wavelengths
         if self.rho.shape[0] > 1:
-            # Note: should at least check for duplicates otherwise thick
-            # layers will get extremely slow
+            self._contract_multi(dA)
             return
 
-        w, sigma, rho, irho = [
-            np.ascontiguousarray(v, 'd')
-            for v in (self.w, self.sigma, self.rho[0], self.irho[0])
-            ]
+        # Double precision slabs are contracted in place
+        slabs = (self.w, self.sigma, self.rho[0], self.irho[0])
+        w, sigma, rho, irho = [np.ascontiguousarray(v, 'd') for v in slabs]
         #print "final sld before contract", rho[-1]
         n = _contract_by_area(w, sigma, rho, irho, dA)
         self._num_slabs = n
-        self.w[:] = w[:n]
-        self.rho[0, :] = rho[:n]
-        self.irho[0, :] = irho[:n]
-        self.sigma[:] = sigma[:n-1]
+        if w is not slabs[0]:
+            self.w[:] = w[:n]
+            self.rho[0, :] = rho[:n]
+            self.irho[0, :] = irho[:n]
+            self.sigma[:] = sigma[:n-1]
         #print "final sld after contract", rho[n-1], self.rho[0][n-1], n
 
+    def _contract_multi(self, dA):
+        """
+        Contract wavelength dependent slabs using the worst case area
+        over all wavelengths.
+        """
+        _contract_by_area_multi = _reflmodule()._contract_by_area_multi
+
+        n = self._num_slabs
+        slabs = (self.w, self.sigma)
+        w, sigma = [np.ascontiguousarray(v, 'd') for v in slabs]
+        rho = self._workspace('contract_rho', self.rho.size, 'd')
+        irho = self._workspace('contract_irho', self.irho.size, 'd')
+        rho, irho = rho.reshape(-1, n), irho.reshape(-1, n)
+        rho[:], irho[:] = self.rho, self.irho
+        n = _contract_by_area_multi(w, sigma, rho, irho, dA)
+        self._num_slabs = n
+        self.rho[:] = rho[:, :n]
+        self.irho[:] = irho[:, :n]
+        if w is not slabs[0]:
+            self.w[:] = w[:n]
+            self.sigma[:] = sigma[:n-1]
+
     def _contract_magnetic(self, dA):
-        from .reflmodule import _contract_mag
+        _contract_mag = _reflmodule()._contract_mag
 
         if dA is None:
             return
@@ -427,18 +504,21 @@ class Microslabs(object):
             # layers will get extremely slow
             return
 
+        # Double precision slabs are contracted in place
+        slabs = (self.w, self.sigma, self.rho[0], self.irho[0],
+                 self.rhoM, self.thetaM)
         w, sigma, rho, irho, rhoM, thetaM = \
-            [np.ascontiguousarray(v, 'd')
-             for v in (self.w, self.sigma, self.rho[0], self.irho[0], self.rhoM, self.thetaM)]
+            [np.ascontiguousarray(v, 'd') for v in slabs]
         #print "final sld before contract", rho[-1]
         n = _contract_mag(w, sigma, rho, irho, rhoM, thetaM, dA)
         self._num_slabs = n
-        self.w[:] = w[:n]
-        self.rho[0][:] = rho[:n]
-        self.irho[0][:] = irho[:n]
-        self.rhoM = rhoM[:n]
-        self.thetaM = thetaM[:n]
-        self.sigma[:] = sigma[:n-1]
+        if w is not slabs[0]:
+            self.w[:] = w[:n]
+            self.rho[0][:] = rho[:n]
+            self.irho[0][:] = irho[:n]
+            self.rhoM[:] = rhoM[:n]
+            self.thetaM[:] = thetaM[:n]
+            self.sigma[:] = sigma[:n-1]
         #self.sigma[:] = 0
         #print "final sld after contract", rho[n-1], self.rho[0][n-1], n
 
@@ -510,8 +590,8 @@ class Microslabs(object):
         """
         z = np.arange(self._z_left, self._z_right + 0.5*dz, dz)
         offsets = np.cumsum(self.w) + self._z_offset
-        irho = build_profile(z, offsets, self.sigma, self.irho[0])
-        rho = build_profile(z, offsets, self.sigma, self.rho[0])
+        rho, irho = build_profile(z, offsets, self.sigma,
+                                  [self.rho[0], self.irho[0]])
         return z, rho, irho
 
     def magnetic_smooth_profile(self, dz=0.1):
@@ -520,10 +600,9 @@ class Microslabs(object):
         """
         z = np.arange(self._z_left, self._z_right + 0.5*dz, dz)
         offsets = np.cumsum(self.w) + self._z_offset
-        irho = build_profile(z, offsets, self.sigma, self.irho[0])
-        rho = build_profile(z, offsets, self.sigma, self.rho[0])
-        rhoM = build_profile(z, offsets, self.sigma, self.rhoM)
-        thetaM = build_profile(z, offsets, self.sigma, self.thetaM)
+        rho, irho, rhoM, thetaM = build_profile(
+            z, offsets, self.sigma,
+            [self.rho[0], self.irho[0], self.rhoM, self.thetaM])
         return z, rho, irho, rhoM, thetaM
 
     def _join_magnetic_sections(self, gap_size):
@@ -608,6 +687,10 @@ def compute_limited_sigma(thickness, roughness, limit):
     return roughness
 
 
+# Interfaces are evaluated within BLEND_WIDTH sigma of the offset; beyond
+# that erf is within 1e-15 of its limit.
+BLEND_WIDTH = 8.
+
 def build_profile(z, offset, roughness, value):
     """
     Convert a step profile to a smooth profile.
@@ -616,13 +699,60 @@ def build_profile(z, offset, roughness, value):
     *offset*     offset for each interface
     *roughness*  roughness of each interface
     *value*      target value for each slab
-    *max_rough*  limit the roughness to a fraction of the layer thickness
+
+    *value* may be a matrix with one row for each profile, such as rho
+    and irho for each wavelength, in which case the result has one row for
+    each profile.  The profiles share the interfaces.
+
+    For sorted *z* and *offset*, the profile is the step profile plus the
+    blend of each rough interface within *BLEND_WIDTH* sigma of its offset,
+    so the cost is proportional to the number of points in the interfaces
+    rather than the number of interfaces times the number of points.
+    """
+    value = np.asarray(value)
+    contrast = np.diff(value)
+    n = contrast.shape[-1]
+    offset, roughness = np.asarray(offset)[:n], np.asarray(roughness)[:n]
+    if (len(offset) < n or (np.diff(z) < 0).any()
+            or (np.diff(offset) < 0).any()):
+        return _build_profile_direct(z, offset, roughness, value)
+
+    # Step profile: a point at or beyond an offset takes the next value
+    result = value[..., np.searchsorted(offset, z, 'right')].astype(
+        np.result_type(z, value))
+
+    # Within each interface add the blend less the step
+    rough = np.nonzero(roughness > 0)[0]
+    if len(rough) == 0:
+        return result
+    lo = np.searchsorted(z, offset[rough] - BLEND_WIDTH*roughness[rough])
+    hi = np.searchsorted(z, offset[rough] + BLEND_WIDTH*roughness[rough])
+    counts = hi - lo
+    k = np.repeat(rough, counts)
+    index = np.arange(len(k)) - np.repeat(np.cumsum(counts) - counts, counts) \
+        + np.repeat(lo, counts)
+    zk = z[index] - offset[k]
+    delta = 0.5*erf(SQRT1_2*zk/roughness[k]) + 0.5 - (zk >= 0)
+    if result.ndim == 1:
+        result += np.bincount(index, weights=contrast[k]*delta,
+                              minlength=len(z))
+    else:
+        for row, contrast_row in zip(result, contrast):
+            row += np.bincount(index, weights=contrast_row[k]*delta,
+                               minlength=len(z))
+    return result
+
+
+def _build_profile_direct(z, offset, roughness, value):
+    """
+    Sum the blend of every interface over every point.
     """
     contrast = np.diff(value)
-    result = np.zeros_like(z) + value[0]
-    for offset_k, sigma_k, contrast_k in zip(offset, roughness, contrast):
-        delta = contrast_k * blend(z, sigma_k, offset_k)
-        result += delta
+    result = np.zeros(np.shape(value)[:-1] + np.shape(z),
+                      np.result_type(z, value))
+    result += value[..., :1]
+    for k, (offset_k, sigma_k) in enumerate(zip(offset, roughness)):
+        result += contrast[..., k:k+1] * blend(z, sigma_k, offset_k)
     return result
 
 
@@ -16,10 +16,17 @@ from six.moves import reduce
 #__doc__ = "Fundamental reflectivity calculations"
 __author__ = "Paul Kienzle"
 __all__ = ['reflectivity', 'reflectivity_amplitude',
+           'reflectivity_amplitude_batch', 'reflectivity_amplitude_gradient',
+           'TransferMatrixCache',
            'magnetic_reflectivity', 'magnetic_amplitude',
-           'unpolarized_magnetic', 'convolve',
+           'unpolarized_magnetic', 'convolve', 'convolve_fft',
+           'convolve_matrix',
+           'set_num_threads', 'get_num_threads', 'set_backend',
           ]
 
+import os
+import warnings
+
 import numpy as np
 from numpy import pi, sin, cos, conj, radians
 # delay load so doc build doesn't require compilation
@@ -28,6 +35,65 @@ from numpy import pi, sin, cos, conj, radians
 def _dense(x, dtype='d'):
     return np.ascontiguousarray(x, dtype)
 
+_BACKEND = None
+def set_backend(name=None):
+    """
+    Select the low level reflectivity calculator.
+
+    *name* is "c" for the compiled reflmodule extension or "numpy" for
+    the pure numpy version in :mod:`refl1d.reflmodule_numpy`.  If *name* is
+    not given, use the REFL1D_BACKEND environment variable, or "c" if it is
+    not set.  If the extension is not available, fall back to numpy with
+    a warning.
+    """
+    global _BACKEND
+    if name is None:
+        name = os.environ.get('REFL1D_BACKEND', 'c')
+    if name == 'c':
+        try:
+            from . import reflmodule as module
+        except ImportError as exc:
+            warnings.warn("reflmodule not available (%s); using numpy" % exc)
+            from . import reflmodule_numpy as module
+    elif name == 'numpy':
+        from . import reflmodule_numpy as module
+    else:
+        raise ValueError("unknown reflectivity backend %r" % name)
+    _BACKEND = module
+
+def _reflmodule():
+    """
+    Return the reflectivity calculator, loading it on first use.
+    """
+    if _BACKEND is None:
+        set_backend()
+    return _BACKEND
+
+
+def set_num_threads(n):
+    """
+    Set the number of threads used to compute the reflectivity amplitude
+    and the resolution convolution.
+
+    The Q points are split evenly across the threads, and the python
+    global interpreter lock is released while the calculation runs, so
+    experiments can also be evaluated concurrently from a thread pool.
+    The default is a single thread, so that fits running one process per
+    core do not oversubscribe the machine, unless the OMP_NUM_THREADS
+    environment variable is set.
+
+    This has no effect if the extension was compiled without OpenMP.
+    """
+    reflmodule = _reflmodule()
+    reflmodule._set_num_threads(int(n))
+
+def get_num_threads():
+    """
+    Return the number of threads used to compute the reflectivity amplitude
+    and the resolution convolution.
+    """
+    reflmodule = _reflmodule()
+    return reflmodule._get_num_threads()
 
 def reflectivity(*args, **kw):
     """
@@ -66,6 +132,7 @@ def reflectivity_amplitude(kz=None,
                            irho=0,
                            sigma=0,
                            rho_index=None,
+                           precision='double',
                           ):
     r"""
     Calculate reflectivity amplitude $r(k_z)$ from slab model.
@@ -87,6 +154,9 @@ def reflectivity_amplitude(kz=None,
             Points at which to evaluate the reflectivity
         *rho_index* = 0 : integer[M]
             *rho* and *irho* columns to use for the various kz.
+        *precision* = 'double' : string
+            Use 'single' to compute in single precision, returning
+            complex64.  This is faster but only accurate to about 1e-5.
 
     :Returns:
         *r* | complex[M]
@@ -94,7 +164,81 @@ def reflectivity_amplitude(kz=None,
 
     This function does not compute any instrument resolution corrections.
     """
-    from . import reflmodule
+    reflmodule = _reflmodule()
+    if precision not in ('double', 'single'):
+        raise ValueError("precision should be 'double' or 'single'")
+    real, cplx = ('d', 'D') if precision == 'double' else ('f', 'F')
+
+    kz = _dense(kz, real)
+    if rho_index is None:
+        rho_index = np.zeros(kz.shape, 'i')
+    else:
+        rho_index = _dense(rho_index, 'i')
+
+    depth = _dense(depth, real)
+    if np.isscalar(sigma):
+        sigma = sigma*np.ones(len(depth)-1, real)
+    else:
+        sigma = _dense(sigma, real)
+    rho = _dense(rho, real)
+    if np.isscalar(irho):
+        irho = irho * np.ones_like(rho)
+    else:
+        irho = _dense(irho, real)
+
+    #print depth.shape, rho.shape, irho.shape, sigma.shape
+    #print depth.dtype, rho.dtype, irho.dtype, sigma.dtype
+    r = np.empty(kz.shape, cplx)
+    #print "amplitude", depth, rho, kz, rho_index
+    #print depth.shape, sigma.shape, rho.shape, irho.shape, kz.shape
+    if precision == 'double':
+        reflmodule._reflectivity_amplitude(depth, sigma, rho, irho, kz,
+                                           rho_index, r)
+    else:
+        reflmodule._reflectivity_amplitude_single(depth, sigma, rho, irho, kz,
+                                                  rho_index, r)
+    return r
+
+
+def reflectivity_amplitude_batch(kz=None,
+                                 depth=None,
+                                 rho=None,
+                                 irho=0,
+                                 sigma=0,
+                                 rho_index=None,
+                                ):
+    r"""
+    Calculate reflectivity amplitude $r(k_z)$ for a population of slab models.
+
+    The models are evaluated in a single call to the kernel, which avoids
+    the per-call overhead of :func:`reflectivity_amplitude` when there are
+    many small models to evaluate, such as the population in a DE or DREAM
+    fit.  All models must have the same number of layers.  Models with
+    fewer layers can be padded by repeating the surface layer with zero
+    thickness and zero roughness, which does not change the reflectivity.
+
+    :Parameters :
+        *depth* : float[P, N] | |Ang|
+            Thickness of the individual layers for each of the *P* models.
+        *sigma* = 0 : float OR float[P, N-1] | |Ang|
+            Interface roughness between the current layer and the next.
+        *rho*, *irho* = 0: float[P, N] OR float[P, K, N] | |1e-6/Ang^2|
+            Real and imaginary scattering length density for each model,
+            with *K* columns when the scattering length density depends
+            on kz.
+        *kz* : float[M] | |1/Ang|
+            Points at which to evaluate the reflectivity, shared by all
+            models.
+        *rho_index* = 0 : integer[M]
+            *rho* and *irho* columns to use for the various kz.
+
+    :Returns:
+        *r* | complex[P, M]
+            Complex reflectivity waveform for each model.
+
+    This function does not compute any instrument resolution corrections.
+    """
+    reflmodule = _reflmodule()
 
     kz = _dense(kz, 'd')
     if rho_index is None:
@@ -103,8 +247,11 @@ def reflectivity_amplitude(kz=None,
         rho_index = _dense(rho_index, 'i')
 
     depth = _dense(depth, 'd')
+    if depth.ndim != 2:
+        raise ValueError("depth must be a population x layers array")
+    npop, nlayers = depth.shape
     if np.isscalar(sigma):
-        sigma = sigma*np.ones(len(depth)-1, 'd')
+        sigma = sigma*np.ones((npop, nlayers-1), 'd')
     else:
         sigma = _dense(sigma, 'd')
     rho = _dense(rho, 'd')
@@ -113,16 +260,183 @@ def reflectivity_amplitude(kz=None,
     else:
         irho = _dense(irho, 'd')
 
-    #print depth.shape, rho.shape, irho.shape, sigma.shape
-    #print depth.dtype, rho.dtype, irho.dtype, sigma.dtype
-    r = np.empty(kz.shape, 'D')
-    #print "amplitude", depth, rho, kz, rho_index
-    #print depth.shape, sigma.shape, rho.shape, irho.shape, kz.shape
-    reflmodule._reflectivity_amplitude(depth, sigma, rho, irho, kz,
-                                       rho_index, r)
+    r = np.empty((npop, len(kz)), 'D')
+    reflmodule._reflectivity_amplitude_batch(depth, sigma, rho, irho, kz,
+                                             rho_index, r)
     return r
 
 
+def reflectivity_amplitude_gradient(kz=None,
+                                    depth=None,
+                                    rho=None,
+                                    irho=0,
+                                    sigma=0,
+                                    rho_index=None,
+                                   ):
+    r"""
+    Calculate reflectivity amplitude $r(k_z)$ from slab model and its
+    derivatives with respect to the slab parameters.
+
+    The derivatives are computed analytically from the transfer matrices
+    at a cost of about three amplitude calculations, independent of the
+    number of layers.
+
+    :Parameters :
+        *depth*, *sigma*, *rho*, *irho*, *kz*, *rho_index* :
+            As for :func:`reflectivity_amplitude`.
+
+    :Returns:
+        *r* | complex[M]
+            Complex reflectivity waveform.
+        *dr_ddepth*, *dr_drho*, *dr_dirho* | complex[M, N]
+            Derivative of *r* with respect to the depth and scattering
+            length density of each layer.  For kz-dependent scattering
+            length density, this is the derivative with respect to the
+            column selected by *rho_index*.
+        *dr_dsigma* | complex[M, N-1]
+            Derivative of *r* with respect to the roughness of each
+            interface.
+
+    The derivative of the reflectivity $R = |r|^2$ is
+    $dR/d\theta = 2 \text{Re}(\bar r\, dr/d\theta)$.
+
+    This function does not compute any instrument resolution corrections.
+    """
+    reflmodule = _reflmodule()
+
+    kz = _dense(kz, 'd')
+    if rho_index is None:
+        rho_index = np.zeros(kz.shape, 'i')
+    else:
+        rho_index = _dense(rho_index, 'i')
+
+    depth = _dense(depth, 'd')
+    n = len(depth)
+    if np.isscalar(sigma):
+        sigma = sigma*np.ones(n-1, 'd')
+    else:
+        sigma = _dense(sigma, 'd')
+    rho = _dense(rho, 'd')
+    if np.isscalar(irho):
+        irho = irho * np.ones_like(rho)
+    else:
+        irho = _dense(irho, 'd')
+
+    r = np.empty(kz.shape, 'D')
+    dr_ddepth = np.empty((len(kz), n), 'D')
+    dr_dsigma = np.empty((len(kz), n-1), 'D')
+    dr_drho = np.empty((len(kz), n), 'D')
+    dr_dirho = np.empty((len(kz), n), 'D')
+    reflmodule._reflectivity_amplitude_gradient(
+        depth, sigma, rho, irho, kz, rho_index,
+        r, dr_ddepth, dr_dsigma, dr_drho, dr_dirho)
+    return r, dr_ddepth, dr_dsigma, dr_drho, dr_dirho
+
+
+class TransferMatrixCache(object):
+    """
+    Reflectivity amplitude with saved partial products of the transfer
+    matrices.
+
+    The amplitude at each kz is the product of one 2x2 matrix per interface.
+    The cache keeps the partial products from the surface side and from the
+    substrate side for a reference model, so when a later model differs
+    from the reference only in layers *lo* through *hi*, just the matrices
+    for those layers are recomputed.  This is a large saving for finite
+    difference derivatives, where each evaluation perturbs one parameter
+    of the reference model.
+
+    The reference is replaced when more than *max_fraction* of the layers
+    change, or when the kz points or the number of layers change.  The
+    partial products need 128 bytes per layer per kz; problems which would
+    need more than *max_size* bytes are computed without caching.
+
+    The counters *hits*, *updates* and *misses* record how often the
+    reference was reused unchanged, partially recomputed or replaced.
+    """
+    def __init__(self, max_size=64*2**20, max_fraction=0.5):
+        self.max_size = max_size
+        self.max_fraction = max_fraction
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the reference model.
+        """
+        self._reference = None
+        self._prefix = self._suffix = self._r = None
+        self.hits = self.updates = self.misses = 0
+
+    def amplitude(self, kz=None, depth=None, rho=None, irho=0, sigma=0,
+                  rho_index=None):
+        """
+        Calculate reflectivity amplitude $r(k_z)$ from slab model.
+
+        See :func:`reflectivity_amplitude` for details.
+        """
+        reflmodule = _reflmodule()
+
+        kz = _dense(kz, 'd')
+        if rho_index is None:
+            rho_index = np.zeros(kz.shape, 'i')
+        else:
+            rho_index = _dense(rho_index, 'i')
+        depth = _dense(depth, 'd')
+        n = len(depth)
+        if np.isscalar(sigma):
+            sigma = sigma*np.ones(n-1, 'd')
+        else:
+            sigma = _dense(sigma, 'd')
+        rho = _dense(rho, 'd')
+        if np.isscalar(irho):
+            irho = irho * np.ones_like(rho)
+        else:
+            irho = _dense(irho, 'd')
+
+        r = np.empty(kz.shape, 'D')
+        if 2*4*16*n*len(kz) > self.max_size:
+            reflmodule._reflectivity_amplitude(depth, sigma, rho, irho, kz,
+                                               rho_index, r)
+            return r
+
+        # Find the range of layers which differ from the reference.
+        ref = self._reference
+        if (ref is None or ref[1].shape != depth.shape
+                or ref[3].shape != rho.shape
+                or not np.array_equal(ref[0], kz)
+                or not np.array_equal(ref[5], rho_index)):
+            changed = None
+        else:
+            layer_changed = ((ref[1] != depth)
+                             | (ref[3] != rho).reshape(-1, n).any(axis=0)
+                             | (ref[4] != irho).reshape(-1, n).any(axis=0))
+            layer_changed[:-1] |= ref[2] != sigma
+            changed = np.flatnonzero(layer_changed)
+
+        if changed is not None and len(changed) == 0:
+            self.hits += 1
+            r[:] = self._r
+        elif (changed is not None
+              and changed[-1] + 1 - changed[0] <= self.max_fraction*n):
+            self.updates += 1
+            reflmodule._reflectivity_amplitude_update(
+                depth, sigma, rho, irho, kz, rho_index,
+                self._prefix, self._suffix,
+                int(changed[0]), int(changed[-1]+1), r)
+        else:
+            self.misses += 1
+            if self._prefix is None or self._prefix.shape != (len(kz), n, 4):
+                self._prefix = np.empty((len(kz), n, 4), 'D')
+                self._suffix = np.empty((len(kz), n, 4), 'D')
+            reflmodule._reflectivity_amplitude_partials(
+                depth, sigma, rho, irho, kz, rho_index,
+                self._prefix, self._suffix, r)
+            self._reference = [v.copy() for v in
+                               (kz, depth, sigma, rho, irho, rho_index)]
+            self._r = r.copy()
+        return r
+
+
 def magnetic_reflectivity(*args, **kw):
     """
     Magnetic reflectivity for slab models.
@@ -191,7 +505,7 @@ def magnetic_amplitude(kz,
 
     See :class:`magnetic_reflectivity <refl1d.reflectivity.magnetic_reflectivity>` for details.
     """
-    from . import reflmodule
+    reflmodule = _reflmodule()
 
     kz = _dense(kz, 'd')
     if rho_index is None:
@@ -223,7 +537,7 @@ def magnetic_amplitude(kz,
     return R1, R2, R3, R4
 
 def calculate_u1_u3(H, rhoM, thetaM, Aguide):
-    from . import reflmodule
+    reflmodule = _reflmodule()
 
     rhoM, thetaM = _dense(rhoM, 'd'), _dense(np.radians(thetaM), 'd')
     n = len(rhoM)
@@ -296,15 +610,182 @@ def convolve(xi, yi, x, dx):
     beyond the ends of the data measurement points *x*. Convolution at the
     tails is truncated and normalized to area of overlap between the resolution
     function in case the theory does not extend far enough.
-    """
-    from . import reflmodule
 
+    If *yi* is float32 then the convolution is computed in single precision
+    and returned as float32.
+    """
+    reflmodule = _reflmodule()
+
+    if getattr(yi, 'dtype', None) == np.float32:
+        x = _dense(x, 'f')
+        y = np.empty_like(x)
+        reflmodule.convolve_single(_dense(xi, 'f'), _dense(yi, 'f'), x,
+                                   _dense(dx, 'f'), y)
+        return y
     x = _dense(x)
     y = np.empty_like(x)
     reflmodule.convolve(_dense(xi), _dense(yi), x, _dense(dx), y)
     return y
 
 
+# Resolution cutoff at G(x)/G(0) = 0.001; see lib/convolve.c
+_LOG_RESLIMIT = np.log(0.001)
+_RESOLUTION_LIMIT = np.sqrt(-2*_LOG_RESLIMIT)
+_SQRT2, _SQRT2PI = np.sqrt(2.), np.sqrt(2*pi)
+
+def convolve_fft(xi, yi, x, dx, rtol=1e-3, check=8, uniform_tol=0.005):
+    """
+    Apply gaussian resolution to the theory using an FFT.
+
+    Returns convolution y[k] of width dx[k] at points x[k], as
+    for :func:`convolve`.
+
+    The FFT is used when the resolution is constant, with *dx* uniform to
+    within *uniform_tol*, or proportional to *x*, with *dx/x* uniform.  In
+    the second case, which covers most time-of-flight measurements, the
+    theory is resampled on a uniform grid in log *x*, where the gaussian
+    becomes a fixed kernel.  In both cases the cost is O(N log N) in the
+    number of grid points rather than the number of data points times the
+    number of theory points within each resolution window.  The mean width
+    is used, so *uniform_tol* bounds the relative error in the width.
+
+    The result is checked against the direct sum at *check* points spread
+    across the data.  If any differ by more than *rtol* relative, or if the
+    resolution is not uniform, the direct sum :func:`convolve` is used
+    instead.  Set *check=0* to skip the test.  Differences of a few parts
+    in 10^4 near sharp features come from where each method truncates
+    the gaussian tails.
+    """
+    y = _convolve_fft(_dense(xi), _dense(yi), _dense(x), _dense(dx),
+                      uniform_tol)
+    if y is None:
+        return convolve(xi, yi, x, dx)
+    if check:
+        index = np.unique(np.linspace(0, len(y)-1, check).astype('i'))
+        target = convolve(xi, yi, _dense(x)[index], _dense(dx)[index])
+        if np.any(abs(y[index] - target) > rtol*abs(target)):
+            return convolve(xi, yi, x, dx)
+    return y.astype(getattr(yi, 'dtype', 'd'), copy=False)
+
+
+def _convolve_fft(xi, yi, x, dx, uniform_tol, max_size=2**22):
+    """
+    Convolve on a uniform grid, returning None if the FFT does not apply.
+    """
+    if len(xi) < 2 or len(x) < 2 or np.any(dx <= 0):
+        return None
+    limit = _RESOLUTION_LIMIT
+    if np.ptp(dx) <= uniform_tol*np.mean(dx):
+        # Constant resolution: kernel is a gaussian of width dx.
+        sigma = np.mean(dx)
+        u, ui = x, xi
+        lo, hi = -limit*sigma, limit*sigma
+        to_x = lambda v: v
+        kernel = lambda d: np.exp(-0.5*(d/sigma)**2)
+        width = sigma
+    elif np.min(x) > 0 and np.ptp(dx/x) <= uniform_tol*np.mean(dx/x):
+        # Constant dx/x: with x' = x exp(d) the gaussian exp(-(x'-x)^2/2dx^2)
+        # dx' becomes exp(-(exp(d)-1)^2/2c^2) exp(d) dd, independent of x.
+        c = np.mean(dx/x)
+        if limit*c >= 1:
+            return None
+        keep = xi > 0
+        xi, yi = xi[keep], yi[keep]
+        if len(xi) < 2:
+            return None
+        u, ui = np.log(x), np.log(xi)
+        lo, hi = np.log(1 - limit*c), np.log(1 + limit*c)
+        to_x = np.exp
+        kernel = lambda d: np.exp(-0.5*((np.expm1(d))/c)**2 + d)
+        width = c
+    else:
+        return None
+
+    # Grid covering the data windows, restricted to the theory support.
+    start, stop = max(ui[0], u.min() + lo), min(ui[-1], u.max() + hi)
+    if u.min() < start or u.max() > stop:
+        return None
+    inside = (ui >= start) & (ui <= stop)
+    step = width/8
+    if np.sum(inside) > 1:
+        step = min(step, np.median(np.diff(ui[inside])))
+    n = int(np.ceil((stop - start)/step)) + 1
+    if n > max_size:
+        return None
+    grid = np.linspace(start, stop, n)
+    step = grid[1] - grid[0]
+    f = np.interp(to_x(grid), to_x(ui), yi)
+
+    # Correlate with the kernel sampled at d = j*step for j in [jlo, jhi],
+    # normalized by the kernel area overlapping the theory.
+    jlo, jhi = int(np.floor(lo/step)), int(np.ceil(hi/step))
+    g = kernel(np.arange(jlo, jhi+1)*step)[::-1]
+    size = n + len(g) - 1
+    nfft = 1 << int(np.ceil(np.log2(size)))
+    G = np.fft.rfft(g, nfft)
+    y = np.fft.irfft(np.fft.rfft(f, nfft)*G, nfft)[jhi:jhi+n]
+    norm = np.fft.irfft(np.fft.rfft(np.ones(n), nfft)*G, nfft)[jhi:jhi+n]
+    return np.interp(u, grid, y/norm)
+
+
+def convolve_matrix(xi, x, dx):
+    """
+    Return the gaussian resolution of :func:`convolve` as a sparse matrix.
+
+    The convolution is linear in the theory, so *convolve(xi, yi, x, dx)*
+    is *W.dot(yi)* for the scipy.sparse CSR matrix *W* returned.  Each row
+    holds the weights of the analytic gaussian-linear spline integral over
+    the resolution window of *x[k]*, normalized to the truncated area as in
+    the direct sum.  Rows with *dx[k]=0* hold the linear interpolation
+    weights.  Build *W* once and reuse it while *xi*, *x* and *dx* are
+    fixed.
+    """
+    from scipy.special import erf
+    from scipy.sparse import coo_matrix
+
+    xi, x, dx = _dense(xi), _dense(x), _dense(dx)
+    n = len(xi)
+    if n < 2:
+        raise ValueError("convolve_matrix: need at least two theory points")
+    limit = np.sqrt(-2.*dx**2*_LOG_RESLIMIT)
+    start = np.clip(np.searchsorted(xi, x - limit, 'right') - 1, 0, n-1)
+    stop = np.clip(np.searchsorted(xi, x + limit, 'left'), start+1, n-1)
+
+    # Linear interpolation (or extrapolation) where there is no resolution.
+    sharp = np.nonzero(dx <= 0.)[0]
+    lo = np.minimum(start[sharp], n-2)
+    t = (x[sharp] - xi[lo])/(xi[lo+1] - xi[lo])
+    rows, cols, weights = [sharp, sharp], [lo, lo+1], [1-t, t]
+
+    # Each segment (k-1, k) in the window contributes
+    #    0.5*(m xo + b)*dE - sigma/sqrt(2 pi)*m*dG
+    # with m xo + b = y[k] + m*(xo - xi[k]) and m = (y[k]-y[k-1])/step.
+    smooth = np.nonzero(dx > 0.)[0]
+    counts = stop[smooth] - start[smooth]
+    point = np.repeat(smooth, counts)
+    k = np.arange(len(point)) - np.repeat(np.cumsum(counts) - counts, counts) \
+        + np.repeat(start[smooth], counts) + 1
+    xo, sk = x[point], dx[point]
+    zlo, zhi = (xo - xi[k-1])/(_SQRT2*sk), (xo - xi[k])/(_SQRT2*sk)
+    dE = erf(-zhi) - erf(-zlo)
+    dG = np.exp(-zhi**2) - np.exp(-zlo**2)
+    step = xi[k] - xi[k-1]
+    keep = step != 0.
+    slope = np.zeros_like(step)
+    slope[keep] = (0.5*dE*(xo - xi[k]) - sk/_SQRT2PI*dG)[keep]/step[keep]
+    # Normalize to the truncated window, only for rows with a resolution
+    xs, ss = x[smooth], _SQRT2*dx[smooth]
+    scale = np.repeat(2./(erf((xi[stop[smooth]] - xs)/ss)
+                          - erf((xi[start[smooth]] - xs)/ss)), counts)
+    rows += [point, point]
+    cols += [k, k-1]
+    weights += [scale*np.where(keep, 0.5*dE + slope, 0.), -scale*slope]
+
+    W = coo_matrix((np.hstack(weights), (np.hstack(rows), np.hstack(cols))),
+                   shape=(len(x), n))
+    return W.tocsr()
+
+
 def convolve_sampled(xi, yi, xp, yp, x, dx):
     """
     Apply x-dependent arbitrary resolution function to the theory.
@@ -317,7 +798,7 @@ def convolve_sampled(xi, yi, xp, yp, x, dx):
     resolution *(xp, yp)* is also represented as a piece-wise linear
     spline.
     """
-    from . import reflmodule
+    reflmodule = _reflmodule()
 
     x = _dense(x)
     y = np.empty_like(x)
@@ -326,6 +807,107 @@ def convolve_sampled(xi, yi, xp, yp, x, dx):
     return y
 
 
+def test_reflectivity_amplitude_batch():
+    kz = np.linspace(-0.1, 0.1, 51)
+    depth = [[0, 100, 20, 0], [0, 50, 0, 0]]
+    sigma = [[5, 3, 2], [1, 0, 0]]
+    rho = [[2.07, 6.5, 4.0, 0], [2.07, 4.0, 0, 0]]
+    irho = [[0, 0.1, 0, 0], [0, 0.2, 0, 0]]
+    r = reflectivity_amplitude_batch(kz, depth, rho, irho, sigma)
+    # The second model has padding layers at the surface
+    target = [reflectivity_amplitude(kz, depth[0], rho[0], irho[0], sigma[0]),
+              reflectivity_amplitude(kz, depth[1][:3], rho[1][:3],
+                                     irho[1][:3], sigma[1][:2])]
+    assert np.max(abs(r - target)) < 1e-14
+
+
+def test_reflectivity_amplitude_gradient():
+    kz = np.linspace(-0.1, 0.1, 51)
+    depth = np.array([0, 100, 20, 35, 0.])
+    sigma = np.array([5, 3, 2, 4.])
+    rho = np.array([2.07, 6.5, 4.0, 1.0, 0.])
+    # absorbing substrates keep clear of the branch cut at irho=0
+    irho = np.array([0.01, 0.1, 0, 0.02, 0.01])
+    r, dd, ds, drho, dirho = reflectivity_amplitude_gradient(
+        kz, depth, rho, irho, sigma)
+    target = reflectivity_amplitude(kz, depth, rho, irho, sigma)
+    assert np.max(abs(r - target)) < 1e-14
+    # Compare against central differences
+    h = 1e-6
+    for p, dp in ((depth, dd), (sigma, ds), (rho, drho), (irho, dirho)):
+        for k in range(len(p)):
+            p[k] += h
+            hi = reflectivity_amplitude(kz, depth, rho, irho, sigma)
+            p[k] -= 2*h
+            lo = reflectivity_amplitude(kz, depth, rho, irho, sigma)
+            p[k] += h
+            assert np.max(abs((hi - lo)/(2*h) - dp[:, k])) < 1e-6
+
+
+def test_single_precision():
+    kz = np.linspace(-0.1, 0.1, 51)
+    depth = [0, 100, 20, 35, 0]
+    sigma = [5, 3, 2, 4]
+    rho = [2.07, 6.5, 4.0, 1.0, 0]
+    irho = [0, 0.1, 0, 0.02, 0]
+    r = reflectivity_amplitude(kz, depth, rho, irho, sigma)
+    r_single = reflectivity_amplitude(kz, depth, rho, irho, sigma,
+                                      precision='single')
+    assert r_single.dtype == np.complex64
+    assert np.max(abs(r_single - r)) < 1e-5
+    xi = np.linspace(0, 1, 500)
+    yi = np.sin(10*xi)
+    x = np.linspace(0.1, 0.9, 50)
+    dx = 0.01*np.ones_like(x)
+    y = convolve(xi, yi, x, dx)
+    y_single = convolve(xi, yi.astype('f'), x, dx)
+    assert y_single.dtype == np.float32
+    assert np.max(abs(y_single - y)) < 1e-4
+
+
+def test_convolve_fft():
+    xi = np.linspace(0, 0.35, 5000)
+    yi = abs(reflectivity_amplitude(xi/2, [0, 500, 0], [0, 4, 2.07]))**2
+    x = np.linspace(0.005, 0.3, 300)
+    # constant dx, constant dx/x, then varying dx which uses the direct sum
+    for dx in (0.002*np.ones_like(x), 0.02*x, 0.001 + 0.02*x):
+        y = convolve_fft(xi, yi, x, dx, check=0)
+        assert np.max(abs(y - convolve(xi, yi, x, dx))/y) < 1e-3
+    assert _convolve_fft(xi, yi, x, 0.001 + 0.02*x, 1e-6) is None
+
+
+def test_convolve_matrix():
+    # duplicate theory point and some zero width points
+    xi = np.sort(np.hstack((np.linspace(-0.01, 0.35, 2000), [0.1])))
+    yi = np.cos(300*xi) + 2
+    x = np.linspace(0.005, 0.34, 100)
+    dx = 0.0005 + 0.02*x
+    dx[::10] = 0
+    W = convolve_matrix(xi, x, dx)
+    assert np.max(abs(W.dot(yi) - convolve(xi, yi, x, dx))) < 1e-13
+
+
+def test_transfer_matrix_cache():
+    kz = np.linspace(-0.1, 0.1, 51)
+    depth = np.array([0, 100, 20, 35, 0.])
+    sigma = np.array([5, 3, 2, 4.])
+    rho = np.array([2.07, 6.5, 4.0, 1.0, 0.])
+    irho = np.array([0, 0.1, 0, 0.02, 0])
+    cache = TransferMatrixCache()
+    cache.amplitude(kz, depth, rho, irho, sigma)
+    # Change one interior layer, then an incident medium, then nothing
+    for k in (2, 0, 4, 4):
+        depth[k] += 5
+        rho[k] += 0.5
+        r = cache.amplitude(kz, depth, rho, irho, sigma)
+        target = reflectivity_amplitude(kz, depth, rho, irho, sigma)
+        assert np.max(abs(r - target)) < 1e-14
+        depth[k] -= 5
+        rho[k] -= 0.5
+    r = cache.amplitude(kz, depth, rho, irho, sigma)
+    assert cache.misses == 1 and cache.updates == 4 and cache.hits == 1
+
+
 def test_convolve_sampled():
     x = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     y = [1, 3, 1, 2, 1, 3, 1, 2, 1, 3]
@@ -0,0 +1,884 @@
+# This program is public domain.
+"""
+Pure numpy implementation of the reflmodule extension.
+
+This module provides the same functions as the compiled reflmodule, with
+the same arguments, writing results into the same output vectors.  It is
+used in place of reflmodule when the extension is not available, or when
+selected with the REFL1D_BACKEND=numpy environment variable.  See
+:func:`refl1d.reflectivity.set_backend` for details.
+
+The reflectivity calculations loop over layers in python with the kz
+points (and models in a population) vectorized, updating the 2x2 and 4x4
+transfer matrices for all points at once.  They agree with the compiled
+kernels to about 1e-12.  The python overhead makes them several times
+slower for small problems, but for tens of thousands of points they are
+comparable to a single threaded reflmodule.  The profile contraction
+and alignment functions are inherently sequential and are written as plain
+python loops, so models with many microslabs will render slowly.
+
+Run this module as a script to compare its performance with reflmodule::
+
+    python -m refl1d.reflmodule_numpy
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from numpy import pi, sqrt, exp, cos, sin, radians
+from scipy.special import erf
+
+PI4 = 4e-6*pi
+SQRT2 = sqrt(2.)
+SQRT2PI = sqrt(2.*pi)
+# Resolution cutoff at G(x)/G(0) = 0.001; see lib/convolve.c
+LOG_RESLIMIT = np.log(0.001)
+# See lib/magnetic.cc
+MINIMAL_RHO_M = 1e-2
+EPS = np.finfo('d').eps
+B2SLD = 2.31604654
+# Alignment tolerance for nuclear and magnetic interfaces
+Z_EPS = 1e-6
+# Below this, kz is treated as zero and the amplitude is -1
+KZ_CUTOFF = 1e-10
+
+
+def _flat(*args):
+    # The extension treats its arguments as flat buffers, so do the same
+    return [np.reshape(v, -1) for v in args]
+
+def _set_num_threads(n):
+    if n < 1:
+        raise ValueError("number of threads must be positive")
+
+def _get_num_threads():
+    return 1
+
+
+def _abeles(kz, depth, sigma, rho, irho, rho_index):
+    """
+    Nonmagnetic amplitude for a population of models.
+
+    *kz* is float[m] with kz > 0, *depth* is float[p, n], *sigma* is
+    float[p, n-1], *rho*, *irho* are float[p, k, n] for k profiles and
+    *rho_index* is int[m] selecting the profile for each kz.
+
+    Returns complex[p, m].
+    """
+    layers = depth.shape[1]
+    single = rho.shape[1] == 1
+    def column(v, i):
+        return v[:, :1, i] if single else v[:, rho_index, i]
+
+    kz_sq = kz**2 + PI4*column(rho, 0)
+    k = kz + 0j
+    B11 = B22 = 1.
+    B12 = B21 = 0.
+    for i in range(layers-1):
+        k_next = sqrt(kz_sq - PI4*(column(rho, i+1) + 1j*column(irho, i+1)))
+        F = (k - k_next)/(k + k_next)*exp(-2.*k*k_next*sigma[:, i:i+1]**2)
+        if i > 0:
+            M11 = exp(1j*k*depth[:, i:i+1])
+            M22 = exp(-1j*k*depth[:, i:i+1])
+        else:
+            M11 = M22 = 1.
+        M21 = F*M11
+        M12 = F*M22
+        B11, B21 = B11*M11 + B21*M12, B11*M21 + B21*M22
+        B12, B22 = B12*M11 + B22*M12, B12*M21 + B22*M22
+        k = k_next
+    return np.broadcast_to(B12/B11, (depth.shape[0], len(kz)))
+
+def _abeles_population(depth, sigma, rho, irho, kz, rho_index, r):
+    # Split kz into forward and reversed sections
+    r = r.reshape(depth.shape[0], len(kz))
+    forward = kz >= KZ_CUTOFF
+    reverse = kz <= -KZ_CUTOFF
+    if forward.any():
+        r[:, forward] = _abeles(kz[forward], depth, sigma, rho, irho,
+                                rho_index[forward])
+    if reverse.any():
+        r[:, reverse] = _abeles(-kz[reverse], depth[:, ::-1], sigma[:, ::-1],
+                                rho[:, :, ::-1], irho[:, :, ::-1],
+                                rho_index[reverse])
+    r[:, ~(forward|reverse)] = -1.
+
+def _reflectivity_amplitude(d, sigma, rho, irho, kz, rho_index, r):
+    d, sigma, rho, irho, kz, rho_index, r = _flat(d, sigma, rho, irho, kz, rho_index, r)
+    nd = len(d)
+    if len(rho)%nd != 0 or len(irho)%nd != 0 or nd != len(sigma)+1:
+        raise ValueError("d,rho,irho,sigma have different lengths")
+    if len(kz) != len(r) or len(rho_index) != len(kz):
+        raise ValueError("kz,rho_index,r have different lengths")
+    nprofiles = max(np.max(rho_index)+1, 1) if len(rho_index) else 1
+    if len(rho) < nd*nprofiles or len(irho) < nd*nprofiles:
+        raise ValueError("rho_index too high")
+    rho = np.reshape(rho, (1, -1, nd))
+    irho = np.reshape(irho, (1, -1, nd))
+    _abeles_population(d[None, :], sigma[None, :], rho, irho,
+                       kz, rho_index, r)
+
+def _reflectivity_amplitude_single(d, sigma, rho, irho, kz, rho_index, r):
+    # numpy keeps float32 and complex64 through the calculation
+    _reflectivity_amplitude(d, sigma, rho, irho, kz, rho_index, r)
+
+def _reflectivity_amplitude_batch(d, sigma, rho, irho, kz, rho_index, r):
+    d, sigma, rho, irho, kz, rho_index, r = _flat(d, sigma, rho, irho, kz, rho_index, r)
+    nkz, nd = len(kz), len(d)
+    if nkz == 0 or len(r)%nkz != 0 or len(rho_index) != nkz:
+        raise ValueError("kz,rho_index,r have inconsistent lengths")
+    npop = len(r)//nkz
+    if npop == 0 or nd%npop != 0 or len(sigma) != nd - npop:
+        raise ValueError("d,sigma,r have inconsistent lengths")
+    if nd == 0 or len(rho)%nd != 0 or len(irho) != len(rho):
+        raise ValueError("d,rho,irho have different lengths")
+    nlayers = nd//npop
+    if np.any(rho_index < 0) or np.any(rho_index >= len(rho)//nd):
+        raise ValueError("rho_index too high")
+    depth = np.reshape(d, (npop, nlayers))
+    sigma = np.reshape(sigma, (npop, nlayers-1))
+    rho = np.reshape(rho, (npop, -1, nlayers))
+    irho = np.reshape(irho, (npop, -1, nlayers))
+    _abeles_population(depth, sigma, rho, irho, kz, rho_index, r)
+
+
+# Partial products of the Abeles matrices; see reflectivity.cc.  Each kz
+# has a stack of 2x2 matrices prefix[f] = Y_0 ... Y_{f-1} and
+# suffix[f] = Y_f ... Y_{F-1} for the F = layers-1 steps through the stack.
+def _factor(kz, kz_sq, f, depth, sigma, rho, irho, rho_index):
+    # Factor f for kz > 0 as complex[m, 2, 2]
+    if f > 0:
+        k = sqrt(kz_sq - PI4*(rho[rho_index, f] + 1j*irho[rho_index, f]))
+        M11, M22 = exp(1j*k*depth[f]), exp(-1j*k*depth[f])
+    else:
+        k = kz + 0j
+        M11 = M22 = np.ones_like(k)
+    k_next = sqrt(kz_sq - PI4*(rho[rho_index, f+1] + 1j*irho[rho_index, f+1]))
+    F = (k - k_next)/(k + k_next)*exp(-2.*k*k_next*sigma[f]**2)
+    return np.stack((M11, F*M11, F*M22, M22), axis=-1).reshape(-1, 2, 2)
+
+def _directions(d, sigma, rho, irho, kz, rho_index):
+    # Forward and reversed views of the stack for kz > 0 and kz < 0
+    nd = len(d)
+    rho, irho = np.reshape(rho, (-1, nd)), np.reshape(irho, (-1, nd))
+    forward = kz >= KZ_CUTOFF
+    reverse = kz <= -KZ_CUTOFF
+    yield forward, (kz[forward], d, sigma, rho, irho, rho_index[forward])
+    yield reverse, (-kz[reverse], d[::-1], sigma[::-1], rho[:, ::-1],
+                    irho[:, ::-1], rho_index[reverse])
+
+def _check_partials(d, sigma, rho, irho, kz, rho_index, prefix, suffix, r):
+    nd = len(d)
+    if nd == 0 or len(rho)%nd != 0 or len(irho) != len(rho) or nd != len(sigma)+1:
+        raise ValueError("d,rho,irho,sigma have different lengths")
+    if len(kz) != len(r) or len(rho_index) != len(kz):
+        raise ValueError("kz,rho_index,r have different lengths")
+    if np.any(rho_index < 0) or np.any(rho_index >= len(rho)//nd):
+        raise ValueError("rho_index too high")
+    if len(prefix) != 4*nd*len(kz) or len(suffix) != len(prefix):
+        raise ValueError("prefix,suffix should have 4*len(d)*len(kz) entries")
+
+def _reflectivity_amplitude_partials(d, sigma, rho, irho, kz, rho_index,
+                                     prefix, suffix, r):
+    d, sigma, rho, irho, kz, rho_index, prefix, suffix, r = _flat(
+        d, sigma, rho, irho, kz, rho_index, prefix, suffix, r)
+    _check_partials(d, sigma, rho, irho, kz, rho_index, prefix, suffix, r)
+    layers = len(d)
+    prefix = prefix.reshape(len(kz), layers, 2, 2)
+    suffix = suffix.reshape(len(kz), layers, 2, 2)
+    r[:] = -1.
+    for index, (kz_k, d_k, sigma_k, rho_k, irho_k, rho_index_k) in _directions(
+            d, sigma, rho, irho, kz, rho_index):
+        if not index.any():
+            continue
+        kz_sq = kz_k**2 + PI4*rho_k[rho_index_k, 0]
+        P = np.empty((len(kz_k), layers, 2, 2), 'D')
+        S = np.empty_like(P)
+        P[:, 0] = S[:, -1] = np.eye(2)
+        for f in range(layers-1):
+            S[:, f] = _factor(kz_k, kz_sq, f, d_k, sigma_k, rho_k, irho_k,
+                              rho_index_k)
+            P[:, f+1] = np.matmul(P[:, f], S[:, f])
+        for f in range(layers-2, -1, -1):
+            S[:, f] = np.matmul(S[:, f], S[:, f+1])
+        prefix[index], suffix[index] = P, S
+        r[index] = P[:, -1, 1, 0]/P[:, -1, 0, 0]
+
+def _reflectivity_amplitude_update(d, sigma, rho, irho, kz, rho_index,
+                                   prefix, suffix, lo, hi, r):
+    d, sigma, rho, irho, kz, rho_index, prefix, suffix, r = _flat(
+        d, sigma, rho, irho, kz, rho_index, prefix, suffix, r)
+    _check_partials(d, sigma, rho, irho, kz, rho_index, prefix, suffix, r)
+    layers = len(d)
+    if lo < 0 or hi > layers or lo >= hi:
+        raise ValueError("changed layers lo:hi out of range")
+    prefix = prefix.reshape(len(kz), layers, 2, 2)
+    suffix = suffix.reshape(len(kz), layers, 2, 2)
+    # Layer n is used by the factors on either side of it, and the incident
+    # medium by all of them
+    F = layers-1
+    ranges = ((0, F) if lo == 0 else (max(lo-1, 0), min(hi, F)),
+              (0, F) if hi == layers else (max(F-hi, 0), min(F-lo+1, F)))
+    r[:] = -1.
+    for (flo, fhi), (index, (kz_k, d_k, sigma_k, rho_k, irho_k, rho_index_k)) \
+            in zip(ranges, _directions(d, sigma, rho, irho, kz, rho_index)):
+        if not index.any():
+            continue
+        kz_sq = kz_k**2 + PI4*rho_k[rho_index_k, 0]
+        X = prefix[index, flo]
+        for f in range(flo, fhi):
+            X = np.matmul(X, _factor(kz_k, kz_sq, f, d_k, sigma_k, rho_k,
+                                     irho_k, rho_index_k))
+        X = np.matmul(X, suffix[index, fhi])
+        r[index] = X[:, 1, 0]/X[:, 0, 0]
+
+def _reflectivity_amplitude_gradient(d, sigma, rho, irho, kz, rho_index,
+                                     r, dr_dd, dr_dsigma, dr_drho, dr_dirho):
+    d, sigma, rho, irho, kz, rho_index, r = _flat(
+        d, sigma, rho, irho, kz, rho_index, r)
+    _check_partials(d, sigma, rho, irho, kz, rho_index,
+                    np.empty(4*len(d)*len(kz)), np.empty(4*len(d)*len(kz)), r)
+    layers, F = len(d), len(d)-1
+    outputs = [np.reshape(v, (len(kz), -1))
+               for v in (dr_dd, dr_dsigma, dr_drho, dr_dirho)]
+    if (outputs[0].shape[1] != layers or outputs[1].shape[1] != F
+            or outputs[2].shape != outputs[0].shape
+            or outputs[3].shape != outputs[0].shape):
+        raise ValueError("gradients should be len(kz) x len(d) or len(kz) x len(sigma)")
+    r[:] = -1.
+    for v in outputs:
+        v[:] = 0.
+    for reverse, (index, (kz_k, d_k, sigma_k, rho_k, irho_k, rho_index_k)) \
+            in enumerate(_directions(d, sigma, rho, irho, kz, rho_index)):
+        if not index.any():
+            continue
+        # Wave vector in each layer, and the factors for each interface
+        rho_k, irho_k = rho_k[rho_index_k], irho_k[rho_index_k]
+        kz_sq = (kz_k**2 + PI4*rho_k[:, 0])[:, None]
+        K = np.empty(rho_k.shape, 'D')
+        K[:, 0] = kz_k
+        K[:, 1:] = sqrt(kz_sq - PI4*(rho_k[:, 1:] + 1j*irho_k[:, 1:]))
+        k, k_next, depth, s = K[:, :-1], K[:, 1:], d_k[:-1], sigma_k
+        g = (k - k_next)/(k + k_next)
+        e = exp(-2.*k*k_next*s**2)
+        M11, M22 = exp(1j*k*depth), exp(-1j*k*depth)
+        M11[:, 0] = M22[:, 0] = 1.
+        Ff = g*e
+        Y = np.stack((M11, Ff*M11, Ff*M22, M22), axis=-1).reshape(-1, F, 2, 2)
+
+        # Prefix products going in, first columns of suffix products coming out
+        P = np.empty((len(kz_k), layers, 2, 2), 'D')
+        P[:, 0] = np.eye(2)
+        for f in range(F):
+            P[:, f+1] = np.matmul(P[:, f], Y[:, f])
+        X00 = P[:, -1, 0, 0]
+        r_k = P[:, -1, 1, 0]/X00
+        w = (P[:, :-1, 1, :] - r_k[:, None, None]*P[:, :-1, 0, :])/X00[:, None, None]
+        U = np.empty((len(kz_k), F, 2), 'D')
+        u = np.zeros((len(kz_k), 2), 'D')
+        u[:, 0] = 1.
+        for f in range(F-1, -1, -1):
+            U[:, f] = u
+            u = np.einsum('mij,mj->mi', Y[:, f], u)
+
+        def contract(a00, a01, a10, a11):
+            dY = np.stack(np.broadcast_arrays(a00, a01, a10, a11), axis=-1)
+            return np.einsum('mfi,mfij,mfj->mf', w, dY.reshape(-1, F, 2, 2), U)
+
+        ksum_sq = (k + k_next)**2
+        dF_dk = 2.*k_next/ksum_sq*e - 2.*g*k_next*s**2*e
+        dF_dknext = -2.*k/ksum_sq*e - 2.*g*k*s**2*e
+        dF_ds = -4.*g*k*k_next*s*e
+        dM11_dd, dM22_dd = 1j*k*M11, -1j*k*M22
+        dM11_dk, dM22_dk = 1j*depth*M11, -1j*depth*M22
+        for v in (dM11_dd, dM22_dd, dM11_dk, dM22_dk):
+            v[:, 0] = 0.
+        t_d = contract(dM11_dd, Ff*dM11_dd, Ff*dM22_dd, dM22_dd)
+        t_s = contract(0., dF_ds*M11, dF_ds*M22, 0.)
+        t_k = contract(dM11_dk, dF_dk*M11 + Ff*dM11_dk,
+                       dF_dk*M22 + Ff*dM22_dk, dM22_dk)
+        t_next = contract(0., dF_dknext*M11, dF_dknext*M22, 0.)
+        a = t_k*PI4/(2.*k)
+        a[:, 0] = 0.   # k = |kz| in the incident medium
+        b = t_next*PI4/(2.*k_next)
+
+        dd = np.zeros((len(kz_k), layers), 'D')
+        drho, dirho = np.zeros_like(dd), np.zeros_like(dd)
+        dd[:, :-1] = t_d
+        drho[:, :-1] -= a
+        drho[:, 1:] -= b
+        drho[:, 0] += a.sum(axis=1) + b.sum(axis=1)
+        dirho[:, :-1] -= 1j*a
+        dirho[:, 1:] -= 1j*b
+        r[index] = r_k
+        for out, v in zip(outputs, (dd, t_s, drho, dirho)):
+            out[index] = v[:, ::-1] if reverse else v
+
+
+def _calculate_u1_u3(H, rhoM, thetaM, Aguide, sld_b, u1, u3):
+    rhoM, thetaM, sld_b, u1, u3 = _flat(rhoM, thetaM, sld_b, u1, u3)
+    # thetaM in radians, Aguide in degrees; see calculate_U1_U3 in magnetic.cc
+    if not len(rhoM) == len(thetaM) == len(sld_b) == len(u1) == len(u3):
+        raise ValueError("rhom,thetam,sldb,u1,u3 have different lengths")
+    AG = radians(Aguide)
+    sld_h = B2SLD*H
+    sld_m_x = rhoM*cos(thetaM)
+    sld_m_y = rhoM*sin(thetaM)
+    sld_m_z = 0.
+    sld_m_y, sld_m_z = (sld_m_z*sin(AG) + sld_m_y*cos(AG),
+                        sld_m_z*cos(AG) - sld_m_y*sin(AG))
+    sld_b_x = sld_m_x + EPS*(sld_m_x == 0)
+    sld_b_y = sld_m_y + EPS*(sld_m_y == 0)
+    sld_b_z = sld_h + sld_m_z
+    b = sqrt(sld_b_x**2 + sld_b_y**2 + sld_b_z**2)
+    u1[:] = (b + sld_b_x - sld_b_z + 1j*sld_b_y)/(b + sld_b_x + sld_b_z - 1j*sld_b_y)
+    u3[:] = (-b + sld_b_x - sld_b_z + 1j*sld_b_y)/(-b + sld_b_x + sld_b_z - 1j*sld_b_y)
+    sld_b[:] = b
+
+def _cr4xa(kz, depth, sigma, ip, rho, irho, rhoM, u1, u3):
+    """
+    Magnetic amplitude for kz > 0.
+
+    Vectorized version of Cr4xa in magnetic.cc, with *rho*, *irho* already
+    expanded to float[m, n] for the m kz values.  Returns the four
+    cross sections.
+    """
+    N = len(depth)
+    def roots(L):
+        eps = -PI4*(np.abs(irho[:, L]) + EPS)
+        S1 = -sqrt(PI4*(rho[:, L] + rhoM[L]) - E0 + 1j*eps)
+        S3 = -sqrt(PI4*(rho[:, L] - rhoM[L]) - E0 + 1j*eps)
+        if abs(u1[L]) <= 1.0:
+            B, G = u1[L], 1.0/u3[L]
+        else:
+            B, G = u3[L], 1.0/u1[L]
+            S1, S3 = S3, S1
+        return S1, S3, B, G
+
+    E0 = kz**2 + PI4*(rho[:, 0] + ip*rhoM[0])
+    # Fronting medium; B and G are not used from the incident layer
+    S1L, S3L, _, _ = roots(0)
+    S1LP, S3LP, BLP, GLP = roots(1)
+    sigma_sq = sigma[0]**2
+    DELTA = 0.5/(1.0 - BLP*GLP)
+    FS1S1, FS1S3 = S1L/S1LP, S1L/S3LP
+    FS3S1, FS3S3 = S3L/S1LP, S3L/S3LP
+    E11 = exp(2.*S1L*S1LP*sigma_sq)
+    E31 = exp(2.*S3L*S1LP*sigma_sq)
+    E13 = exp(2.*S1L*S3LP*sigma_sq)
+    E33 = exp(2.*S3L*S3LP*sigma_sq)
+    B = np.empty((len(kz), 4, 4), 'D')
+    B[:, 0, 0] = B[:, 1, 1] = DELTA*(1.0 + FS1S1)
+    B[:, 0, 1] = B[:, 1, 0] = DELTA*(1.0 - FS1S1)*E11
+    B[:, 0, 2] = B[:, 1, 3] = DELTA*-GLP*(1.0 + FS3S1)
+    B[:, 0, 3] = B[:, 1, 2] = DELTA*-GLP*(1.0 - FS3S1)*E31
+    B[:, 2, 0] = B[:, 3, 1] = DELTA*-BLP*(1.0 + FS1S3)
+    B[:, 2, 1] = B[:, 3, 0] = DELTA*-BLP*(1.0 - FS1S3)*E13
+    B[:, 2, 2] = B[:, 3, 3] = DELTA*(1.0 + FS3S3)
+    B[:, 2, 3] = B[:, 3, 2] = DELTA*(1.0 - FS3S3)*E33
+    Z = depth[1]
+
+    # Interior layers
+    A = np.empty_like(B)
+    for L in range(1, N-1):
+        S1L, S3L, GL, BL = S1LP, S3LP, GLP, BLP
+        S1LP, S3LP, BLP, GLP = roots(L+1)
+        sigma_sq = sigma[L]**2
+        DELTA = 0.5/(1.0 - BLP*GLP)
+        DBB = (BL - BLP)*DELTA
+        DBG = (1.0 - BL*GLP)*DELTA
+        DGB = (1.0 - GL*BLP)*DELTA
+        DGG = (GL - GLP)*DELTA
+        ES1L, ES1LP = exp(S1L*Z), exp(S1LP*Z)
+        ES3L, ES3LP = exp(S3L*Z), exp(S3LP*Z)
+        ENS1L, ENS1LP = 1.0/ES1L, 1.0/ES1LP
+        ENS3L, ENS3LP = 1.0/ES3L, 1.0/ES3LP
+        FS1S1, FS1S3 = S1L/S1LP, S1L/S3LP
+        FS3S1, FS3S3 = S3L/S1LP, S3L/S3LP
+
+        P = DBG*(1.0 + FS1S1)
+        A[:, 0, 0] = P*ES1L*ENS1LP
+        A[:, 1, 1] = P*ENS1L*ES1LP
+        P = DBG*(1.0 - FS1S1)*exp(2.*S1L*S1LP*sigma_sq)
+        A[:, 0, 1] = P*ENS1L*ENS1LP
+        A[:, 1, 0] = P*ES1L*ES1LP
+        P = DGG*(1.0 + FS3S1)
+        A[:, 0, 2] = P*ES3L*ENS1LP
+        A[:, 1, 3] = P*ENS3L*ES1LP
+        P = DGG*(1.0 - FS3S1)*exp(2.*S3L*S1LP*sigma_sq)
+        A[:, 0, 3] = P*ENS3L*ENS1LP
+        A[:, 1, 2] = P*ES3L*ES1LP
+
+        P = DBB*(1.0 + FS1S3)
+        A[:, 2, 0] = P*ES1L*ENS3LP
+        A[:, 3, 1] = P*ENS1L*ES3LP
+        P = DBB*(1.0 - FS1S3)*exp(2.*S1L*S3LP*sigma_sq)
+        A[:, 2, 1] = P*ENS1L*ENS3LP
+        A[:, 3, 0] = P*ES1L*ES3LP
+        P = DGB*(1.0 + FS3S3)
+        A[:, 2, 2] = P*ES3L*ENS3LP
+        A[:, 3, 3] = P*ENS3L*ES3LP
+        P = DGB*(1.0 - FS3S3)*exp(2.*S3L*S3LP*sigma_sq)
+        A[:, 2, 3] = P*ENS3L*ENS3LP
+        A[:, 3, 2] = P*ES3L*ES3LP
+
+        B = np.matmul(A, B)
+        Z += depth[L+1]
+
+    B21, B22, B23, B24 = B[:, 1, 0], B[:, 1, 1], B[:, 1, 2], B[:, 1, 3]
+    B41, B42, B43, B44 = B[:, 3, 0], B[:, 3, 1], B[:, 3, 2], B[:, 3, 3]
+    DETW = B44*B22 - B24*B42
+    return ((B24*B41 - B21*B44)/DETW, (B21*B42 - B41*B22)/DETW,
+            (B24*B43 - B23*B44)/DETW, (B23*B42 - B43*B22)/DETW)
+
+def _magnetic_amplitude(d, sigma, rho, irho, rhoM, u1, u3, Aguide,
+                        kz, rho_index, Ra, Rb, Rc, Rd):
+    d, sigma, rho, irho, rhoM, u1, u3, kz, rho_index, Ra, Rb, Rc, Rd = _flat(
+        d, sigma, rho, irho, rhoM, u1, u3, kz, rho_index, Ra, Rb, Rc, Rd)
+    nd = len(d)
+    if (len(sigma) != nd-1 or len(rho)%nd != 0 or len(irho)%nd != 0
+            or len(rhoM) != nd or len(u1) != nd or len(u3) != nd):
+        raise ValueError("d,sigma,rho,irho,rhom,u1,u3 have different lengths")
+    if not len(kz) == len(Ra) == len(Rb) == len(Rc) == len(Rd) == len(rho_index):
+        raise ValueError("kz,r1,r2,r3,r4,rho_index have different lengths")
+    rho = np.reshape(rho, (-1, nd))[rho_index]
+    irho = np.reshape(irho, (-1, nd))[rho_index]
+    # Cross sections for the I+ and I- incident beams
+    if abs(rhoM[0]) <= MINIMAL_RHO_M and abs(rhoM[-1]) <= MINIMAL_RHO_M:
+        plus, minus = (Ra, Rb, Rc, Rd), (None, None, None, None)
+    else:
+        plus, minus = (Ra, Rb, None, None), (None, None, Rc, Rd)
+
+    forward = kz >= KZ_CUTOFF
+    reverse = kz <= -KZ_CUTOFF
+    zero = ~(forward|reverse)
+    for ip, targets in ((1, plus), (-1, minus)):
+        if all(R is None for R in targets):
+            continue
+        parts = []
+        if forward.any():
+            parts.append((forward, _cr4xa(
+                kz[forward], d, sigma, ip, rho[forward], irho[forward],
+                rhoM, u1, u3)))
+        if reverse.any():
+            parts.append((reverse, _cr4xa(
+                -kz[reverse], d[::-1], sigma[::-1], ip,
+                rho[reverse, ::-1], irho[reverse, ::-1],
+                rhoM[::-1], u1[::-1], u3[::-1])))
+        for R, zero_value, k in zip(targets, (-1., 0., 0., -1.), range(4)):
+            if R is None:
+                continue
+            for index, values in parts:
+                R[index] = values[k]
+            R[zero] = zero_value
+
+
+def _align_magnetic(d, sigma, rho, irho, dM, sigmaM, rhoM, thetaM, output):
+    d, sigma, rho, irho, dM, sigmaM, rhoM, thetaM = _flat(d, sigma, rho, irho, dM, sigmaM, rhoM, thetaM)
+    nlayers, nlayersM = len(d), len(dM)
+    if not (len(sigma) == nlayers-1 and len(rho) == len(irho) == nlayers):
+        raise ValueError("d,sigma,rho,irho have different lengths")
+    if not (len(sigmaM) == nlayersM-1 and len(rhoM) == len(thetaM) == nlayersM):
+        raise ValueError("dM,sigmaM,rhoM,thetaM have different lengths")
+    output = np.reshape(output, (-1, 6))
+    if len(output) < nlayers + nlayersM:
+        raise ValueError("output too short --- should be [len(d)+len(dM), 6]")
+    magnetic = nuclear = k = 0
+    z = next_z = next_zM = 0.
+    # See align_magnetic in contract_profile.cc for the algorithm
+    while True:
+        output[k, 2:] = rho[nuclear], irho[nuclear], rhoM[magnetic], thetaM[magnetic]
+        if magnetic == nlayersM-1 and nuclear == nlayers-1:
+            output[k, :2] = 0.
+            k += 1
+            break
+        if nuclear == nlayers-1:
+            output[k, :2] = max(next_zM - z, 0.), sigmaM[magnetic]
+            magnetic += 1
+            next_zM += dM[magnetic]
+        elif magnetic == nlayersM-1:
+            output[k, :2] = max(next_z - z, 0.), sigma[nuclear]
+            nuclear += 1
+            next_z += d[nuclear]
+        elif (abs(next_z - next_zM) < Z_EPS
+              and abs(sigma[nuclear] - sigmaM[magnetic]) < Z_EPS):
+            output[k, 0] = max(0.5*(next_z + next_zM) - z, 0.)
+            output[k, 1] = 0.5*(sigma[nuclear] + sigmaM[magnetic])
+            nuclear += 1
+            magnetic += 1
+            next_z += d[nuclear]
+            next_zM += dM[magnetic]
+        elif next_zM < next_z:
+            output[k, :2] = max(next_zM - z, 0.), sigmaM[magnetic]
+            magnetic += 1
+            next_zM += dM[magnetic]
+        else:
+            output[k, :2] = max(next_z - z, 0.), sigma[nuclear]
+            nuclear += 1
+            next_z += d[nuclear]
+        z += output[k, 0]
+        k += 1
+    return k
+
+def _contract_by_step(d, sigma, rho, irho, dh):
+    d, sigma, rho, irho = _flat(d, sigma, rho, irho)
+    n = len(d)
+    if not (len(sigma) == n-1 and len(rho) == len(irho) == n):
+        raise ValueError("d,sigma,rho,irho have different lengths")
+    newi = 0
+    dz, rholeft, irholeft = d[0], rho[0], irho[0]
+    rhoarea, irhoarea = dz*rholeft, dz*irholeft
+    for i in range(1, n):
+        # The C version reads past the end of sigma for the last slice
+        if (i < n-1 and sigma[i] != 0. and abs(rholeft - rho[i]) < dh
+                and abs(irholeft - irho[i]) < dh):
+            dz += d[i]
+            rhoarea += d[i]*rho[i]
+            irhoarea += d[i]*irho[i]
+        else:
+            d[newi] = dz
+            if newi > 0:
+                rho[newi] = rhoarea/dz
+                irho[newi] = irhoarea/dz
+            newi += 1
+            dz, rholeft, irholeft = d[i], rho[i], irho[i]
+            rhoarea, irhoarea = dz*rholeft, dz*irholeft
+    d[newi] = dz
+    rho[newi] = rho[n-1]
+    irho[newi] = irho[n-1]
+    return newi + 1
+
+def _contract_by_area(d, sigma, rho, irho, dA):
+    d, sigma, rho, irho = _flat(d, sigma, rho, irho)
+    n = len(d)
+    if not (len(sigma) == n-1 and len(rho) == len(irho) == n):
+        raise ValueError("d,sigma,rho,irho have different lengths")
+    # Convert to lists since scalar indexing into numpy arrays is slow
+    dl, sl, rl, il = d.tolist(), sigma.tolist(), rho.tolist(), irho.tolist()
+    i = newi = 1
+    while i < n:
+        dz = rhoarea = irhoarea = 0.
+        rholo = rhohi = rl[i]
+        irholo = irhohi = il[i]
+        while True:
+            dz += dl[i]
+            rhoarea += dl[i]*rl[i]
+            irhoarea += dl[i]*il[i]
+            i += 1
+            if i == n or sl[i-1] != 0.:
+                break
+            rholo, rhohi = min(rholo, rl[i]), max(rhohi, rl[i])
+            if (rhohi - rholo)*(dz + dl[i]) > dA:
+                break
+            irholo, irhohi = min(irholo, il[i]), max(irhohi, il[i])
+            if (irhohi - irholo)*(dz + dl[i]) > dA:
+                break
+        dl[newi] = dz
+        if i == n:
+            rl[newi], il[newi] = rl[n-1], il[n-1]
+        else:
+            rl[newi], il[newi] = rhoarea/dz, irhoarea/dz
+            sl[newi] = sl[i-1]
+        newi += 1
+    d[:], sigma[:], rho[:], irho[:] = dl, sl, rl, il
+    return newi
+
+def _contract_by_area_multi(d, sigma, rho, irho, dA):
+    d, sigma, rho, irho = _flat(d, sigma, rho, irho)
+    n = len(d)
+    if not (n > 0 and len(sigma) == n-1 and len(rho) == len(irho)
+            and len(rho) % n == 0):
+        raise ValueError("d,sigma,rho,irho have different lengths")
+    # Rows are wavelengths; the criterion is the worst case over the rows
+    rho2, irho2 = rho.reshape(-1, n), irho.reshape(-1, n)
+    dl, sl = d.tolist(), sigma.tolist()
+    i = newi = 1
+    while i < n:
+        start = i
+        dz = 0.
+        rholo = rhohi = rho2[:, i]
+        irholo = irhohi = irho2[:, i]
+        while True:
+            dz += dl[i]
+            i += 1
+            if i == n or sl[i-1] != 0.:
+                break
+            rholo = np.minimum(rholo, rho2[:, i])
+            rhohi = np.maximum(rhohi, rho2[:, i])
+            irholo = np.minimum(irholo, irho2[:, i])
+            irhohi = np.maximum(irhohi, irho2[:, i])
+            step = max(np.max(rhohi - rholo), np.max(irhohi - irholo))
+            if step*(dz + dl[i]) > dA:
+                break
+        dl[newi] = dz
+        if i == n:
+            rho2[:, newi], irho2[:, newi] = rho2[:, n-1], irho2[:, n-1]
+        else:
+            w = d[start:i]
+            rho2[:, newi] = np.dot(rho2[:, start:i], w)/dz
+            irho2[:, newi] = np.dot(irho2[:, start:i], w)/dz
+            sl[newi] = sl[i-1]
+        newi += 1
+    d[:], sigma[:] = dl, sl
+    return newi
+
+def _contract_mag(d, sigma, rho, irho, rhoM, thetaM, dA):
+    d, sigma, rho, irho, rhoM, thetaM = _flat(d, sigma, rho, irho, rhoM, thetaM)
+    n = len(d)
+    if not (len(sigma) == n-1 and len(rho) == len(irho) == len(rhoM)
+            == len(thetaM) == n):
+        raise ValueError("d,sigma,rho,irho,rhoM,thetaM have different lengths")
+    dl, sl, rl, il = d.tolist(), sigma.tolist(), rho.tolist(), irho.tolist()
+    ml, tl = rhoM.tolist(), thetaM.tolist()
+    weights = cos(radians(thetaM)).tolist()
+    i = newi = 1
+    while i < n:
+        dz = weighted_dz = 0.
+        rhoarea = irhoarea = rhoMarea = thetaMarea = 0.
+        rholo = rhohi = rl[i]
+        irholo = irhohi = il[i]
+        maglo = maghi = ml[i]*weights[i]
+        while True:
+            dz += dl[i]
+            rhoarea += dl[i]*rl[i]
+            irhoarea += dl[i]*il[i]
+            mag = ml[i]*weights[i]
+            rhoMarea += dl[i]*mag
+            thetaMarea += dl[i]*tl[i]*weights[i]
+            weighted_dz += dl[i]*weights[i]
+            i += 1
+            if i == n or sl[i-1] != 0.:
+                break
+            rholo, rhohi = min(rholo, rl[i]), max(rhohi, rl[i])
+            if (rhohi - rholo)*(dz + dl[i]) > dA:
+                break
+            irholo, irhohi = min(irholo, il[i]), max(irhohi, il[i])
+            if (irhohi - irholo)*(dz + dl[i]) > dA:
+                break
+            # Note: like the C code, this uses the magnetism of the
+            # previous slice rather than the next one.
+            maglo, maghi = min(maglo, mag), max(maghi, mag)
+            if (maghi - maglo)*(dz + dl[i]) > dA:
+                break
+        dl[newi] = dz
+        if i == n:
+            rl[newi], il[newi] = rl[n-1], il[n-1]
+            ml[newi], tl[newi] = ml[n-1], tl[n-1]
+        else:
+            rl[newi], il[newi] = rhoarea/dz, irhoarea/dz
+            ml[newi], tl[newi] = rhoMarea/weighted_dz, thetaMarea/weighted_dz
+            sl[newi] = sl[i-1]
+        newi += 1
+    d[:], sigma[:], rho[:], irho[:] = dl, sl, rl, il
+    rhoM[:], thetaM[:] = ml, tl
+    return newi
+
+
+def _window_start(xin, x, limit):
+    # Index of the last theory point at or below x-limit, or zero
+    return np.clip(np.searchsorted(xin, x - limit, 'right') - 1, 0, len(xin)-1)
+
+def _linear(xin, yin, start, x):
+    # Interpolate from start to start+1, or extrapolate from the last pair
+    lo = np.minimum(start, len(xin)-2)
+    m = (yin[lo+1] - yin[lo])/(xin[lo+1] - xin[lo])
+    return m*(x - xin[lo]) + yin[lo]
+
+def convolve(xi, yi, x, dx, y):
+    xi, yi, x, dx, y = _flat(xi, yi, x, dx, y)
+    if len(xi) != len(yi) or len(x) != len(dx) or len(x) != len(y):
+        raise ValueError("convolve: xi and yi must match and x,dx,y must match")
+    if len(xi) < 2:
+        raise ValueError("convolve: need at least two theory points")
+    limit = sqrt(-2.*dx**2*LOG_RESLIMIT)
+    start = _window_start(xi, x, limit)
+    stop = np.clip(np.searchsorted(xi, x + limit, 'left'), start+1, len(xi)-1)
+    y[:] = _linear(xi, yi, start, x)
+    smooth = dx > 0.
+    if not smooth.any():
+        return
+    x, sigma, start, stop = x[smooth], dx[smooth], start[smooth], stop[smooth]
+
+    # Analytic convolution of the gaussian with each linear segment in
+    # the window, summed by output point.
+    counts = stop - start
+    point = np.repeat(np.arange(len(x)), counts)
+    k = np.arange(len(point)) - np.repeat(np.cumsum(counts) - counts, counts) \
+        + np.repeat(start, counts) + 1
+    xo, sk = x[point], sigma[point]
+    zlo, zhi = (xo - xi[k-1])/(SQRT2*sk), (xo - xi[k])/(SQRT2*sk)
+    step = xi[k] - xi[k-1]
+    keep = step != 0.
+    m = np.zeros_like(step)
+    m[keep] = (yi[k] - yi[k-1])[keep]/step[keep]
+    b = yi[k] - m*xi[k]
+    area = 0.5*(m*xo + b)*(erf(-zhi) - erf(-zlo)) \
+        - sk/SQRT2PI*m*(exp(-zhi**2) - exp(-zlo**2))
+    area[~keep] = 0.
+    total = np.bincount(point, weights=area, minlength=len(x))
+    norm = erf((xi[stop] - x)/(SQRT2*sigma)) - erf((xi[start] - x)/(SQRT2*sigma))
+    y[smooth] = 2*total/norm
+
+def convolve_single(xi, yi, x, dx, y):
+    # numpy keeps float32 through the calculation
+    convolve(xi, yi, x, dx, y)
+
+def _convolve_point_sampled(xin, yin, xp, yp, xo, dx, index):
+    # Walk the theory and resolution splines together; see convolve_sampled.c
+    Nin, Np = len(xin), len(xp)
+    m1 = b1 = 1e308
+    m2 = b2 = 0.
+    total = norm = 0.
+    next_xin = xin[index]
+    p = 1
+    while p < Np and not xo + dx*xp[p] > next_xin:
+        p += 1
+    p -= 1
+    next_xp = xo + dx*xp[p]
+    x = max(next_xp, next_xin)
+    while True:
+        if next_xin <= x:
+            index += 1
+            if index >= Nin:
+                break
+            next_xin = xin[index]
+            m1 = (yin[index] - yin[index-1])/(xin[index] - xin[index-1])
+            b1 = yin[index] - m1*xin[index]
+        if next_xp <= x:
+            p += 1
+            if p >= Np:
+                break
+            next_xp = xo + dx*xp[p]
+            m2 = (yp[p] - yp[p-1])/(xp[p] - xp[p-1])/dx
+            b2 = yp[p] - m2*next_xp
+        next_x = min(next_xin, next_xp)
+        delta = next_x - x
+        delta2 = next_x**2 - x**2
+        delta3 = next_x**3 - x**3
+        norm += 0.5*m2*delta2 + b2*delta
+        total += m1*m2/3.0*delta3 + 0.5*(m1*b2 + m2*b1)*delta2 + b1*b2*delta
+        x = next_x
+    return total/norm
+
+def convolve_sampled(xi, yi, xp, yp, x, dx, y):
+    xi, yi, xp, yp, x, dx, y = _flat(xi, yi, xp, yp, x, dx, y)
+    if len(xi) != len(yi) or len(xp) != len(yp) or len(x) != len(dx) or len(x) != len(y):
+        raise ValueError("convolve_sampled: xi,yi and xp,yp and x,dx,y must match")
+    if len(xi) < 2:
+        raise ValueError("convolve_sampled: need at least two theory points")
+    start = _window_start(xi, x, -dx*xp[0])
+    y[:] = _linear(xi, yi, start, x)
+    xi, yi, xp, yp = [v.tolist() for v in (xi, yi, xp, yp)]
+    for k in np.flatnonzero(dx > 0.):
+        y[k] = _convolve_point_sampled(xi, yi, xp, yp, x[k], dx[k], start[k])
+
+
+def benchmark(points=(100, 1000, 10000, 100000), layers=(10, 100, 1000)):
+    """
+    Compare the numpy kernel against the compiled reflmodule.
+
+    Prints the time per call for each combination of *points* and *layers*
+    and the worst relative difference between the two.
+    """
+    import timeit
+    from . import reflmodule
+
+    rng = np.random.RandomState(1)
+    print("%8s %7s %12s %12s %7s %9s"
+          % ("points", "layers", "C (ms)", "numpy (ms)", "ratio", "rel err"))
+    for n in layers:
+        d = np.hstack((0., rng.uniform(5, 50, n-2), 0.))
+        sigma = rng.uniform(0, 5, n-1)
+        rho = rng.uniform(-1, 7, n)
+        irho = rng.uniform(0, 0.01, n)
+        for m in points:
+            kz = np.linspace(-0.15, 0.15, m)
+            index = np.zeros(m, 'i')
+            r_c, r_py = np.empty(m, 'D'), np.empty(m, 'D')
+            def run_c():
+                reflmodule._reflectivity_amplitude(d, sigma, rho, irho,
+                                                   kz, index, r_c)
+            def run_py():
+                _reflectivity_amplitude(d, sigma, rho, irho, kz, index, r_py)
+            repeat = max(1, int(2e5//(n*m)))
+            t_c = min(timeit.repeat(run_c, number=repeat, repeat=3))/repeat
+            t_py = min(timeit.repeat(run_py, number=repeat, repeat=3))/repeat
+            err = np.max(abs(r_c - r_py)/abs(r_c))
+            print("%8d %7d %12.3f %12.3f %7.1f %9.2g"
+                  % (m, n, 1e3*t_c, 1e3*t_py, t_py/t_c, err))
+
+
+def test():
+    from . import reflmodule
+
+    rng = np.random.RandomState(2)
+    n, m = 12, 400
+    d = np.hstack((0., rng.uniform(5, 50, n-2), 0.))
+    sigma = rng.uniform(0, 5, n-1)
+    rho = rng.uniform(-1, 7, (2, n))
+    irho = rng.uniform(0, 0.01, (2, n))
+    kz = np.linspace(-0.1, 0.1, m)
+    index = rng.randint(0, 2, m).astype('i')
+    rho, irho = rho.flatten(), irho.flatten()
+    r_c, r_py = np.empty(m, 'D'), np.empty(m, 'D')
+    reflmodule._reflectivity_amplitude(d, sigma, rho, irho, kz, index, r_c)
+    _reflectivity_amplitude(d, sigma, rho, irho, kz, index, r_py)
+    assert np.max(abs(r_c - r_py)) < 1e-12
+
+    grads = []
+    for module in (reflmodule, __import__(__name__, fromlist=['_'])):
+        g = [np.empty(m, 'D'), np.empty((m, n), 'D'), np.empty((m, n-1), 'D'),
+             np.empty((m, n), 'D'), np.empty((m, n), 'D')]
+        module._reflectivity_amplitude_gradient(d, sigma, rho, irho, kz,
+                                                index, *g)
+        grads.append(g)
+    for g_c, g_py in zip(*grads):
+        assert np.max(abs(g_c - g_py)) < 1e-9
+
+    rhoM = rng.uniform(0, 2, n)
+    thetaM = radians(rng.uniform(0, 360, n))
+    results = []
+    for module in (reflmodule, __import__(__name__, fromlist=['_'])):
+        sld_b, u1, u3 = np.empty(n, 'd'), np.empty(n, 'D'), np.empty(n, 'D')
+        module._calculate_u1_u3(0.1, rhoM, thetaM, 270., sld_b, u1, u3)
+        R = [np.empty(m, 'D') for _ in range(4)]
+        module._magnetic_amplitude(d, sigma, rho[:n], irho[:n], sld_b, u1, u3,
+                                   270., kz, np.zeros(m, 'i'), *R)
+        results.append(R)
+    for Rc, Rpy in zip(*results):
+        assert np.max(abs(Rc - Rpy)) < 1e-12
+
+    x = np.linspace(0, 1, 200)
+    xi = np.sort(rng.uniform(-0.1, 1.1, 500))
+    yi = np.sin(10*xi)
+    dx = rng.uniform(0, 0.02, len(x))
+    dx[::7] = 0.
+    y_c, y_py = np.empty_like(x), np.empty_like(x)
+    reflmodule.convolve(xi, yi, x, dx, y_c)
+    convolve(xi, yi, x, dx, y_py)
+    assert np.max(abs(y_c - y_py)) < 1e-12
+
+    z = np.linspace(0, 40, 200)
+    profile = [np.ascontiguousarray(v) for v in
+               (np.hstack((0, np.diff(z))), np.zeros(len(z)-1),
+                np.tanh(z/10 - 2), 0.01*np.cos(z/5))]
+    profile[1][50] = 3.
+    contracted = []
+    for fn in (reflmodule._contract_by_area, _contract_by_area):
+        v = [p.copy() for p in profile]
+        k = fn(*(v + [0.02]))
+        contracted.append([p[:k] for p in v])
+    for a, b in zip(*contracted):
+        assert np.max(abs(a[:-1] - b[:-1])) < 1e-12
+
+    rho2, irho2 = np.vstack((profile[2], 1.1*profile[2])), 0.1*np.cos(z/5)*[[1], [2]]
+    contracted = []
+    for fn in (reflmodule._contract_by_area_multi, _contract_by_area_multi):
+        v = [p.copy() for p in (profile[0], profile[1], rho2, irho2)]
+        k = fn(*(v + [0.02]))
+        contracted.append([v[0][:k], v[2][:, :k], v[3][:, :k]])
+    for a, b in zip(*contracted):
+        assert np.max(abs(a[..., :-1] - b[..., :-1])) < 1e-12
+
+
+if __name__ == "__main__":
+    benchmark()
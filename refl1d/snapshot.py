@@ -0,0 +1,215 @@
+# This program is in the public domain
+"""
+Model snapshots.
+
+Loading a model script runs it from the start, building the materials,
+reading and parsing the data files and constructing the experiments.
+For large models this takes seconds on every fit worker and every command
+line run.  A snapshot is the fully built problem saved with pickle,
+which :func:`load_problem` reloads in place of running the script so
+long as neither the script, its options nor any file it read has changed.
+
+Snapshots are stored in the directory given by the REFL1D_MODEL_CACHE
+environment variable, and are used by the refl1d command line and fit
+workers when it is set.  The key is a hash of the script path and
+contents, the model options and command line, and the refl1d and python
+versions.  The files opened for reading while the script ran and the
+source of any module it imported are recorded with a hash of their
+contents, and the snapshot is rebuilt if any of them changes.  Modules
+which are part of the python installation are not checked.
+
+The script must build the same problem each time it is run with the same
+inputs; do not use snapshots with models which depend on random numbers
+or on the environment.  Problems which cannot be pickled, such as those
+using functions defined in the model script, are never cached.
+"""
+from __future__ import print_function
+
+__all__ = ["load_problem", "STATS"]
+
+import sys
+import os
+import hashlib
+import pickle
+import tempfile
+
+from . import __version__
+
+#: Counts of snapshot *hits*, *misses* and *failures* to save a snapshot
+STATS = {'hits': 0, 'misses': 0, 'failures': 0}
+
+def load_problem(filename, options=None, cache_dir=None, argv=None):
+    """
+    Load the problem defined by the model script *filename*.
+
+    *options* are the model options passed to the script in sys.argv.
+    *argv* are any other arguments which may change the problem, such as
+    the full command line when the model options cannot be separated from
+    it.  These are part of the snapshot key but are not given to the script.
+    *cache_dir* is the snapshot directory, which defaults to the
+    REFL1D_MODEL_CACHE environment variable.  If there is no directory,
+    the script is run directly with bumps.fitproblem.load_problem.
+    """
+    from bumps.fitproblem import load_problem as run_script
+
+    options = list(options) if options else []
+    if cache_dir is None:
+        cache_dir = os.environ.get('REFL1D_MODEL_CACHE', None)
+    if not cache_dir:
+        return run_script(filename, options=options)
+
+    key = _key(filename, (options, list(argv) if argv else []))
+    path = os.path.join(cache_dir, key + ".snapshot")
+    problem = _load(path)
+    if problem is not None:
+        STATS['hits'] += 1
+        return problem
+
+    STATS['misses'] += 1
+    modules = set(sys.modules)
+    with _FileRecorder() as files:
+        problem = run_script(filename, options=options)
+    files.update(_module_sources(set(sys.modules) - modules))
+    files.discard(os.path.realpath(filename))
+    try:
+        _save(path, files, problem)
+    except Exception:
+        # Problems with functions from the script cannot be pickled
+        STATS['failures'] += 1
+    return problem
+
+def _key(filename, options):
+    digest = hashlib.sha1()
+    digest.update(repr((os.path.realpath(filename), options, __version__,
+                        sys.version)).encode('utf-8'))
+    with open(filename, 'rb') as fid:
+        digest.update(fid.read())
+    return digest.hexdigest()
+
+def _file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fid:
+        for block in iter(lambda: fid.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _module_sources(names):
+    """
+    Return the source files for the modules *names* which are not part of
+    the python installation.
+
+    Imports are recorded from the module spec rather than the audit hook
+    since the hook sees the cached .pyc file, which is not rewritten until
+    the edited module is next imported.
+    """
+    sources = set()
+    for name in names:
+        spec = getattr(sys.modules.get(name, None), '__spec__', None)
+        origin = getattr(spec, 'origin', None)
+        if not origin or not getattr(spec, 'has_location', False):
+            continue
+        origin = os.path.realpath(origin)
+        if not origin.startswith(_INSTALL_PREFIXES) and os.path.isfile(origin):
+            sources.add(origin)
+    return sources
+
+def _load(path):
+    """
+    Return the problem saved in *path*, or None if it is missing or stale.
+    """
+    try:
+        with open(path, 'rb') as fid:
+            files = pickle.load(fid)
+            for filename, digest in files.items():
+                if _file_hash(filename) != digest:
+                    return None
+            return pickle.load(fid)
+    except Exception:
+        # missing, stale or unreadable; rebuild from the script
+        return None
+
+def _save(path, files, problem):
+    """
+    Save *problem* to *path*, along with the hashes of the data *files*.
+    """
+    # pickle first so that nothing is written if the problem can't be saved
+    data = pickle.dumps(problem, protocol=pickle.HIGHEST_PROTOCOL)
+    files = dict((f, _file_hash(f)) for f in sorted(files))
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmpname = tempfile.mkstemp(prefix=".", dir=cache_dir)
+    with os.fdopen(fd, 'wb') as fid:
+        pickle.dump(files, fid, protocol=pickle.HIGHEST_PROTOCOL)
+        fid.write(data)
+    try:
+        os.rename(tmpname, path)
+    except OSError:
+        # Windows will not replace a snapshot saved by another worker
+        os.unlink(tmpname)
+
+
+# Files opened while a _FileRecorder is active; None when not recording
+_recording = None
+
+def _audit(event, args):
+    if _recording is not None and event == 'open':
+        _record(args[0], args[1])
+
+def _record(filename, mode):
+    """
+    Add *filename* to the recorded files if it is a data file opened for
+    reading outside of the python installation.
+    """
+    if isinstance(filename, int) or (mode and 'r' not in mode):
+        return
+    if isinstance(filename, bytes):
+        filename = filename.decode(sys.getfilesystemencoding())
+    filename = os.path.realpath(filename)
+    if filename.startswith(_INSTALL_PREFIXES) or not os.path.isfile(filename):
+        return
+    # Imported modules are recorded by source file in load_problem
+    if filename.endswith('.pyc') or '__pycache__' in filename.split(os.sep):
+        return
+    _recording.add(filename)
+
+_INSTALL_PREFIXES = tuple(set(
+    os.path.realpath(p) + os.sep
+    for p in (sys.prefix, sys.exec_prefix,
+              getattr(sys, 'base_prefix', sys.prefix))))
+
+class _FileRecorder(object):
+    """
+    Context manager returning the set of files opened while it is active.
+
+    This uses an audit hook on python 3.8 and above, which sees files
+    opened from C extensions as well as from python, and otherwise
+    replaces the builtin open function.
+    """
+    _hooked = False
+
+    def __enter__(self):
+        global _recording
+        _recording = set()
+        if hasattr(sys, 'addaudithook'):
+            # audit hooks cannot be removed, so only install one
+            if not _FileRecorder._hooked:
+                sys.addaudithook(_audit)
+                _FileRecorder._hooked = True
+        else:
+            try:
+                import builtins
+            except ImportError:
+                import __builtin__ as builtins
+            self._builtins, self._open = builtins, builtins.open
+            def _open(filename, mode='r', *args, **kw):
+                _record(filename, mode)
+                return self._open(filename, mode, *args, **kw)
+            builtins.open = _open
+        return _recording
+
+    def __exit__(self, *args):
+        global _recording
+        _recording = None
+        if not hasattr(sys, 'addaudithook'):
+            self._builtins.open = self._open
@@ -24,8 +24,13 @@ for line in open(os.path.join("refl1d", "__init__.py")):
         version = line.split('"')[1]
 #print("Version: "+version)
 
-extra_compile_args =  {'msvc': ['/EHsc']}
+extra_compile_args =  {'msvc': ['/EHsc', '/openmp']}
 extra_link_args =  {}
+# Use OpenMP to split the reflectivity calculation across threads.  Apple
+# clang does not support -fopenmp, so the mac build stays single threaded.
+if sys.platform != "darwin":
+    extra_compile_args['unix'] = ['-fopenmp']
+    extra_link_args['unix'] = ['-fopenmp']
 
 class build_ext_subclass(build_ext):
     def build_extensions(self):
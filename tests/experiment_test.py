@@ -6,7 +6,20 @@ import unittest
 import os
 import numpy as np
 
-from refl1d.names import QProbe, Slab, SLD, Parameter, Experiment
+from refl1d.names import QProbe, NeutronProbe, Slab, SLD, Parameter, Experiment
+
+
+def _neutron_probe(n=100, **kw):
+    """ Monochromatic neutron probe with *n* angles """
+    return NeutronProbe(T=np.linspace(0.1, 3, n), dT=0.02, L=4.75, dL=0.0475,
+                        **kw)
+
+
+def _nickel_film(thickness=200):
+    """ Nickel film on silicon """
+    return Slab(material=SLD(name='Si', rho=2.07)) \
+        | Slab(material=SLD(name='Ni', rho=9.4), thickness=thickness, interface=5) \
+        | Slab(material=SLD(name='air', rho=0))
 
 
 class ExperimentJsonTest(unittest.TestCase):
@@ -40,5 +53,190 @@ class ExperimentJsonTest(unittest.TestCase):
         self.assertTrue(os.path.isfile('output-expt.json'))
 
 
+class ExperimentJacobianTest(unittest.TestCase):
+    """ Analytic jacobian agrees with finite differences """
+
+    def test_jacobian(self):
+        q_values = np.linspace(0.005, 0.2, 200)
+        probe = QProbe(q_values, q_values*0.02 + 0.0001)
+        probe.intensity = Parameter(value=0.9, name='normalization')
+        probe.background = Parameter(value=1e-6, name='background')
+        sample = Slab(material=SLD(name='Si', rho=2.07, irho=0.0)) \
+            | Slab(material=SLD(name='Cu', rho=6.5, irho=0.1), thickness=130, interface=15) \
+            | Slab(material=SLD(name='Ni', rho=9.4, irho=0.0), thickness=50, interface=5) \
+            | Slab(material=SLD(name='air', rho=0, irho=0.0), interface=3)
+        expt = Experiment(probe=probe, sample=sample)
+        pars = [sample['Cu'].thickness, sample['Cu'].interface,
+                sample['Cu'].material.rho, sample['Cu'].material.irho,
+                sample['Ni'].interface, probe.intensity, probe.background]
+        J = expt.jacobian(pars)
+        theory = expt.reflectivity()[1].copy()
+        for k, p in enumerate(pars):
+            v, h = p.value, 1e-4*max(abs(p.value), 1)
+            p.value = v + h
+            expt.update()
+            hi = expt.reflectivity()[1].copy()
+            p.value = v - h
+            expt.update()
+            lo = expt.reflectivity()[1].copy()
+            p.value = v
+            expt.update()
+            target = (hi - lo)/(2*h)
+            self.assertTrue(np.max(abs(J[:, k] - target)) < 1e-5*np.max(abs(target)))
+        self.assertTrue(np.all(expt.reflectivity()[1] == theory))
+
+
+class AdaptiveOversampleTest(unittest.TestCase):
+    """ Adaptive calculation points track the fringes """
+
+    def test_adaptive_oversample(self):
+        sample = _nickel_film(thickness=2000)
+        reference = _neutron_probe(300)
+        reference.oversample(n=200, seed=1)
+        target = Experiment(probe=reference, sample=sample).reflectivity()[1]
+
+        adaptive = _neutron_probe(300)
+        adaptive.adaptive_oversample(tol=0.001)
+        expt = Experiment(probe=adaptive, sample=sample)
+        theory = expt.reflectivity()[1]
+        npoints = len(adaptive.calc_Q)
+        self.assertTrue(300 < npoints < len(reference.calc_Q)/5)
+        # Ignore the ends, where the resolution extends beyond the data
+        err = abs(theory - target)/target
+        self.assertTrue(err[10:-10].max() < 0.002)
+
+        # Small thickness changes keep the grid; large ones refine it
+        sample['Ni'].thickness.value = 2050
+        expt.update_values()
+        expt.reflectivity()
+        self.assertEqual(len(adaptive.calc_Q), npoints)
+        sample['Ni'].thickness.value = 5000
+        expt.update_values()
+        expt.reflectivity()
+        self.assertTrue(len(adaptive.calc_Q) > npoints)
+        # The refinement does not invalidate the amplitude computed with it
+        expt.update_values()
+        self.assertTrue('calc_r' in expt._cache)
+
+
+class IncrementalCacheTest(unittest.TestCase):
+    """ Beam parameter changes keep the profile and amplitude """
+
+    def test_incremental_update(self):
+        probe = _neutron_probe()
+        sample = _nickel_film()
+        expt = Experiment(probe=probe, sample=sample)
+        expt.update_values()  # record the starting values
+        R = expt.reflectivity()[1]
+        calc_r = expt._cache['calc_r']
+
+        probe.background.value = 1e-6
+        expt.update_values()
+        self.assertTrue(expt._cache['calc_r'] is calc_r)
+        self.assertTrue(('convolved', True, 0) in expt._cache)
+        self.assertTrue(np.allclose(expt.reflectivity()[1], R + 1e-6))
+
+        probe.back_absorption.value = 0.5
+        expt.update_values()
+        self.assertTrue(expt._cache['calc_r'] is calc_r)
+        self.assertFalse(('convolved', True, 0) in expt._cache)
+
+        sample['Ni'].thickness.value = 250
+        expt.update_values()
+        self.assertFalse('calc_r' in expt._cache)
+        self.assertFalse('rendered' in expt._cache)
+
+    def test_structural_update(self):
+        probe = _neutron_probe()
+        sample = _nickel_film()
+        expt = Experiment(probe=probe, sample=sample)
+        expt.reflectivity()
+        # Replacing a material changes no parameter values, so update()
+        # must drop everything.
+        sample[1].material = SLD(name='Co', rho=2.3)
+        expt.update()
+        fresh = Experiment(probe=probe, sample=sample)
+        self.assertTrue(np.allclose(expt.reflectivity()[1],
+                                    fresh.reflectivity()[1]))
+
+
+class SlabCacheTest(unittest.TestCase):
+    """ Returning to an earlier profile reuses its amplitude """
+
+    def test_slab_cache(self):
+        probe = _neutron_probe()
+        sample = _nickel_film()
+        expt = Experiment(probe=probe, sample=sample, slab_cache=True)
+        R = expt.reflectivity()[1]
+        sample['Ni'].thickness.value = 250
+        expt.update()
+        expt.reflectivity()
+        sample['Ni'].thickness.value = 200
+        expt.update()
+        self.assertTrue(np.array_equal(expt.reflectivity()[1], R))
+        self.assertEqual((expt.slab_cache.hits, expt.slab_cache.misses), (1, 2))
+
+
+class PrecisionTest(unittest.TestCase):
+    """ Changing precision recasts the slab buffers on the next render """
+
+    def test_precision(self):
+        expt = Experiment(probe=_neutron_probe(), sample=_nickel_film())
+        slabs = expt._render_slabs()
+        err, _ = expt.check_precision('single')
+        self.assertTrue(0 < err < 1e-4)
+        self.assertEqual(expt.precision, 'double')
+        self.assertTrue(expt._render_slabs() is slabs)
+        self.assertEqual(slabs.w.dtype, np.dtype('d'))
+        expt.precision = 'single'
+        self.assertEqual(expt._render_slabs().w.dtype, np.dtype('f'))
+
+
+class SldColumnsTest(unittest.TestCase):
+    """ Scattering factors on a coarse wavelength grid """
+
+    def test_sld_columns(self):
+        from refl1d.material import Material
+        from refl1d.probe import ProbeSet
+        # Time-of-flight measurement of an absorbing material
+        L = np.linspace(2, 10, 500)
+        T = 1.5*np.ones_like(L)
+        def expt(columns):
+            probe = NeutronProbe(T=T, dT=0.01, L=L, dL=0.02*L)
+            probe.sld_columns = columns
+            sample = Slab(material=SLD(name='Si', rho=2.07)) \
+                | Slab(material=Material('Gd'), thickness=100, interface=5) \
+                | Slab(material=SLD(name='air', rho=0))
+            return Experiment(probe=probe, sample=sample)
+        coarse, fine = expt(50), expt(len(L))
+        self.assertEqual(coarse._render_slabs().rho.shape[0], 50)
+        self.assertEqual(fine._render_slabs().rho.shape[0], len(L))
+        R, Rfine = coarse.reflectivity()[1], fine.reflectivity()[1]
+        self.assertTrue(np.max(abs(R - Rfine)/Rfine) < 0.002)
+        # Probe sets use a single set of scattering factors
+        probe = ProbeSet([NeutronProbe(T=T, dT=0.01, L=L, dL=0.02*L)])
+        probe.probes[0].sld_columns = 50
+        self.assertRaises(ValueError, Experiment, probe=probe,
+                          sample=Material('Si')(0, 5) | SLD(name='air', rho=0))
+
+
+class ScatteringFactorCacheTest(unittest.TestCase):
+    """ Experiments share scattering factors for the same materials """
+
+    def test_shared_scattering_factors(self):
+        from refl1d.material import Material, scattering_factor_cache
+        scattering_factor_cache.reset()
+        def expt(k):
+            probe = _neutron_probe(background=1e-6*k)
+            # Rebuild the materials for each contrast
+            sample = Material('Si')(0, 5) | Material('Ni')(200, 5) \
+                | Material('D2O')
+            return Experiment(probe=probe, sample=sample)
+        R = [expt(k).reflectivity()[1] for k in range(3)]
+        self.assertEqual(scattering_factor_cache.misses, 3)
+        self.assertEqual(scattering_factor_cache.hits, 6)
+        self.assertTrue(np.allclose(R[0], R[1] - 1e-6))
+
+
 if __name__ == '__main__':
     unittest.main()
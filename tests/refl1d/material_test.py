@@ -0,0 +1,24 @@
+import numpy
+from refl1d.material import Material, Mixture
+from refl1d.probe import NeutronProbe
+
+def test_mixture_population():
+    probe = NeutronProbe(T=numpy.linspace(0.1, 3, 20), dT=0.01,
+                         L=4.75, dL=0.0475)
+    Si, Ni, Cu = [Material(name) for name in ('Si', 'Ni', 'Cu')]
+    rho_Si, rho_Ni, rho_Cu = [m.sld(probe)[0] for m in (Si, Ni, Cu)]
+    fraction = numpy.array([[20, 10], [5, 50], [60, 50]])
+
+    M = Mixture.byvolume(Si, Ni, 20, Cu, 10)
+    rho, irho = M.mix(probe, fraction)
+    assert rho.shape == (3,) + numpy.shape(rho_Si)
+    assert numpy.allclose(rho[0], 0.7*rho_Si + 0.2*rho_Ni + 0.1*rho_Cu)
+    assert numpy.isnan(rho[2]).all() and numpy.isnan(irho[2]).all()
+
+    M = Mixture.bymass(Si, Ni, 20, Cu, 10)
+    rho, irho = M.mix(probe, fraction)
+    for k in range(2):
+        for p, v in zip(M.fraction, fraction[k]):
+            p.value = v
+        assert numpy.allclose(rho[k], M.sld(probe)[0])
+        assert numpy.allclose(irho[k], M.sld(probe)[1])
@@ -0,0 +1,53 @@
+import json
+import subprocess
+import sys
+from time import time
+
+HEAVY = ('bumps.fitproblem', 'bumps.pdfwrapper', 'refl1d.experiment',
+         'refl1d.polymer', 'refl1d.stajconvert', 'refl1d.ncnrdata',
+         'refl1d.snsdata', 'refl1d.materialdb')
+
+def _cold_import(statement):
+    """
+    Run *statement* in a new interpreter, returning the modules it loaded
+    and the time taken.
+    """
+    code = ("import sys, json, time; t = time.time(); %s; "
+            "print(json.dumps([time.time() - t, sorted(sys.modules)]))"
+            % statement)
+    output = subprocess.check_output([sys.executable, "-c", code])
+    elapsed, modules = json.loads(output.decode('ascii').splitlines()[-1])
+    return set(modules), elapsed
+
+def test_lazy_names():
+    if sys.version_info < (3, 7):
+        return  # names are loaded eagerly without PEP 562
+    modules, _ = _cold_import("from refl1d.names import Slab, SLD")
+    for name in HEAVY:
+        assert name not in modules, name
+    modules, _ = _cold_import("from refl1d.names import *")
+    for name in HEAVY:
+        assert name in modules, name
+
+def test_names_complete():
+    import refl1d.names
+    from refl1d import materialdb
+    assert set(materialdb.__all__) <= set(refl1d.names.__all__)
+    for name in refl1d.names.__all__:
+        getattr(refl1d.names, name)
+
+def test_import_time():
+    if sys.version_info < (3, 7):
+        return
+    # Best of three, so that disk caching does not favour the second
+    few = min(_cold_import("from refl1d.names import Slab, SLD")[1]
+              for _ in range(3))
+    every = min(_cold_import("from refl1d.names import *")[1]
+                for _ in range(3))
+    print("import a few names %.3f s, import * %.3f s"%(few, every))
+    assert few < every
+
+if __name__ == "__main__":
+    test_lazy_names()
+    test_names_complete()
+    test_import_time()
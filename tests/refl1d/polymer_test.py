@@ -15,7 +15,8 @@ import numpy as np
 from refl1d.names import Material
 from refl1d.polymer import (PolymerBrush, PolymerMushroom, EndTetheredPolymer,
                             SCFprofile, SCFcache, SCFsolve, SCFeqns, SZdist,
-                            calc_g_zs)
+                            SCFstore, SCFjacobian, calc_g_zs,
+                            calc_g_zs_batch, set_scf_store, _NearestIndex)
 
 
 def calc_g_zs_test():
@@ -149,6 +150,57 @@ def calc_g_zs_test():
     assert np.allclose(calc_g_zs(g_z,c_i,layers,segments), data, atol=1e-14)
     
 
+def calc_g_zs_batch_test():
+    layers=10
+    segments=20
+    g_z = np.array([np.linspace(.9,1.1,layers)*k for k in (1., .9, 1.1)])
+    c_i = SZdist(1.2, 15)[:, :segments]*np.array([[1.], [2.], [3.]])
+
+    batch = calc_g_zs_batch(g_z, 0, layers, segments)
+    for k in range(3):
+        assert batch[k].flags.f_contiguous
+        assert np.allclose(batch[k], calc_g_zs(g_z[k],0,layers,segments),
+                           atol=1e-14)
+
+    batch = calc_g_zs_batch(g_z, c_i, layers, segments, threads=2)
+    for k in range(3):
+        expected = calc_g_zs(g_z[k],c_i[k:k+1].copy(),layers,segments)
+        assert np.allclose(batch[k], expected, atol=1e-14)
+
+    # a shared g_z with terminally attached and uniform chains
+    batch = calc_g_zs_batch(g_z[1], (0., 2.), layers, segments)
+    for k, c in enumerate((0., 2.)):
+        assert np.allclose(batch[k], calc_g_zs(g_z[1],c,layers,segments),
+                           atol=1e-14)
+
+    for args in ((g_z[:, :-1], 0), (g_z, c_i[:, :-1]), (g_z[:2], c_i)):
+        try:
+            calc_g_zs_batch(args[0], args[1], layers, segments)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError")
+
+
+def calc_g_zs_benchmark(layers=200, segments=2000, batch=16):
+    from time import time
+    g_z = 1 + 0.01*np.random.rand(batch, layers)
+    c_i = SZdist(1.2, segments/2)[:, :segments]*np.ones((batch, 1))
+    c_i = np.ascontiguousarray(c_i)
+
+    # keep the results, as the batch does
+    starttime = time()
+    [calc_g_zs(g_z[k],c_i[k:k+1],layers,segments) for k in range(batch)]
+    single = time()-starttime
+
+    starttime = time()
+    calc_g_zs_batch(g_z, c_i, layers, segments)
+    batched = time()-starttime
+
+    print("calc_g_zs %d chains of %d x %d: loop %.3f s, batch %.3f s"
+          % (batch, layers, segments, single, batched))
+
+
 def SZdist_test():
     
     # uniform
@@ -423,6 +475,23 @@ def SCFsolve_test():
     result = SCFsolve(chi,chi_s,pdi,sigma,navgsegments,False,phi0)
     assert np.allclose(result, data, atol=1e-14)
     
+
+def SCFjacobian_test():
+    # Jacobian-vector products match finite differences of SCFeqns
+    phi_z = np.linspace(.5,0,50)
+    v = np.cos(np.arange(50.))
+    h = 1e-6
+    for pdi, navgsegments in ((1, 95), (1.2, 95.5)):
+        args = (0.1, 0.05, .1, navgsegments, SZdist(pdi, navgsegments))
+        jac = SCFjacobian(phi_z, *args)
+        assert np.allclose(jac.residual, SCFeqns(phi_z.copy(), *args))
+        fd = (SCFeqns(phi_z+h*v, *args) - SCFeqns(phi_z-h*v, *args))/(2*h)
+        assert np.allclose(jac.matvec(v), fd, rtol=1e-5, atol=1e-8)
+
+    # and the Newton solver finds the same solution as scipy
+    result = SCFsolve(0.1,0.05,1.2,.1,95.5,method='newton')
+    assert np.allclose(result, easy_phi_z, atol=1e-5)
+
          
 def SCFcache_test():
     
@@ -467,6 +536,79 @@ def SCFcache_test():
         assert newest_key == list(cache)[-2]
     
 
+def nearest_index_test():
+    rng = np.random.RandomState(1)
+    keys = [tuple(v) for v in rng.rand(200, 5)]
+    index = _NearestIndex(keys[:100])
+    present = set(keys[:100])
+    # mix changes with lookups so that some go through the tree rebuild
+    for k in range(100):
+        index.add(keys[100+k])
+        present.add(keys[100+k])
+        if k % 3 == 0:
+            index.remove(keys[2*k])
+            present.discard(keys[2*k])
+        target = tuple(rng.rand(5))
+        expected = min(present,
+                       key=lambda v: np.linalg.norm(np.subtract(v, target)))
+        key, distance = index.nearest(target)
+        assert key == expected
+        assert np.allclose(distance, np.linalg.norm(np.subtract(key, target)))
+    assert len(index) == len(present)
+    assert _NearestIndex().nearest(keys[0]) == (None, np.inf)
+
+
+def SCFstore_test():
+    import shutil
+    import tempfile
+    from collections import OrderedDict
+    from refl1d import polymer
+    path = tempfile.mkdtemp()
+    try:
+        store = SCFstore(path, max_bytes=2000, interval=60)
+        phi = np.linspace(.5, 0, 30)
+        assert store.get((0, 0, 0, .1, .2)) is None
+        assert store.nearest((0, 0, 0, .1, .2)) == (None, np.inf)
+        store.put((0, 0, 0, .1, .2), phi)
+        store.put((1, .3, .2, .1, .2), 2*phi)
+
+        # a second process sees the same solutions
+        other = SCFstore(path, max_bytes=2000, interval=60)
+        assert len(other) == 2
+        assert np.array_equal(other.get((1, .3, .2, .1, .2)), 2*phi)
+        key, distance = other.nearest((.9, .3, .2, .1, .2))
+        assert key == (1, .3, .2, .1, .2) and np.allclose(distance, .1)
+
+        # but only after the directory is scanned again
+        other.put((.9, .3, .2, .1, .2), phi)
+        assert store.nearest((.9, .3, .2, .1, .2))[0] == (1, .3, .2, .1, .2)
+        store.refresh(force=True)
+        assert store.nearest((.9, .3, .2, .1, .2))[0] == (.9, .3, .2, .1, .2)
+
+        # the least recently used solutions are evicted
+        for k in range(10):
+            store.put((0, 0, 0, .1, k), phi)
+        assert 0 < len(store) < 12
+        store.refresh(force=True)
+        assert sum(size for _, size in store._files.values()) <= 2000
+    finally:
+        shutil.rmtree(path)
+
+    # SCFcache stores the solution but not the steps walking to it
+    path = tempfile.mkdtemp()
+    saved = polymer.SCF_STORE
+    try:
+        store = set_scf_store(path)
+        cache = OrderedDict()
+        SCFcache(1, .5, 1.2, .1, 95.5, False, cache)
+        assert len(cache) > 2
+        assert len(store) == 2
+        assert (1, .5*3, 1.2-1, .1, 95.5/500) in store
+    finally:
+        polymer.SCF_STORE = saved
+        shutil.rmtree(path)
+
+
 long_profile = np.array((
          4.99184756e-01,   4.87940275e-01,   4.76695793e-01,
          4.65451312e-01,   4.56517574e-01,   4.50163833e-01,
@@ -736,11 +878,16 @@ def PolymerBrush_test():
 
 if __name__ == '__main__':
     calc_g_zs_test()
+    calc_g_zs_batch_test()
     SZdist_test()
     SCFeqns_test()
     SCFsolve_test()
+    SCFjacobian_test()
     SCFcache_test()
+    nearest_index_test()
+    SCFstore_test()
     SCFprofile_test()
     EndTetheredPolymer_test()
     PolymerMushroom_test()
     PolymerBrush_test()
+    calc_g_zs_benchmark()
@@ -0,0 +1,58 @@
+import numpy
+from refl1d.probe import NeutronProbe, QProbe, ProbeSet, PolarizedNeutronProbe
+
+def test_resolution_guard():
+    # Sparse measurement: each window needs the full complement of points
+    Q = numpy.linspace(0.01, 0.2, 20)
+    probe = QProbe(Q, 0.001*numpy.ones_like(Q))
+    assert probe.resolution_guard(n=5) == 20*4
+    assert probe.resolution_guard(n=5) == 0
+    calc_Q = probe.calc_Q
+    for Qk in Q:
+        assert numpy.sum(abs(calc_Q - Qk) <= 0.003) >= 5
+
+    # Dense measurement: only the ends need points beyond the data
+    probe = NeutronProbe(T=numpy.linspace(0.1, 3, 300), dT=0.02,
+                         L=4.75, dL=0.0475)
+    added = probe.resolution_guard(n=5)
+    assert 0 < added < 10
+    assert probe.calc_Q[-1] > probe.Q[-1] and probe.calc_Q[0] < probe.Q[0]
+    assert len(probe.unique_L) == 1
+
+def test_probeset_cache():
+    probes = [NeutronProbe(T=numpy.linspace(0.1+k, 1+k, 20), dT=0.01,
+                           L=4.75, dL=0.0475) for k in range(3)]
+    probeset = ProbeSet(probes)
+    Q, calc_Q = probeset.Q, probeset.calc_Q
+    assert probeset.Q is Q and probeset.calc_Q is calc_Q
+    # Changes to theta offset or to the calculation points are seen
+    probes[1].theta_offset.value = 0.01
+    assert probeset.Q is not Q
+    assert numpy.array_equal(probeset.Q[20:40], probes[1].Q)
+    probes[2].oversample(10)
+    assert len(probeset.calc_Q) == 20*2 + 20*10
+
+def test_polarized_fused_beam():
+    T = numpy.linspace(0.1, 3, 50)
+    xs = [NeutronProbe(T=T, dT=0.01, L=4.75, dL=0.0475, background=1e-6*k)
+          for k in range(4)]
+    xs[2] = None
+    probe = PolarizedNeutronProbe(xs)
+    probe.oversample(10)
+    # Only cross sections using the resolution matrix are fused
+    assert not probe._shared_grid()
+    for p in xs:
+        if p is not None:
+            p.convolution = 'matrix'
+    assert probe._shared_grid()
+    Q = probe.calc_Q
+    R = [numpy.exp(-(30+k)*Q)*(1 + 0.3*numpy.cos(400*Q)) for k in range(4)]
+    fused = probe.apply_beam(Q, R)
+    separate = [(p.apply_beam(Q, Rk) if p else None) for p, Rk in zip(xs, R)]
+    assert fused[2] is None
+    for a, b in zip(fused, separate):
+        if a is not None:
+            assert numpy.max(abs(a[1] - b[1])) < 1e-14
+    # Moving one cross section off the shared grid disables the fused path
+    xs[0].theta_offset.value = 0.01
+    assert not probe._shared_grid()
@@ -0,0 +1,51 @@
+import numpy as np
+from refl1d.profile import Microslabs, build_profile, _build_profile_direct
+
+def _render(slabs, thickness):
+    slabs.clear()
+    slabs.append(w=0, rho=2.07)
+    Pw, Pz = slabs.microslabs(thickness)
+    slabs.extend(w=Pw, rho=[4.5 - 2.43*np.exp(-Pz/20)], sigma=1)
+    slabs.append(w=0, rho=0, sigma=3)
+    slabs.finalize(step_interfaces=True, dA=0.01)
+
+def test_steady_state_allocations():
+    slabs = Microslabs(1, dz=1)
+    for thickness in (80, 100, 90):
+        _render(slabs, thickness)
+    allocations = slabs.allocations
+    for thickness in (95, 85, 100):
+        _render(slabs, thickness)
+        # slabs are views into the preallocated buffers
+        assert slabs.w.base is slabs._w and slabs.rho.flags.c_contiguous
+    assert slabs.allocations == allocations
+
+def test_build_profile():
+    rng = np.random.RandomState(1)
+    offset = np.cumsum(rng.uniform(5, 30, 50))
+    sigma = rng.uniform(0, 6, 50)
+    sigma[::5] = 0
+    value = rng.uniform(0, 8, (3, 51))
+    z = np.arange(-20, offset[-1]+20, 0.25)
+    expected = _build_profile_direct(z, offset, sigma, value)
+    assert np.allclose(build_profile(z, offset, sigma, value), expected,
+                       rtol=0, atol=1e-12)
+    assert np.allclose(build_profile(z, offset, sigma, value[1]), expected[1],
+                       rtol=0, atol=1e-12)
+
+def test_contract_multiple_wavelengths():
+    def contract(scale):
+        slabs = Microslabs(len(scale), dz=1)
+        slabs.append(w=0, rho=2.07)
+        Pw, Pz = slabs.microslabs(200)
+        rho = 4.5 - 2.43*np.exp(-Pz/20)
+        slabs.extend(w=Pw, rho=[f*rho for f in scale],
+                     irho=[0.1*f*np.exp(-Pz/50) for f in scale])
+        slabs.append(w=0, rho=0, sigma=3)
+        slabs.finalize(step_interfaces=True, dA=0.01)
+        return slabs
+    single, repeated = contract([1]), contract([1, 1, 1])
+    assert len(repeated.w) == len(single.w) < 200
+    assert (repeated.rho == single.rho).all()
+    # worst case wavelength controls the layering
+    assert len(contract([0.5, 1, 2]).w) == len(contract([2]).w)
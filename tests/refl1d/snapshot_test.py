@@ -0,0 +1,104 @@
+import os
+import sys
+import shutil
+import py_compile
+import tempfile
+
+import numpy as np
+
+from refl1d import snapshot
+
+MODEL = """\
+import sys
+import numpy as np
+from refl1d.names import *
+
+Q, R, dR = np.loadtxt(sys.argv[1]).T
+probe = QProbe(Q, 0.001*np.ones_like(Q), data=(R, dR))
+sample = SLD(name='Si', rho=2.07)(0, 5) | SLD(name='air', rho=0)
+problem = FitProblem(Experiment(probe=probe, sample=sample))
+"""
+
+def _write_data(filename, scale):
+    Q = np.linspace(0.01, 0.2, 50)
+    R = scale*np.exp(-50*Q)
+    np.savetxt(filename, np.vstack((Q, R, 0.05*R)).T)
+
+def test_snapshot():
+    path = tempfile.mkdtemp()
+    try:
+        script = os.path.join(path, 'model.py')
+        data = os.path.join(path, 'data.txt')
+        cache = os.path.join(path, 'cache')
+        with open(script, 'w') as fid:
+            fid.write(MODEL)
+        _write_data(data, 1.0)
+        snapshot.STATS.update(hits=0, misses=0, failures=0)
+
+        first = snapshot.load_problem(script, [data], cache_dir=cache)
+        second = snapshot.load_problem(script, [data], cache_dir=cache)
+        assert snapshot.STATS == {'hits': 1, 'misses': 1, 'failures': 0}
+        assert np.allclose(first.chisq(), second.chisq())
+
+        # changing the data file rebuilds the problem
+        _write_data(data, 2.0)
+        third = snapshot.load_problem(script, [data], cache_dir=cache)
+        assert snapshot.STATS['misses'] == 2
+        assert not np.allclose(first.chisq(), third.chisq())
+    finally:
+        shutil.rmtree(path)
+
+HELPER_MODEL = """\
+from refl1d.names import *
+from snapshot_helper import sample
+
+probe = NeutronProbe(T=np.linspace(0, 5, 50), L=4.75)
+problem = FitProblem(Experiment(probe=probe, sample=sample))
+"""
+
+HELPER = """\
+from refl1d.names import SLD
+sample = SLD(name='Si', rho=%g)(0, 5) | SLD(name='air', rho=0)
+"""
+
+def _write_helper(filename, rho):
+    with open(filename, 'w') as fid:
+        fid.write(HELPER % rho)
+
+def test_snapshot_helper():
+    path = tempfile.mkdtemp()
+    sys.path.insert(0, path)
+    try:
+        script = os.path.join(path, 'model.py')
+        helper = os.path.join(path, 'snapshot_helper.py')
+        cache = os.path.join(path, 'cache')
+        with open(script, 'w') as fid:
+            fid.write(HELPER_MODEL)
+        _write_helper(helper, 2.07)
+        # with a compiled helper, the import only opens the .pyc file
+        py_compile.compile(helper)
+        snapshot.STATS.update(hits=0, misses=0, failures=0)
+
+        first = snapshot.load_problem(script, cache_dir=cache)
+        # each fit worker imports the helper afresh
+        sys.modules.pop('snapshot_helper', None)
+        second = snapshot.load_problem(script, cache_dir=cache)
+        assert snapshot.STATS == {'hits': 1, 'misses': 1, 'failures': 0}
+        assert np.allclose(first.fitness.reflectivity()[1],
+                           second.fitness.reflectivity()[1])
+
+        # editing the helper rebuilds the problem
+        _write_helper(helper, 4.0)
+        sys.modules.pop('snapshot_helper', None)
+        third = snapshot.load_problem(script, cache_dir=cache)
+        assert snapshot.STATS['misses'] == 2
+        assert not np.allclose(second.fitness.reflectivity()[1],
+                               third.fitness.reflectivity()[1])
+    finally:
+        sys.path.remove(path)
+        sys.modules.pop('snapshot_helper', None)
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    test_snapshot()
+    test_snapshot_helper()